@@ -42,9 +42,10 @@ const schema = {
                 type: 'number',
                 default: 5.0
             },
+            // 0 = otomatik: bu makinenin kalibrasyonu (python/calibration.py)
             defaultThreads: {
                 type: 'number',
-                default: 8
+                default: 0
             }
         }
     }
@@ -2,6 +2,7 @@ const fs = require('fs').promises;
 const path = require('path');
 const { spawn } = require('child_process');
 const { app } = require('electron');
+const processManager = require('./processManager');
 
 class FileManager {
     constructor() {
@@ -9,12 +10,9 @@ class FileManager {
         const isDev = !app.isPackaged;
         if (isDev) {
             this.ffmpegPath = 'ffmpeg';
-            this.ffprobePath = 'ffprobe';
         } else {
             const ffmpegBin = process.platform === 'win32' ? 'ffmpeg.exe' : 'ffmpeg';
-            const ffprobeBin = process.platform === 'win32' ? 'ffprobe.exe' : 'ffprobe';
             this.ffmpegPath = path.join(process.resourcesPath, 'ffmpeg', 'bin', ffmpegBin);
-            this.ffprobePath = path.join(process.resourcesPath, 'ffmpeg', 'bin', ffprobeBin);
         }
     }
     /**
@@ -51,7 +49,7 @@ class FileManager {
                 };
             }
 
-            // Get file info using ffprobe if available
+            // Get stream info from the media probe if available
             const videoInfo = await this.getVideoInfo(filePath);
 
             return {
@@ -71,54 +69,24 @@ class FileManager {
     }
 
     /**
-     * Get video information using ffprobe
+     * Get video information from the Python media probe
+     * (one ffprobe call in a light process of its own)
      */
     async getVideoInfo(filePath) {
-        return new Promise((resolve) => {
-            const ffprobe = spawn(this.ffprobePath, [
-                '-v', 'quiet',
-                '-print_format', 'json',
-                '-show_format',
-                '-show_streams',
-                filePath
-            ]);
-
-            let output = '';
-
-            ffprobe.stdout.on('data', (data) => {
-                output += data.toString();
-            });
-
-            ffprobe.on('close', (code) => {
-                if (code === 0) {
-                    try {
-                        const data = JSON.parse(output);
-                        const videoStream = data.streams.find(s => s.codec_type === 'video');
-
-                        if (videoStream) {
-                            resolve({
-                                width: videoStream.width,
-                                height: videoStream.height,
-                                codec: videoStream.codec_name,
-                                duration: parseFloat(data.format.duration),
-                                bitrate: parseInt(data.format.bit_rate),
-                                fps: eval(videoStream.r_frame_rate)
-                            });
-                        } else {
-                            resolve(null);
-                        }
-                    } catch (error) {
-                        resolve(null);
-                    }
-                } else {
-                    resolve(null);
-                }
-            });
-
-            ffprobe.on('error', () => {
-                resolve(null);
-            });
-        });
+        const result = await processManager.probeVideo(filePath);
+        if (!result || !result.success) {
+            return null;
+        }
+        return {
+            width: result.width,
+            height: result.height,
+            codec: result.codec,
+            duration: result.duration,
+            bitrate: result.bit_rate,
+            fps: result.fps,
+            frameCount: result.frame_count,
+            audio: result.audio
+        };
     }
 
     /**
@@ -6,6 +6,7 @@ class KeyStorage {
     constructor() {
         this.dbPath = path.join(__dirname, '../data/records.json');
         this.records = [];
+        this.sequenceIndex = null; // "sorted keys|sequence" -> records, built on first lookup
         this.initialized = false;
         this.initialize();
     }
@@ -33,6 +34,7 @@ class KeyStorage {
                 await this.saveToFile();
             }
 
+            this.sequenceIndex = null;
             this.initialized = true;
             console.log(`KeyStorage initialized with ${this.records.length} records`);
 
@@ -46,6 +48,8 @@ class KeyStorage {
      * Save records to file
      */
     async saveToFile() {
+        // Every change to this.records ends here
+        this.sequenceIndex = null;
         try {
             await fs.writeFile(this.dbPath, JSON.stringify(this.records, null, 2), 'utf8');
             return { success: true };
@@ -171,6 +175,52 @@ class KeyStorage {
         );
     }
 
+    /**
+     * Canonical index key of an embedded key order: the keys sorted ascending
+     * and the sequence as positions in that sorted list. Two records that put
+     * the same keys into the same fragments get the same index key.
+     * @param {number[]} keys - Keys of the record
+     * @param {string} sequence - Sequence of indices into keys
+     * @returns {string|null} e.g. "123,321,456,789|3012"
+     */
+    static sequenceIndexKey(keys, sequence) {
+        if (!keys || !sequence) {
+            return null;
+        }
+        const order = String(sequence).split('').map(c => Number(keys[Number(c)]));
+        if (order.some(k => !Number.isFinite(k))) {
+            return null;
+        }
+        const sorted = [...order].sort((a, b) => a - b);
+        return `${sorted.join(',')}|${order.map(k => sorted.indexOf(k)).join('')}`;
+    }
+
+    /**
+     * Find the records that embedded keys in a given order (see identify-key)
+     * @param {number[]} keys - Keys sorted ascending
+     * @param {string} sequence - Positions in keys, one per fragment slot
+     * @returns {Promise<object[]>} Matching records (normally one)
+     */
+    async findByKeySequence(keys, sequence) {
+        if (!this.initialized) {
+            await this.initialize();
+        }
+
+        if (!this.sequenceIndex) {
+            this.sequenceIndex = new Map();
+            for (const record of this.records) {
+                const indexKey = KeyStorage.sequenceIndexKey(record.keys, record.sequence);
+                if (indexKey) {
+                    const bucket = this.sequenceIndex.get(indexKey) || [];
+                    bucket.push(record);
+                    this.sequenceIndex.set(indexKey, bucket);
+                }
+            }
+        }
+
+        return this.sequenceIndex.get(KeyStorage.sequenceIndexKey(keys, sequence)) || [];
+    }
+
     /**
      * Get record by ID
      */
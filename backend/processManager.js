@@ -1,5 +1,7 @@
 const { spawn } = require('child_process');
+const readline = require('readline');
 const path = require('path');
+const os = require('os');
 const fs = require('fs').promises;
 const { app } = require('electron');
 
@@ -29,6 +31,161 @@ class ProcessManager {
             const ffmpegBin = process.platform === 'win32' ? 'ffmpeg.exe' : 'ffmpeg';
             this.ffmpegPath = path.join(process.resourcesPath, 'ffmpeg', 'bin', ffmpegBin);
         }
+
+        // Python side caches (watermark patterns) live under the app data folder
+        this.pythonEnv = {
+            ...process.env,
+            MGHOSTING_CACHE_DIR: path.join(app.getPath('userData'), 'cache')
+        };
+
+        // Persistent Python worker (serve mode), started on first job
+        this.useWorker = process.env.MGHOSTING_PERSISTENT_WORKER !== '0';
+        this.worker = null;
+        this.workerJobs = new Map();
+        this.nextJobId = 1;
+    }
+
+    /**
+     * Forward a Python progress event to the UI
+     * Profiled jobs (MGHOSTING_PROFILE=1 or a `profile` arg) also send
+     * status "metrics" events whose `metrics` object is passed through
+     * extract-batch sends one status "file" event per finished file with
+     * its `file`, `id` and `result`
+     */
+    sendProgress(mainWindow, parsed) {
+        console.log(`Progress: ${parsed.progress || '?'}% - ${parsed.message}`);
+
+        if (mainWindow && !mainWindow.isDestroyed()) {
+            const event = {
+                status: parsed.status,
+                message: parsed.message,
+                progress: parsed.progress || 0,
+                timestamp: new Date().toLocaleTimeString('tr-TR')
+            };
+            if (parsed.metrics) {
+                event.phase = parsed.phase;
+                event.metrics = parsed.metrics;
+            }
+            if (parsed.status === 'file') {
+                event.file = parsed.file;
+                event.id = parsed.id;
+                event.result = parsed.result;
+            }
+            mainWindow.webContents.send('watermark-progress', event);
+        }
+    }
+
+    /**
+     * Start the persistent Python worker if it is not running
+     * Resolves once the worker has announced it is ready
+     */
+    startWorker() {
+        if (this.worker) {
+            return this.worker.ready;
+        }
+
+        const child = spawn(this.pythonPath, [this.scriptPath, 'serve'], { env: this.pythonEnv });
+        const worker = { process: child, ready: null };
+
+        worker.ready = new Promise((resolve, reject) => {
+            const rl = readline.createInterface({ input: child.stdout });
+
+            rl.on('line', (line) => {
+                let message;
+                try {
+                    message = JSON.parse(line);
+                } catch (e) {
+                    // Not a protocol message (e.g. import-time output)
+                    return;
+                }
+
+                if (message.type === 'ready') {
+                    console.log(`Python worker ready (pid ${message.pid})`);
+                    resolve();
+                    return;
+                }
+
+                const job = this.workerJobs.get(message.job_id);
+                if (!job) {
+                    return;
+                }
+
+                if (message.type === 'event') {
+                    this.sendProgress(job.mainWindow, message);
+                } else if (message.type === 'result') {
+                    this.workerJobs.delete(message.job_id);
+                    job.resolve(message.result);
+                }
+            });
+
+            child.stderr.on('data', (data) => {
+                console.error('Python worker stderr:', data.toString());
+            });
+
+            const fail = (error) => {
+                if (this.worker === worker) {
+                    this.worker = null;
+                }
+                reject(error);
+                for (const [jobId, job] of this.workerJobs) {
+                    this.workerJobs.delete(jobId);
+                    job.reject(error);
+                }
+            };
+
+            child.on('error', (error) => fail(new Error(`Failed to start Python worker: ${error.message}`)));
+            child.on('close', (code) => fail(new Error(`Python worker exited with code ${code}`)));
+        });
+
+        this.worker = worker;
+        return worker.ready;
+    }
+
+    /**
+     * Stop the persistent Python worker
+     */
+    stopWorker() {
+        if (!this.worker) {
+            return;
+        }
+        const child = this.worker.process;
+        this.worker = null;
+        try {
+            child.stdin.write(JSON.stringify({ id: 'shutdown', command: 'shutdown' }) + '\n');
+            child.stdin.end();
+        } catch (e) {
+            child.kill();
+        }
+    }
+
+    /**
+     * Run a command on the persistent worker
+     * @param {string} command - Command name
+     * @param {object} args - Arguments
+     * @param {object} mainWindow - Electron main window for IPC messages
+     */
+    async executeWorkerJob(command, args, mainWindow = null) {
+        await this.startWorker();
+
+        const jobId = `job-${this.nextJobId++}`;
+        return new Promise((resolve, reject) => {
+            this.workerJobs.set(jobId, { resolve, reject, mainWindow });
+            this.worker.process.stdin.write(JSON.stringify({ id: jobId, command, args }) + '\n');
+        });
+    }
+
+    /**
+     * Run a command on the persistent worker, falling back to a one-off process
+     */
+    async runJob(command, args, mainWindow = null) {
+        if (this.useWorker) {
+            try {
+                return await this.executeWorkerJob(command, args, mainWindow);
+            } catch (error) {
+                console.error('Python worker unavailable, falling back to a new process:', error.message);
+            }
+        }
+        return this.executePythonScript(command, args, mainWindow);
     }
 
     /**
@@ -40,7 +197,7 @@ class ProcessManager {
     async executePythonScript(command, args, mainWindow = null) {
         return new Promise((resolve, reject) => {
             const argsJson = JSON.stringify(args);
-            const pythonProcess = spawn(this.pythonPath, [this.scriptPath, command, argsJson]);
+            const pythonProcess = spawn(this.pythonPath, [this.scriptPath, command, argsJson], { env: this.pythonEnv });
 
             let stdout = '';
             let stderr = '';
@@ -57,17 +214,9 @@ class ProcessManager {
                         const parsed = JSON.parse(line);
                         if (parsed.status) {
                             progressData.push(parsed);
-                            console.log(`Progress: ${parsed.progress || '?'}% - ${parsed.message}`);
                             
                             // Send to UI via IPC
-                            if (mainWindow && !mainWindow.isDestroyed()) {
-                                mainWindow.webContents.send('watermark-progress', {
-                                    status: parsed.status,
-                                    message: parsed.message,
-                                    progress: parsed.progress || 0,
-                                    timestamp: new Date().toLocaleTimeString('tr-TR')
-                                });
-                            }
+                            this.sendProgress(mainWindow, parsed);
                         }
                     } catch (e) {
                         // Not JSON, regular output
@@ -200,9 +349,15 @@ class ProcessManager {
      * @param {object} options - Options
      * @param {object} mainWindow - Electron main window for progress updates
      */
-    async embedWatermarkKey({ videoPath, outputPath, keys, sequence, fragLength, strength, step, threads }, mainWindow = null) {
+    async embedWatermarkKey({ videoPath, outputPath, keys, sequence, fragLength, strength, step, threads, resume, tileMemoryMb, markEvery, markPerFragment }, mainWindow = null) {
         try {
-            const result = await this.executePythonScript('embed-key', {
+            // resume: checkpoint every fragment and reuse those finished by an
+            // interrupted run with the same keys and settings
+            // tileMemoryMb: transform memory budget; larger frames (4K/8K) are
+            // processed as tiles with identical output
+            // markEvery / markPerFragment: watermark only every k-th frame or k
+            // frames of each fragment; detection needs the same value
+            const result = await this.runJob('embed-key', {
                 video_path: videoPath,
                 output_path: outputPath,
                 keys: keys,
@@ -210,7 +365,11 @@ class ProcessManager {
                 frag_length: fragLength || 1,
                 strength: strength || 1.0,
                 step: step || 5.0,
-                threads: threads || 8
+                threads: threads || null,
+                resume: Boolean(resume),
+                tile_memory_mb: tileMemoryMb || null,
+                mark_every: markEvery || null,
+                mark_per_fragment: markPerFragment || null
             }, mainWindow);
 
             return result;
@@ -223,18 +382,66 @@ class ProcessManager {
         }
     }
 
+    /**
+     * Embed a different key-based watermark into one video for many recipients
+     * The source is decoded and transformed once; each output gets its own encoder
+     * @param {object} options - Options (jobs: [{ id, keys, sequence, outputPath, fragLength }])
+     * @param {object} mainWindow - Electron main window for progress updates
+     */
+    async embedWatermarkKeyBatch({ videoPath, jobs, fragLength, strength, step, threads, tileMemoryMb }, mainWindow = null) {
+        // Recipient lists can be long, so pass them via a file
+        const jobsFile = path.join(os.tmpdir(), `mghosting_jobs_${Date.now()}.json`);
+        try {
+            await fs.writeFile(jobsFile, JSON.stringify(jobs.map(j => ({
+                id: j.id,
+                keys: j.keys,
+                sequence: j.sequence,
+                output_path: j.outputPath,
+                frag_length: j.fragLength || fragLength || 1
+            }))), 'utf8');
+
+            const result = await this.runJob('embed-key-batch', {
+                video_path: videoPath,
+                jobs_file: jobsFile,
+                frag_length: fragLength || 1,
+                strength: strength || 1.0,
+                step: step || 5.0,
+                threads: threads || null,
+                tile_memory_mb: tileMemoryMb || null
+            }, mainWindow);
+
+            return result;
+        } catch (error) {
+            console.error('Batch embed key-based watermark error:', error);
+            return {
+                success: false,
+                error: error.message
+            };
+        } finally {
+            await fs.unlink(jobsFile).catch(() => {});
+        }
+    }
+
     /**
      * Extract key-based watermark
+     * windows: only read these time windows ([start, end] in seconds or "1:30-2:00"),
+     * seeking to each instead of decoding the file from the start
      */
-    async extractWatermarkKey({ videoPath, keys, fragLength, strength, step, threads }) {
+    async extractWatermarkKey({ videoPath, keys, fragLength, strength, step, threads, detectionMode, sampleFrames, marginThreshold, markEvery, markPerFragment, windows }) {
         try {
-            const result = await this.executePythonScript('extract-key', {
+            const result = await this.runJob('extract-key', {
                 video_path: videoPath,
                 keys: keys,
                 frag_length: fragLength || 1,
                 strength: strength || 1.0,
                 step: step || 5.0,
-                threads: threads || 8
+                threads: threads || null,
+                detection_mode: detectionMode || 'full',
+                sample_frames: sampleFrames || 6,
+                margin_threshold: marginThreshold || 0.05,
+                mark_every: markEvery || null,
+                mark_per_fragment: markPerFragment || null,
+                windows: windows && windows.length ? windows : null
             });
 
             return result;
@@ -247,39 +454,216 @@ class ProcessManager {
         }
     }
 
-    // Image-based watermarking removed - System now uses key-based only for better performance and reliability
+    /**
+     * Score many candidate key sets against one video in a single decode pass
+     * @param {object} options - Options (candidates: [{ id, keys, sequence, fragLength }])
+     * @param {object} mainWindow - Electron main window for progress updates
+     */
+    async extractWatermarkKeyMulti({ videoPath, candidates, fragLength, minMatchRatio, strength, step, threads, markEvery, markPerFragment }, mainWindow = null) {
+        // Candidate lists can be thousands of records long, so pass them via a file
+        const candidatesFile = path.join(os.tmpdir(), `mghosting_candidates_${Date.now()}.json`);
+        try {
+            await fs.writeFile(candidatesFile, JSON.stringify(candidates.map(c => ({
+                id: c.id,
+                keys: c.keys,
+                sequence: c.sequence,
+                frag_length: c.fragLength || fragLength || 2
+            }))), 'utf8');
+
+            const result = await this.runJob('extract-key-multi', {
+                video_path: videoPath,
+                candidates_file: candidatesFile,
+                frag_length: fragLength || 2,
+                min_match_ratio: minMatchRatio || 1.0,
+                strength: strength || 1.0,
+                step: step || 5.0,
+                threads: threads || null,
+                mark_every: markEvery || null,
+                mark_per_fragment: markPerFragment || null
+            }, mainWindow);
+
+            return result;
+        } catch (error) {
+            console.error('Extract multi-candidate watermark error:', error);
+            return {
+                success: false,
+                error: error.message
+            };
+        } finally {
+            await fs.unlink(candidatesFile).catch(() => {});
+        }
+    }
 
     /**
-     * Check if Python and required packages are installed
+     * Read one key set out of many videos across the worker pool (extract-batch)
+     * Each file's result arrives as a status "file" progress event as soon as it is done
+     * @param {object} options - Options (files: paths or [{ id, path }], directory: folder to sweep)
+     * @param {object} mainWindow - Electron main window for progress updates
      */
-    async checkPythonEnvironment() {
-        return new Promise((resolve) => {
-            const pythonProcess = spawn(this.pythonPath, ['-c', 'import blind_video_watermark; import cv2; print("OK")']);
+    async extractWatermarkBatch({ files, directory, recursive, keys, sequence, fragLength, minMatchRatio, strength, step, threads, markEvery, markPerFragment }, mainWindow = null) {
+        // Folder sweeps can list thousands of files, so pass them via a file
+        const filesFile = path.join(os.tmpdir(), `mghosting_files_${Date.now()}.json`);
+        try {
+            await fs.writeFile(filesFile, JSON.stringify((files || []).map(f => (
+                typeof f === 'string' ? f : { id: f.id, path: f.path }
+            ))), 'utf8');
 
-            let output = '';
+            return await this.runJob('extract-batch', {
+                files_file: filesFile,
+                directory: directory || null,
+                recursive: !!recursive,
+                keys: keys,
+                sequence: sequence || null,
+                frag_length: fragLength || 2,
+                min_match_ratio: minMatchRatio || 1.0,
+                strength: strength || 1.0,
+                step: step || 5.0,
+                threads: threads || null,
+                mark_every: markEvery || null,
+                mark_per_fragment: markPerFragment || null
+            }, mainWindow);
+        } catch (error) {
+            console.error('Extract batch watermark error:', error);
+            return {
+                success: false,
+                error: error.message
+            };
+        } finally {
+            await fs.unlink(filesFile).catch(() => {});
+        }
+    }
 
-            pythonProcess.stdout.on('data', (data) => {
-                output += data.toString();
-            });
+    /**
+     * Read the keys and their order out of a video without a candidate list
+     * @param {object} options - Options (fragLengths: fragment lengths in seconds to try)
+     * @param {object} mainWindow - Electron main window for progress updates
+     */
+    async identifyWatermarkKey({ videoPath, fragLengths, strength, step, threads, markEvery, markPerFragment }, mainWindow = null) {
+        try {
+            return await this.runJob('identify-key', {
+                video_path: videoPath,
+                frag_length: fragLengths && fragLengths.length ? fragLengths : 2,
+                strength: strength || 1.0,
+                step: step || 5.0,
+                threads: threads || null,
+                mark_every: markEvery || null,
+                mark_per_fragment: markPerFragment || null
+            }, mainWindow);
+        } catch (error) {
+            console.error('Identify watermark key error:', error);
+            return {
+                success: false,
+                error: error.message
+            };
+        }
+    }
 
-            pythonProcess.on('close', (code) => {
-                if (code === 0 && output.includes('OK')) {
-                    resolve({ success: true, message: 'Python environment is ready' });
-                } else {
-                    resolve({ 
-                        success: false, 
-                        message: 'Python environment check failed. Please install required packages: pip install -r python/requirements.txt' 
-                    });
-                }
-            });
+    /**
+     * Run a job manifest and/or watch a folder under one CPU budget (batch-run)
+     * Runs as its own process, since each job is a child process of the scheduler
+     * @param {object} options - Options (jobs: [{ id, command, args, priority }], template: { command, args })
+     * @param {object} mainWindow - Electron main window for progress updates
+     */
+    async runWatermarkBatch({ manifestPath, jobs, watchDir, template, outputDir, cpuBudget, maxJobs, controlDir, reportPath, idleExitS }, mainWindow = null) {
+        try {
+            return await this.executePythonScript('batch-run', {
+                manifest: manifestPath || null,
+                jobs: jobs || [],
+                watch_dir: watchDir || null,
+                template: template || null,
+                output_dir: outputDir || null,
+                cpu_budget: cpuBudget || null,
+                max_jobs: maxJobs || null,
+                control_dir: controlDir || null,
+                report_path: reportPath || null,
+                idle_exit_s: idleExitS === undefined ? null : idleExitS
+            }, mainWindow);
+        } catch (error) {
+            console.error('Batch run error:', error);
+            return {
+                success: false,
+                error: error.message
+            };
+        }
+    }
 
-            pythonProcess.on('error', () => {
-                resolve({ 
-                    success: false, 
-                    message: 'Python not found. Please install Python 3.8 or higher' 
-                });
-            });
-        });
+    /**
+     * Cancel one job of a running batch, or the whole batch when jobId is omitted
+     * @param {string} controlDir - The batch's control directory (default: watch/manifest folder)
+     */
+    async cancelBatchJob(controlDir, jobId = null) {
+        await fs.writeFile(path.join(controlDir, `${jobId || 'batch'}.cancel`), '', 'utf8');
+    }
+
+    /**
+     * Measure the fastest worker, batch and process settings of this machine
+     * Later jobs that leave threads unset use them automatically
+     * @param {object} options - Options (resolutions: e.g. ['720p', '1080p'], seconds: clip length)
+     * @param {object} mainWindow - Electron main window for progress updates
+     */
+    async calibrate({ resolutions, threadGrid, batchSizes, seconds } = {}, mainWindow = null) {
+        try {
+            // Trials spawn their own processes, so the persistent worker is not needed
+            return await this.executePythonScript('calibrate', {
+                resolutions: resolutions || null,
+                thread_grid: threadGrid || null,
+                batch_sizes: batchSizes || null,
+                seconds: seconds || 2
+            }, mainWindow);
+        } catch (error) {
+            console.error('Calibration error:', error);
+            return {
+                success: false,
+                error: error.message
+            };
+        }
+    }
+
+    // Image-based watermarking removed - System now uses key-based only for better performance and reliability
+
+    /**
+     * Probe video metadata (codec, size, fps, frame count, duration, audio)
+     * Runs in its own light process (no engine import), so file validation
+     * never waits behind a long job on the persistent worker
+     */
+    async probeVideo(videoPath) {
+        try {
+            return await this.executePythonScript('probe', { video_path: videoPath });
+        } catch (error) {
+            console.error('Video probe error:', error);
+            return {
+                success: false,
+                error: error.message
+            };
+        }
+    }
+
+    /**
+     * Check if Python and required packages are installed
+     */
+    async checkPythonEnvironment() {
+        try {
+            // `health` locates the packages without importing numpy/OpenCV, so this is fast
+            const result = await this.executePythonScript('health', {});
+            if (result.success) {
+                return { success: true, message: 'Python environment is ready', ffmpeg: result.ffmpeg };
+            }
+            return {
+                success: false,
+                message: `Python environment check failed (missing: ${result.missing.join(', ')}). Please install required packages: pip install -r python/requirements.txt`
+            };
+        } catch (error) {
+            if (error.message.startsWith('Failed to start Python process')) {
+                return {
+                    success: false,
+                    message: 'Python not found. Please install Python 3.8 or higher'
+                };
+            }
+            return {
+                success: false,
+                message: 'Python environment check failed. Please install required packages: pip install -r python/requirements.txt'
+            };
+        }
     }
 }
 
@@ -69,6 +69,11 @@ app.on('window-all-closed', () => {
     }
 });
 
+// Stop the persistent Python worker
+app.on('will-quit', () => {
+    processManager.stopWorker();
+});
+
 // ===== HELPER FUNCTIONS =====
 
 /**
@@ -191,7 +196,7 @@ ipcMain.handle('embed-watermark-key', async (event, data) => {
             fragLength: fragLength || 2,
             strength: strength || 1.0,
             step: step || 5.0,
-            threads: threads || 8
+            threads: threads || null
         }, mainWindow);
 
         if (result.success) {
@@ -299,66 +304,99 @@ ipcMain.handle('extract-watermark-key', async (event, data) => {
             };
         }
 
-        console.log(`Found ${keyRecords.length} records to try...`);
-
-        // Try each record
-        for (let i = 0; i < keyRecords.length; i++) {
-            const record = keyRecords[i];
-            console.log(`\n[${i + 1}/${keyRecords.length}] Testing:`);
+        const matchResponse = (record, match) => {
+            console.log('\n✅ MATCH FOUND!');
             console.log(`  Unique Key: ${record.key}`);
-            console.log(`  Keys: [${record.keys.join(', ')}]`);
-            console.log(`  Sequence: ${record.sequence}`);
             console.log(`  User: ${record.userName}`);
+            console.log(`  Detected Sequence: ${match.sequence}`);
+            console.log(`  Expected Sequence: ${record.sequence}`);
 
-            try {
-                const result = await processManager.extractWatermarkKey({
-                    videoPath,
-                    keys: record.keys,
-                    fragLength: record.fragLength || 2,
-                    outputFolder: outputFolder || path.join(__dirname, 'output', `extract_${Date.now()}`)
-                });
+            // Verify keys regeneration
+            const regenerated = generateKeysFromUniqueKey(record.key);
+            const isValidated = 
+                JSON.stringify(regenerated.keys) === JSON.stringify(record.keys) &&
+                regenerated.sequence === record.sequence;
 
-                // Check if extraction was successful
-                if (result.success && result.detected_sequence && !result.detected_sequence.includes('#')) {
-                    console.log('\n✅ MATCH FOUND!');
-                    console.log(`  Detected Sequence: ${result.detected_sequence}`);
-                    console.log(`  Expected Sequence: ${record.sequence}`);
-
-                    // Verify keys regeneration
-                    const regenerated = generateKeysFromUniqueKey(record.key);
-                    const isValidated = 
-                        JSON.stringify(regenerated.keys) === JSON.stringify(record.keys) &&
-                        regenerated.sequence === record.sequence;
-
-                    console.log(`  Validation: ${isValidated ? '✅ PASSED' : '⚠️ WARNING'}`);
-
-                    const duration = ((Date.now() - startTime) / 1000).toFixed(2);
-                    console.log(`  ⏱️ Toplam Süre: ${duration} saniye`);
-
-                    return {
-                        success: true,
-                        uniqueKey: record.key,
-                        keys: record.keys,
-                        sequence: result.detected_sequence,
-                        userInfo: {
-                            userName: record.userName,
-                            userEmail: record.userEmail,
-                            videoPath: record.videoPath,
-                            createdAt: record.createdAt,
-                            keyGeneratedAt: record.keyGeneratedAt
-                        },
-                        validated: isValidated,
-                        outputFolder: result.output_folder,
-                        duration: duration,
-                        message: `Video ${record.userName} kullanıcısına aittir!`
-                    };
-                }
+            console.log(`  Validation: ${isValidated ? '✅ PASSED' : '⚠️ WARNING'}`);
 
-                console.log('  ❌ No match');
+            const duration = ((Date.now() - startTime) / 1000).toFixed(2);
+            console.log(`  ⏱️ Toplam Süre: ${duration} saniye`);
+
+            return {
+                success: true,
+                uniqueKey: record.key,
+                keys: record.keys,
+                sequence: match.sequence,
+                userInfo: {
+                    userName: record.userName,
+                    userEmail: record.userEmail,
+                    videoPath: record.videoPath,
+                    createdAt: record.createdAt,
+                    keyGeneratedAt: record.keyGeneratedAt
+                },
+                validated: isValidated,
+                matchRatio: match.matchRatio,
+                score: match.score,
+                duration: duration,
+                message: `Video ${record.userName} kullanıcısına aittir!`
+            };
+        };
 
-            } catch (extractError) {
-                console.log(`  ❌ Extraction failed: ${extractError.message}`);
+        // Blind identification: one decode scored against every possible key,
+        // then an index lookup, however many records there are
+        const fragLengths = [...new Set(keyRecords.map(r => r.fragLength || 2))];
+        let candidateRecords = keyRecords;
+        const identified = await processManager.identifyWatermarkKey({ videoPath, fragLengths }, mainWindow);
+
+        if (identified.success && identified.identified) {
+            const owners = await keyStorage.findByKeySequence(identified.keys, identified.sequence);
+            console.log(`Identified keys ${identified.index_key} (match=${(identified.match_ratio * 100).toFixed(0)}%, score=${identified.score.toFixed(3)}), ${owners.length} record(s)`);
+
+            if (owners.length === 1) {
+                const record = owners[0];
+                return matchResponse(record, {
+                    sequence: identified.detected_keys
+                        .map(k => (k === null ? '#' : String(record.keys.indexOf(k))))
+                        .join(''),
+                    matchRatio: identified.match_ratio,
+                    score: identified.score
+                });
+            }
+            if (owners.length > 1) {
+                // Same keys in the same order: let the candidate scoring decide
+                candidateRecords = owners;
             }
+        } else if (!identified.success) {
+            console.log(`Identification failed: ${identified.error}`);
+        }
+
+        console.log(`Identification inconclusive, scoring ${candidateRecords.length} records in a single pass...`);
+
+        const result = await processManager.extractWatermarkKeyMulti({
+            videoPath,
+            candidates: candidateRecords.map(r => ({
+                id: r.id,
+                keys: r.keys,
+                sequence: r.sequence,
+                fragLength: r.fragLength || 2
+            }))
+        }, mainWindow);
+
+        if (!result.success) {
+            throw new Error(result.error || 'Multi-candidate extraction failed');
+        }
+
+        for (const candidate of result.ranked || []) {
+            console.log(`  ${candidate.matched ? '✅' : '❌'} Record ${candidate.id}: detected=${candidate.detected_sequence}, match=${(candidate.match_ratio * 100).toFixed(0)}%, score=${candidate.score.toFixed(3)}`);
+        }
+
+        if (result.matched && result.best) {
+            const record = candidateRecords.find(r => r.id === result.best.id);
+            return matchResponse(record, {
+                sequence: result.best.detected_sequence,
+                matchRatio: result.best.match_ratio,
+                score: result.best.score
+            });
         }
 
         // No match found
@@ -381,7 +419,7 @@ ipcMain.handle('extract-watermark-key', async (event, data) => {
 ipcMain.handle('extract-watermark-manual', async (event, data) => {
     const startTime = Date.now();
     try {
-        const { videoPath, key, outputFolder } = data;
+        const { videoPath, key, outputFolder, detectionMode, sampleFrames } = data;
 
         console.log('\n=== MANUAL EXTRACTION START ===');
         console.log('Video:', videoPath);
@@ -396,6 +434,8 @@ ipcMain.handle('extract-watermark-manual', async (event, data) => {
             videoPath,
             keys: generated.keys,
             fragLength: 2,
+            detectionMode,
+            sampleFrames,
             outputFolder: outputFolder || path.join(__dirname, 'output', `extract_${Date.now()}`)
         });
 
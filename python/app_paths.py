@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Application Paths
+Per-user locations shared by the pattern and coefficient caches
+
+Kept free of numpy and the watermark library so cache maintenance commands
+can resolve their directory without loading either.
+"""
+
+import os
+import sys
+
+
+def default_cache_dir():
+    """
+    Resolve the application cache directory
+
+    MGHOSTING_CACHE_DIR (set by the Electron app to its userData folder) wins,
+    otherwise the platform's per-user cache location is used.
+    """
+    env_dir = os.environ.get('MGHOSTING_CACHE_DIR')
+    if env_dir:
+        return env_dir
+
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.environ.get('APPDATA') or os.path.expanduser('~')
+        return os.path.join(base, 'MGhosting Video Watermark', 'cache')
+
+    if sys.platform == 'darwin':
+        return os.path.join(os.path.expanduser('~'), 'Library', 'Caches', 'MGhosting Video Watermark')
+
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'mghosting-video-watermark')
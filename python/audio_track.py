@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Audio Prefetch
+Probe and demux a source's audio track while its frames are being embedded
+
+Outputs that are not encoded by an FFmpeg process reading the source (the
+OpenCV path and the chunked segments) used to get their audio only after the
+last frame: probe the source, then remux it with the finished video. The
+probe and the demux do not depend on the frames, so AudioPrefetch runs them
+on a background thread as soon as the job starts. The first audio stream is
+copied, without re-encoding, into a small Matroska file next to the output
+(Matroska takes any codec an MP4 can carry). Muxing then reads that file
+instead of the whole source, and the main thread only waits for the thread
+if the demux is still running when the frames are done.
+
+Both steps are recorded as 'background' spans of the job profiler, so the
+profile timeline shows them next to (and overlapping) the embed phase.
+"""
+
+import os
+import subprocess
+import tempfile
+import threading
+
+from profiling import NULL_PROFILER
+
+
+DEMUX_TIMEOUT = 300
+
+
+class AudioPrefetch:
+    """Background probe and stream-copy demux of a source's first audio stream"""
+
+    def __init__(self, ffmpeg_path, video_path, directory, probe, profiler=NULL_PROFILER):
+        """
+        Initialize prefetch
+
+        Args:
+            ffmpeg_path (str): FFmpeg executable
+            video_path (str): Source video
+            directory (str): Directory for the demuxed audio file (next to the output)
+            probe (callable): probe(video_path) -> audio info dict, or None without audio
+            profiler: Job profiler the background spans are recorded in
+        """
+        self.ffmpeg_path = ffmpeg_path
+        self.video_path = video_path
+        self.directory = directory
+        self.probe = probe
+        self.profiler = profiler
+        self.audio_info = None
+        self.path = None
+        self.error = None
+        self._thread = None
+
+    def start(self):
+        """Start probing and demuxing on a daemon thread; returns self"""
+        self._thread = threading.Thread(target=self._run, name='audio-prefetch', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        path = None
+        try:
+            with self.profiler.span('audio_probe', where='background'):
+                self.audio_info = self.probe(self.video_path)
+            if not self.audio_info:
+                return
+            with self.profiler.span('audio_demux', where='background'):
+                fd, path = tempfile.mkstemp(prefix='mghosting_audio_', suffix='.mka', dir=self.directory)
+                os.close(fd)
+                # stderr goes to a file rather than a pipe: a worker pool forked
+                # meanwhile would inherit the pipe and keep it from reaching EOF
+                with tempfile.TemporaryFile() as stderr:
+                    result = subprocess.run([
+                        self.ffmpeg_path,
+                        '-v', 'error',
+                        '-i', self.video_path,
+                        '-map', '0:a:0',
+                        '-vn', '-sn', '-dn',
+                        '-c:a', 'copy',
+                        '-y',
+                        path
+                    ], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr,
+                        timeout=DEMUX_TIMEOUT)
+                    stderr.seek(0)
+                    message = stderr.read().decode('utf-8', errors='replace')
+            if result.returncode == 0 and os.path.getsize(path) > 0:
+                self.path = path
+            else:
+                self.error = message[-300:] or f"FFmpeg exited with code {result.returncode}"
+                _remove(path)
+        except Exception as e:
+            self.error = str(e)
+            if path:
+                _remove(path)
+
+    def result(self, timeout=None):
+        """
+        Wait for the background work
+
+        Returns:
+            str: Path of the demuxed audio, or None if the source has no audio
+                or demuxing failed (see `error`)
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.path
+
+    def cleanup(self):
+        """Wait for the thread and delete the demuxed file"""
+        self.result()
+        if self.path:
+            _remove(self.path)
+            self.path = None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
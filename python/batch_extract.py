@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Batch Extraction
+Detect one key set in many suspect files across the worker pool
+
+A folder sweep used to start one processor per file, one file after the
+other, each paying for its own startup, pattern loading and pool. The
+`extract-batch` command takes the whole list instead and gives every file
+to a pool worker of its own: a worker decodes its file sequentially (FFmpeg
+pipe, batched DTCWT) and correlates each frame with the key patterns, so
+files run side by side and the sweep scales with the worker count rather
+than with the parallelism inside one file.
+
+Files are probed on a few threads while the pool already works on the
+first ones. The normalized pattern bank (keys x pixels float32) is built
+in the main process when the first file of a frame size is dispatched and
+placed in shared memory; workers map it read-only instead of each
+rebuilding or unpickling a copy. Every file's
+reading is printed as one `status: "file"` JSON line as soon as it is
+done, in completion order, and the final result lists all of them in input
+order.
+
+Per-file detection follows extract-key's full mode: fragment sums, the best
+key wins above DETECTION_THRESHOLD, '#' otherwise; sparse marking arguments
+apply as in extract-key. With an expected `sequence` each file also gets a
+match ratio and a matched flag.
+"""
+
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import dtcwt_batch
+from dtcwt_batch import DEFAULT_BATCH_SIZE, iter_batches
+from frame_io import FFmpegFrameReader
+from frame_marking import FrameMarking, fragment_of, fragment_scales
+from batch_scheduler import VIDEO_EXTENSIONS
+from watermark_engine import DETECTION_THRESHOLD, PIXEL_FORMATS
+
+# Concurrent media probes (each mostly waits on an ffprobe process)
+PROBE_THREADS = 4
+
+
+# Shared pattern banks mapped by this worker: shm name -> (SharedMemory, array)
+_attached = {}
+_attached_run = None
+
+
+def _attach_bank(run, name, shape):
+    """Map a shared pattern bank, releasing the banks of earlier runs"""
+    global _attached_run
+    if run != _attached_run:
+        for shm, _ in _attached.values():
+            try:
+                shm.close()
+            except BufferError:
+                pass
+        _attached.clear()
+        _attached_run = run
+    if name not in _attached:
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = (shm, np.ndarray(shape, dtype=np.float32, buffer=shm.buf))
+    return _attached[name][1]
+
+
+def _read_sequence(frag_sums, seen, frag_frames, marking):
+    """Fragment readings as in extract-key's full mode: key index or '#' per fragment"""
+    seq = ""
+    for sums, scale in zip(frag_sums, fragment_scales(frag_frames, seen, marking)):
+        idx = int(np.argmax(sums))
+        seq += str(idx) if sums[idx] * scale > DETECTION_THRESHOLD else "#"
+    return seq
+
+
+def _match(detected, sequence):
+    """Share of fragments whose reading is the expected sequence position's key"""
+    if not detected:
+        return 0.0
+    hits = sum(1 for i, c in enumerate(detected) if c == sequence[i % len(sequence)])
+    return hits / len(detected)
+
+
+def _extract_file_job(job):
+    """
+    Pool worker: read the key sequence of one file
+
+    Returns:
+        dict: Per-file result (index, path, id, success, detected_sequence,
+            frames_decoded, wall_s, and match fields or error)
+    """
+    start = time.perf_counter()
+    result = {"index": job['index'], "path": job['path'], "id": job['id']}
+    try:
+        bank = _attach_bank(job['run'], job['bank'], job['shape'])
+        # Fragments on the embedding grid (fractional at NTSC rates)
+        frag_frames = job['frag_length'] * job['fps']
+        marking = FrameMarking.from_args(frag_frames, job['mark_every'], job['mark_per_fragment'])
+        yuv420 = job['pixel_format'] == 'yuv420'
+        reader = FFmpegFrameReader(job['ffmpeg_path'], job['path'], job['width'], job['height'],
+                                   pix_fmt=PIXEL_FORMATS[job['pixel_format']])
+        indexed = enumerate(reader)
+        if marking is not None:
+            indexed = ((count, frame) for count, frame in indexed if marking.marked(count))
+
+        frag_sums, seen = [], []
+        frames_decoded = 0
+        with reader:
+            for batch in iter_batches(indexed, job['batch_size']):
+                frames = [frame for _, frame in batch]
+                if yuv420:
+                    wms = dtcwt_batch.decode_batch_yuv420(frames, job['alpha'], job['step'])
+                else:
+                    wms = dtcwt_batch.decode_batch(frames, job['alpha'], job['step'])
+                for (count, _), wm in zip(batch, wms):
+                    wm = wm.astype(np.float32).ravel()
+                    nwm = (wm - wm.mean()) / (wm.std() + 1e-10)
+                    idx = fragment_of(count, frag_frames)
+                    while len(frag_sums) <= idx:
+                        frag_sums.append(np.zeros(bank.shape[0], dtype=np.float32))
+                        seen.append(0)
+                    frag_sums[idx] += bank @ nwm / nwm.size
+                    seen[idx] += 1
+                frames_decoded += len(batch)
+
+        detected = _read_sequence(frag_sums, seen, frag_frames, marking)
+        result.update(success=True, detected_sequence=detected, frames_decoded=frames_decoded)
+        if job['sequence']:
+            ratio = _match(detected, job['sequence'])
+            result.update(match_ratio=ratio, matched=bool(detected) and ratio >= job['min_match_ratio'])
+    except Exception as e:
+        result.update(success=False, error=str(e))
+    result['wall_s'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def collect_files(args):
+    """
+    Files of an extract-batch request
+
+    Taken from `files` (paths or {"path", "id"} dicts), a JSON list in
+    `files_file`, and the video files in `directory` (with `recursive`).
+
+    Returns:
+        list: (path, id) tuples in request order
+    """
+    entries = list(args.get('files') or [])
+    if args.get('files_file'):
+        with open(args['files_file'], 'r', encoding='utf-8') as f:
+            entries += json.load(f)
+    directory = args.get('directory')
+    if directory:
+        if args.get('recursive'):
+            found = [os.path.join(root, name) for root, _, names in os.walk(directory) for name in names]
+        else:
+            found = [os.path.join(directory, name) for name in os.listdir(directory)]
+        entries += sorted(p for p in found if p.lower().endswith(VIDEO_EXTENSIONS) and os.path.isfile(p))
+
+    files = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            files.append((entry['path'], entry.get('id')))
+        else:
+            files.append((entry, None))
+    return files
+
+
+def extract_batch(processor, args):
+    """
+    Run extract-batch on a WatermarkProcessor's pool
+
+    Args:
+        processor (WatermarkProcessor): Provides the pool, probe and pattern banks
+        args (dict): keys, files / files_file / directory, frag_length,
+            pixel_format, batch_size, sequence, min_match_ratio, mark_every,
+            mark_per_fragment
+
+    Returns:
+        dict: success, counts, wall time and the per-file results in input order
+    """
+    try:
+        return _extract_batch(processor, args)
+    except Exception as e:
+        return {
+            "success": False,
+            "error": str(e),
+            "traceback": traceback.format_exc()
+        }
+
+
+def _extract_batch(processor, args):
+    started = time.perf_counter()
+    keys = [int(k) for k in args.get('keys') or []]
+    if not keys:
+        raise ValueError("Keys list cannot be empty")
+    files = collect_files(args)
+    if not files:
+        raise ValueError("No files to extract from")
+    pixel_format = args.get('pixel_format', 'bgr')
+    if pixel_format not in PIXEL_FORMATS:
+        raise ValueError(f"Unknown pixel_format: {pixel_format}")
+    sequence = args.get('sequence')
+    decoder = processor._get_decoder()
+    run = uuid.uuid4().hex
+
+    results = [None] * len(files)
+    done = 0
+
+    # Unreadable files are reported from the pool's task thread, results from this one
+    emit_lock = threading.Lock()
+
+    def emit(result):
+        nonlocal done
+        with emit_lock:
+            done += 1
+            results[result['index']] = result
+            if not result['success']:
+                summary = f"failed: {result['error']}"
+            elif sequence:
+                summary = f"{result['detected_sequence']} ({'match' if result['matched'] else 'no match'})"
+            else:
+                summary = result['detected_sequence']
+            print(json.dumps({
+                "status": "file",
+                "message": f"{os.path.basename(result['path'])}: {summary}",
+                "progress": int(100 * done / len(files)),
+                "file": result['path'],
+                "id": result['id'],
+                "result": result
+            }), flush=True)
+
+    frag_length = float(args.get('frag_length', 1))
+    batch_size = int(args.get('batch_size', DEFAULT_BATCH_SIZE))
+    banks = {}
+    dispatched = 0
+
+    def jobs(infos):
+        """Jobs in input order as their probes finish, with a bank made for each new frame size"""
+        nonlocal dispatched
+        for index, ((path, file_id), info) in enumerate(zip(files, infos)):
+            if 'height' not in info:
+                emit({"index": index, "path": path, "id": file_id, "success": False,
+                      "error": info.get('error') or "Cannot read video metadata", "wall_s": 0.0})
+                continue
+            size = (info['height'], info['width'])
+            if size not in banks:
+                patterns = processor._normalized_patterns(keys, processor._wm_shape(*size, pixel_format))
+                shm = shared_memory.SharedMemory(create=True, size=max(1, patterns.nbytes))
+                np.ndarray(patterns.shape, dtype=np.float32, buffer=shm.buf)[:] = patterns
+                banks[size] = (shm, patterns.shape)
+            shm, shape = banks[size]
+            dispatched += 1
+            yield {
+                "run": run,
+                "index": index,
+                "path": path,
+                "id": file_id,
+                "bank": shm.name,
+                "shape": shape,
+                "width": info['width'],
+                "height": info['height'],
+                "fps": info['fps'],
+                "frag_length": frag_length,
+                "pixel_format": pixel_format,
+                "batch_size": batch_size,
+                "alpha": decoder.alpha,
+                "step": decoder.step,
+                "ffmpeg_path": processor.ffmpeg_path,
+                "mark_every": args.get('mark_every'),
+                "mark_per_fragment": args.get('mark_per_fragment'),
+                "sequence": sequence,
+                "min_match_ratio": float(args.get('min_match_ratio', 1.0))
+            }
+
+    def probe(path):
+        return processor._get_video_info(path) if os.path.exists(path) else {"error": "File not found"}
+
+    # Banks are made after the pool starts; forked workers must share the
+    # tracker that sees them unlinked, or each starts its own and reports a leak
+    resource_tracker.ensure_running()
+    pool = processor._get_pool()
+    # Files are probed on threads while the pool already runs the first ones;
+    # the pool's task thread pulls jobs from the generator as it dispatches
+    prober = ThreadPoolExecutor(max_workers=min(len(files), PROBE_THREADS))
+    try:
+        for result in pool.imap_unordered(_extract_file_job, jobs(prober.map(probe, [p for p, _ in files]))):
+            emit(result)
+    finally:
+        prober.shutdown()
+        for shm, _ in banks.values():
+            shm.close()
+            shm.unlink()
+
+    print(json.dumps({
+        "status": "debug",
+        "message": f"Batch extraction: {dispatched} files on {processor.threads} workers, "
+                   f"{len(banks)} shared pattern banks "
+                   f"({sum(int(np.prod(shape)) * 4 for _, shape in banks.values()) / 2 ** 20:.1f} MB)"
+    }), flush=True)
+
+    succeeded = [r for r in results if r['success']]
+    wall = time.perf_counter() - started
+    summary = {
+        "success": True,
+        "command": "extract-batch",
+        "files": len(files),
+        "succeeded": len(succeeded),
+        "failed": len(files) - len(succeeded),
+        "wall_s": round(wall, 3),
+        "files_per_minute": round(60 * len(files) / wall, 2) if wall > 0 else None,
+        "frames_decoded": sum(r['frames_decoded'] for r in succeeded),
+        "results": results
+    }
+    if sequence:
+        summary['matched'] = sum(1 for r in succeeded if r['matched'])
+    return summary
@@ -0,0 +1,614 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Batch Scheduler
+Run many watermark jobs side by side under one CPU budget
+
+Jobs come from a manifest (a JSON list of {"id", "command", "args",
+"priority"}), from a watched directory (every new video file becomes a job
+built from a template), or both. Each job runs as its own
+`watermark_processor.py <command>` process, so a job can be cancelled by
+killing its process group (pool workers and FFmpeg included) without
+disturbing the others.
+
+Scheduling:
+    - The budget (default: all cores) is shared by the running jobs. A job
+      gets the budget divided by the number of jobs that can run at once,
+      capped per command (extractions are decode-bound and gain little from
+      more workers) and by the job's own `threads`, and never less than
+      MIN_JOB_THREADS. Embeds also get the same number of FFmpeg encoder
+      threads unless they ask for a count.
+    - Queued jobs start in priority order, then submission order. Extractions
+      and probes rank above embeds by default, so a short extraction does not
+      wait behind a queue of long embeds.
+    - A job is cancelled by creating `<job id>.cancel` in the control
+      directory (or with cancel()). `batch.cancel` cancels everything and
+      ends the run; `batch.stop` stops watching and lets the queue drain.
+
+Every job's progress events are printed tagged with its job_id, alongside
+`status: "batch"` events for queueing, starting and finishing jobs. When the
+run ends a throughput report (per job and overall: jobs per minute, frames and
+input MB per second, how much of the budget was in use) is written as JSON
+and printed as a metrics event.
+"""
+
+import heapq
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+
+DEFAULT_PRIORITIES = {
+    'probe': 30,
+    'extract-key': 20,
+    'identify-key': 20,
+    'extract-key-multi': 10,
+    'extract-batch': 10,
+    'embed-key': 0,
+    'embed-key-batch': 0
+}
+# Worker cap per command; others get DEFAULT_MAX_THREADS
+MAX_JOB_THREADS = {'probe': 1, 'extract-key': 4, 'identify-key': 4, 'extract-key-multi': 4}
+DEFAULT_MAX_THREADS = 8
+MIN_JOB_THREADS = 2
+EMBED_COMMANDS = ('embed-key', 'embed-key-batch')
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.mkv', '.avi', '.m4v', '.webm', '.mpg', '.mpeg', '.ts')
+POLL_INTERVAL = 0.5  # seconds between control, watch and process checks
+
+_print_lock = threading.Lock()
+
+
+def _emit(event):
+    with _print_lock:
+        print(json.dumps(event), flush=True)
+
+
+def _parse_result(text):
+    """Final result of a watermark_processor.py run (pretty-printed JSON after any events)"""
+    text = text.strip()
+    try:
+        # Nested objects are indented, so the last '{' at a line start opens the result
+        result = json.loads(text[text.rfind('\n{') + 1:])
+    except ValueError:
+        result = None
+    if not isinstance(result, dict):
+        return {"success": False, "error": f"No result in job output: {text[-300:]}"}
+    return result
+
+
+def _result_frames(result):
+    """Frames a finished job went through, from whichever count its command reports"""
+    for key in ('frames_decoded', 'frames_processed', 'total_frames'):
+        if isinstance(result.get(key), (int, float)):
+            return int(result[key])
+    info = result.get('video_info') or {}
+    return int(info['frame_count']) if isinstance(info.get('frame_count'), (int, float)) else 0
+
+
+class BatchJob:
+    """One command run by the scheduler"""
+
+    def __init__(self, job_id, command, args, priority, seq):
+        self.id = job_id
+        self.command = command
+        self.args = dict(args)
+        self.priority = priority
+        self.seq = seq
+        self.status = 'queued'
+        self.threads = None
+        self.result = None
+        self.queued_at = time.perf_counter()
+        self.started_at = None
+        self.finished_at = None
+        self.process = None
+        self._output = []
+        self._reader = None
+        try:
+            self.input_bytes = os.path.getsize(self.args['video_path'])
+        except (KeyError, TypeError, OSError):
+            self.input_bytes = 0
+
+    def __lt__(self, other):
+        return (-self.priority, self.seq) < (-other.priority, other.seq)
+
+    def record(self, started):
+        """Report row for this job (times relative to the run start)"""
+        run_s = (self.finished_at - self.started_at) if self.started_at and self.finished_at else None
+        frames = _result_frames(self.result) if self.result else 0
+        row = {
+            "id": self.id,
+            "command": self.command,
+            "status": self.status,
+            "priority": self.priority,
+            "threads": self.threads,
+            "wait_s": round((self.started_at or self.finished_at or self.queued_at) - self.queued_at, 3),
+            "start_s": round(self.started_at - started, 3) if self.started_at else None,
+            "run_s": round(run_s, 3) if run_s is not None else None,
+            "input_mb": round(self.input_bytes / 2 ** 20, 2),
+            "frames": frames,
+            "fps": round(frames / run_s, 2) if frames and run_s else None
+        }
+        if self.status == 'failed' and self.result:
+            row["error"] = str(self.result.get('error'))[:300]
+        return row
+
+
+class BatchScheduler:
+    """Priority queue of watermark jobs run as child processes under a CPU budget"""
+
+    def __init__(self, cpu_budget=None, max_jobs=None, control_dir=None, python=None, script=None, env=None):
+        """
+        Initialize scheduler
+
+        Args:
+            cpu_budget (int): Cores shared by all running jobs (default: all cores)
+            max_jobs (int): Jobs running at once (default: budget // MIN_JOB_THREADS)
+            control_dir (str): Directory polled for cancel/stop files (optional)
+            python (str): Python executable for the jobs (default: this one)
+            script (str): watermark_processor.py path (default: next to this module)
+            env (dict): Environment of the job processes (default: this process's)
+        """
+        self.cpu_budget = max(1, int(cpu_budget or os.cpu_count() or 1))
+        self.max_jobs = max(1, int(max_jobs or self.cpu_budget // MIN_JOB_THREADS or 1))
+        self.control_dir = control_dir
+        self.python = python or sys.executable
+        self.script = script or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'watermark_processor.py')
+        self.env = env
+        self.jobs = {}
+        self._queue = []
+        self._running = []
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._cancel_all = False
+        self.started = None
+        self.finished = None
+        self._busy_area = 0.0
+        self._busy_changed = None
+
+    # --- Queue ---
+
+    def submit(self, command, args, job_id=None, priority=None):
+        """
+        Queue a command
+
+        Args:
+            command (str): watermark_processor.py command (embed-key, extract-key, ...)
+            args (dict): Its arguments; `threads` caps the workers the job may get
+            job_id (str): Unique ID (default: job-<n>)
+            priority (int): Higher runs first (default: DEFAULT_PRIORITIES[command])
+
+        Returns:
+            BatchJob: The queued job
+        """
+        with self._lock:
+            self._seq += 1
+            job_id = str(job_id or f"job-{self._seq}")
+            if job_id in self.jobs:
+                raise ValueError(f"Duplicate job id: {job_id}")
+            if priority is None:
+                priority = DEFAULT_PRIORITIES.get(command, 0)
+            job = BatchJob(job_id, command, args, int(priority), self._seq)
+            self.jobs[job_id] = job
+            heapq.heappush(self._queue, job)
+        _emit({"status": "batch", "event": "queued", "job_id": job_id, "command": command,
+               "priority": job.priority, "queued": len(self._queue),
+               "message": f"Queued {job_id} ({command}, priority {job.priority})"})
+        return job
+
+    def cancel(self, job_id):
+        """
+        Cancel a queued or running job
+
+        Returns:
+            bool: False if the job is unknown or already finished
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status not in ('queued', 'running'):
+                return False
+            if job.status == 'queued':
+                self._queue.remove(job)
+                heapq.heapify(self._queue)
+                job.finished_at = time.perf_counter()
+            job.status = 'cancelled'
+        if job.process is not None:
+            _terminate(job.process)
+            # Half-written embed outputs are unusable
+            outputs = _embed_outputs(job.command, job.args)
+            if outputs:
+                job._reader.join()
+            for output in outputs:
+                try:
+                    os.remove(output)
+                except OSError:
+                    pass
+        _emit({"status": "batch", "event": "cancelled", "job_id": job_id,
+               "message": f"Cancelled {job_id}"})
+        return True
+
+    def cancel_all(self):
+        """Cancel every queued and running job and end the run"""
+        self._cancel_all = True
+        for job_id in [job.id for job in list(self._queue) + list(self._running)]:
+            self.cancel(job_id)
+
+    def pending(self):
+        """Jobs queued or running"""
+        return len(self._queue) + len(self._running)
+
+    # --- Running ---
+
+    def _threads_for(self, job, free, contenders):
+        """Workers for a job about to start, or None if it should wait for more free cores"""
+        cap = int(job.args.get('threads') or MAX_JOB_THREADS.get(job.command, DEFAULT_MAX_THREADS))
+        share = self.cpu_budget // max(1, min(contenders, self.max_jobs))
+        want = max(MIN_JOB_THREADS, min(cap, share))
+        want = min(want, cap, self.cpu_budget)
+        if free >= want:
+            return want
+        if free >= min(MIN_JOB_THREADS, cap):
+            return free
+        return None
+
+    def _account_busy(self):
+        now = time.perf_counter()
+        if self._busy_changed is not None:
+            self._busy_area += sum(job.threads for job in self._running) * (now - self._busy_changed)
+        self._busy_changed = now
+
+    def _dispatch(self):
+        """Start queued jobs while the budget and max_jobs allow"""
+        while True:
+            with self._lock:
+                if not self._queue or len(self._running) >= self.max_jobs:
+                    return
+                free = self.cpu_budget - sum(job.threads for job in self._running)
+                job = self._queue[0]
+                threads = self._threads_for(job, free, len(self._queue) + len(self._running))
+                if threads is None:
+                    return
+                heapq.heappop(self._queue)
+                self._account_busy()
+                job.threads = threads
+                job.status = 'running'
+                self._running.append(job)
+            self._start(job)
+
+    def _start(self, job):
+        args = dict(job.args, threads=job.threads)
+        if job.command in EMBED_COMMANDS:
+            args.setdefault('encoder_threads', job.threads)
+        cmd = [self.python, self.script, job.command, json.dumps(args)]
+        job.started_at = time.perf_counter()
+        _emit({"status": "batch", "event": "started", "job_id": job.id, "command": job.command,
+               "threads": job.threads, "running": len(self._running),
+               "message": f"Started {job.id} ({job.command}) with {job.threads} threads"})
+        try:
+            job.process = subprocess.Popen(
+                cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                env=self.env, **_group_kwargs()
+            )
+        except OSError as e:
+            job.result = {"success": False, "error": f"Could not start job: {str(e)}"}
+            job.finished_at = time.perf_counter()
+            job.status = 'failed'
+            return
+        job._reader = threading.Thread(target=self._read, args=(job,), name=f"batch-{job.id}", daemon=True)
+        job._reader.start()
+
+    def _read(self, job):
+        """Forward a job's progress events and keep the rest of its output for the result"""
+        for raw in job.process.stdout:
+            line = raw.decode('utf-8', errors='replace')
+            event = None
+            if line.startswith('{"'):
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    pass
+            if isinstance(event, dict) and 'status' in event and 'success' not in event:
+                _emit({**event, "job_id": job.id})
+            else:
+                job._output.append(line)
+        job.process.stdout.close()
+
+    def _reap(self):
+        """Collect jobs whose process has exited"""
+        for job in list(self._running):
+            if job.process is not None and job.process.poll() is None:
+                continue
+            if job._reader is not None:
+                job._reader.join()
+            with self._lock:
+                self._account_busy()
+                self._running.remove(job)
+                job.finished_at = job.finished_at or time.perf_counter()
+                if job.status == 'running':
+                    if job.result is None:
+                        job.result = _parse_result(''.join(job._output))
+                    job.status = 'done' if job.result.get('success') else 'failed'
+            if job.status == 'cancelled':
+                continue
+            _emit({"status": "batch", "event": "finished", "job_id": job.id, "command": job.command,
+                   "state": job.status, "run_s": round(job.finished_at - job.started_at, 3),
+                   "result": job.result,
+                   "message": f"{job.id} {job.status} in {job.finished_at - job.started_at:.1f}s"})
+
+    def _check_control(self):
+        """Apply cancel files from the control directory; returns 'stop', 'cancel' or None"""
+        if not self.control_dir or not os.path.isdir(self.control_dir):
+            return None
+        action = None
+        for name in os.listdir(self.control_dir):
+            if not name.endswith(('.cancel', '.stop')):
+                continue
+            path = os.path.join(self.control_dir, name)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            if name == 'batch.cancel':
+                action = 'cancel'
+            elif name == 'batch.stop':
+                action = action or 'stop'
+            elif name.endswith('.cancel'):
+                self.cancel(name[:-len('.cancel')])
+        return action
+
+    def run(self, watcher=None, idle_exit_s=None):
+        """
+        Run until the queue is empty (and, when watching, until stopped)
+
+        Args:
+            watcher (FolderWatcher): Source of new jobs (optional)
+            idle_exit_s (float): When watching, stop after this long with no
+                jobs queued or running (default: watch until batch.stop/cancel)
+
+        Returns:
+            dict: report()
+        """
+        self.started = time.perf_counter()
+        self._busy_changed = self.started
+        idle_since = self.started
+        try:
+            while not self._cancel_all:
+                action = self._check_control()
+                if action == 'cancel':
+                    self.cancel_all()
+                    break
+                if action == 'stop':
+                    watcher = None
+                if watcher is not None:
+                    watcher.poll(self)
+                self._reap()
+                self._dispatch()
+                now = time.perf_counter()
+                if self.pending():
+                    idle_since = now
+                elif watcher is None or (idle_exit_s is not None and now - idle_since >= idle_exit_s):
+                    break
+                time.sleep(POLL_INTERVAL)
+        except KeyboardInterrupt:
+            self.cancel_all()
+        self._reap()
+        self._account_busy()
+        self.finished = time.perf_counter()
+        return self.report()
+
+    # --- Report ---
+
+    def report(self):
+        """Throughput report of the run"""
+        end = self.finished or time.perf_counter()
+        started = self.started or end
+        wall = max(end - started, 1e-9)
+        jobs = sorted(self.jobs.values(), key=lambda job: job.seq)
+        rows = [job.record(started) for job in jobs]
+        done = [row for row in rows if row['status'] == 'done']
+        counts = {state: sum(1 for row in rows if row['status'] == state)
+                  for state in ('done', 'failed', 'cancelled', 'queued', 'running')}
+        frames = sum(row['frames'] for row in done)
+        input_mb = sum(row['input_mb'] for row in done)
+        by_command = {}
+        for row in done:
+            entry = by_command.setdefault(row['command'], {"jobs": 0, "run_s": 0.0, "frames": 0})
+            entry['jobs'] += 1
+            entry['run_s'] += row['run_s'] or 0.0
+            entry['frames'] += row['frames']
+        for entry in by_command.values():
+            entry['mean_run_s'] = round(entry.pop('run_s') / entry['jobs'], 3)
+        return {
+            "success": counts['failed'] == 0,
+            "cpu_budget": self.cpu_budget,
+            "max_jobs": self.max_jobs,
+            "wall_s": round(wall, 3),
+            "jobs_total": len(rows),
+            **{f"jobs_{state}": count for state, count in counts.items()},
+            "jobs_per_min": round(len(done) * 60 / wall, 2),
+            "frames_per_s": round(frames / wall, 2),
+            "input_mb_per_s": round(input_mb / wall, 2),
+            "budget_utilization": round(self._busy_area / (self.cpu_budget * wall), 3),
+            "mean_wait_s": round(sum(row['wait_s'] for row in done) / len(done), 3) if done else None,
+            "by_command": by_command,
+            "jobs": rows
+        }
+
+
+class FolderWatcher:
+    """Turns video files appearing in a directory into jobs built from a template"""
+
+    def __init__(self, directory, template, output_dir=None, extensions=VIDEO_EXTENSIONS):
+        """
+        Initialize watcher
+
+        Args:
+            directory (str): Directory to watch (not recursive)
+            template (dict): {"command", "args", "priority"}; string args may use
+                {input}, {name}, {stem} and {output_dir}. video_path defaults to {input}
+            output_dir (str): Where outputs go (default: <directory>/watermarked)
+            extensions (tuple): File name suffixes treated as videos
+        """
+        self.directory = directory
+        self.template = template
+        self.output_dir = output_dir or os.path.join(directory, 'watermarked')
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self._sizes = {}
+        self._seen = set()
+
+    def _job_args(self, path):
+        name = os.path.basename(path)
+        values = {"input": path, "name": name, "stem": os.path.splitext(name)[0], "output_dir": self.output_dir}
+        args = {key: value.format(**values) if isinstance(value, str) else value
+                for key, value in (self.template.get('args') or {}).items()}
+        args.setdefault('video_path', path)
+        return args
+
+    def poll(self, scheduler):
+        """Queue files whose size has not changed since the previous poll (copies that finished)"""
+        try:
+            names = sorted(os.listdir(self.directory))
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if path in self._seen or not name.lower().endswith(self.extensions) or not os.path.isfile(path):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            size = (st.st_size, st.st_mtime_ns)
+            if self._sizes.get(path) != size:
+                self._sizes[path] = size
+                continue
+            self._seen.add(path)
+            del self._sizes[path]
+            os.makedirs(self.output_dir, exist_ok=True)
+            job_id = os.path.splitext(name)[0]
+            while job_id in scheduler.jobs:
+                job_id += '_'
+            scheduler.submit(self.template.get('command', 'embed-key'), self._job_args(path),
+                             job_id=job_id, priority=self.template.get('priority'))
+
+
+def _embed_outputs(command, args):
+    """Output files an embed job writes (every recipient's, for embed-key-batch)"""
+    if command == 'embed-key':
+        return [args['output_path']] if args.get('output_path') else []
+    if command != 'embed-key-batch':
+        return []
+    targets = args.get('jobs') or []
+    if args.get('jobs_file'):
+        try:
+            with open(args['jobs_file'], 'r', encoding='utf-8') as f:
+                targets = json.load(f)
+        except (OSError, ValueError):
+            targets = []
+    return [target['output_path'] for target in targets
+            if isinstance(target, dict) and target.get('output_path')]
+
+
+def _group_kwargs():
+    """Popen arguments that put a job in its own process group"""
+    if os.name == 'nt':
+        return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {"start_new_session": True}
+
+
+def _terminate(process):
+    """Kill a job and everything it started (pool workers, FFmpeg)"""
+    if process.poll() is not None:
+        return
+    try:
+        if os.name == 'nt':
+            subprocess.run(['taskkill', '/T', '/F', '/PID', str(process.pid)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            os.killpg(process.pid, signal.SIGTERM)
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+    except (OSError, subprocess.SubprocessError):
+        process.kill()
+    process.wait()
+
+
+def format_report(report):
+    """Render a report as a fixed-width text table"""
+    lines = [
+        f"Batch: {report['jobs_done']}/{report['jobs_total']} jobs done in {report['wall_s']:.1f}s "
+        f"({report['jobs_per_min']:.2f} jobs/min, {report['frames_per_s']:.1f} frames/s, "
+        f"{report['input_mb_per_s']:.2f} MB/s, {report['budget_utilization'] * 100:.0f}% of {report['cpu_budget']} cores)",
+        f"{'job':<24} {'command':<18} {'state':<10} {'thr':>4} {'wait s':>8} {'run s':>8} {'fps':>7}"
+    ]
+    for row in report['jobs']:
+        run_s = f"{row['run_s']:.2f}" if row['run_s'] is not None else '-'
+        fps = f"{row['fps']:.1f}" if row['fps'] is not None else '-'
+        lines.append(f"{row['id'][:24]:<24} {row['command']:<18} {row['status']:<10} {row['threads'] or '-':>4} "
+                     f"{row['wait_s']:>8.2f} {run_s:>8} {fps:>7}")
+    return "\n".join(lines)
+
+
+def run_batch(args):
+    """
+    batch-run command: run a manifest and/or watch a directory, then write the report
+
+    Args:
+        args (dict): manifest (path to a job list, or {"jobs": [...], "defaults": {...}}),
+            jobs (inline job list), watch_dir + template (+ output_dir, idle_exit_s),
+            cpu_budget, max_jobs, control_dir, report_path
+
+    Returns:
+        dict: The report, with report_path
+    """
+    jobs = list(args.get('jobs') or [])
+    defaults = dict(args.get('defaults') or {})
+    manifest_path = args.get('manifest')
+    if manifest_path:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if isinstance(manifest, dict):
+            defaults = {**manifest.get('defaults', {}), **defaults}
+            manifest = manifest.get('jobs', [])
+        jobs = list(manifest) + jobs
+    watch_dir = args.get('watch_dir')
+    if not jobs and not watch_dir:
+        raise ValueError("batch-run needs a manifest, jobs or a watch_dir")
+    if watch_dir and not args.get('template'):
+        # Keys, sequence and output_path differ per deployment; there is no usable default
+        raise ValueError("watch_dir needs a template ({\"command\", \"args\"}) to build jobs from")
+
+    base_dir = watch_dir or (os.path.dirname(os.path.abspath(manifest_path)) if manifest_path else os.getcwd())
+    control_dir = args.get('control_dir') or base_dir
+    report_path = args.get('report_path') or os.path.join(base_dir, 'batch_report.json')
+
+    scheduler = BatchScheduler(cpu_budget=args.get('cpu_budget'), max_jobs=args.get('max_jobs'),
+                               control_dir=control_dir)
+    for job in jobs:
+        scheduler.submit(job['command'], {**defaults, **(job.get('args') or {})},
+                         job_id=job.get('id'), priority=job.get('priority'))
+    watcher = None
+    if watch_dir:
+        template = args['template']
+        template = {**template, "args": {**defaults, **(template.get('args') or {})}}
+        watcher = FolderWatcher(watch_dir, template, output_dir=args.get('output_dir'))
+
+    _emit({"status": "batch", "event": "run",
+           "message": f"Batch run: {len(jobs)} jobs" + (f", watching {watch_dir}" if watch_dir else "")
+                      + f", budget {scheduler.cpu_budget} cores, up to {scheduler.max_jobs} jobs at once; "
+                        f"cancel with <job id>.cancel or batch.cancel in {control_dir}"})
+    report = scheduler.run(watcher, idle_exit_s=args.get('idle_exit_s'))
+    report['report_path'] = report_path
+    try:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    except OSError as e:
+        report['report_error'] = str(e)
+    _emit({"status": "metrics", "phase": "summary", "message": format_report(report),
+           "metrics": {key: value for key, value in report.items() if key != 'jobs'}})
+    return report
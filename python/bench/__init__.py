@@ -0,0 +1,18 @@
+"""
+MGhosting Benchmark Suite
+Throughput benchmarks for the watermark processor on synthetic videos
+
+Run from the python/ directory:
+    python -m bench --preset quick                      # run and print a table
+    python -m bench --output results.json --baseline bench_baseline.json
+    python -m bench.transforms                          # DTCWT transforms only
+    python -m bench.startup                             # CLI startup latency
+"""
+
+from .synthetic import VideoSpec, PRESETS, generate_video, ensure_video
+from .runner import CASES, run_suite, compare_results
+
+__all__ = [
+    'VideoSpec', 'PRESETS', 'generate_video', 'ensure_video',
+    'CASES', 'run_suite', 'compare_results'
+]
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Benchmark - Command Line
+
+Usage (from the python/ directory):
+    python -m bench [--preset quick|standard|full] [--cases embed,extract,...]
+                    [--threads N] [--work-dir DIR] [--output results.json]
+                    [--baseline baseline.json] [--save-baseline baseline.json]
+                    [--tolerance 0.15]
+
+Exits with status 1 when a case regresses against the baseline.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from .synthetic import PRESETS
+from .runner import CASES, DEFAULT_TOLERANCE, run_suite, compare_results, load_json, save_json
+
+
+def _print_table(report, comparison=None):
+    rows = {(r['video'], r['case']): r for r in (comparison or {}).get('cases', [])}
+    print()
+    print(f"{'video':<24} {'case':<16} {'fps':>8} {'wall s':>8} {'rss MB':>8} {'size':>6} {'vs base':>8}  status")
+    for record in report['results']:
+        row = rows.get((record['video'], record['case']), {})
+        size = f"{record['size_ratio']:.2f}" if 'size_ratio' in record else ''
+        rss = f"{record['peak_rss_mb']:.0f}" if record.get('peak_rss_mb') is not None else '-'
+        ratio = f"{row['fps_ratio']:.2f}x" if 'fps_ratio' in row else ''
+        status = row.get('status', 'ok' if record['success'] else 'failed')
+        if record.get('correct') is False:
+            status += ' (not detected)'
+        if row.get('problems'):
+            status += f" ({', '.join(row['problems'])})"
+        print(f"{record['video']:<24} {record['case']:<16} {record['fps']:>8.2f} {record['wall_s']:>8.2f} "
+              f"{rss:>8} {size:>6} {ratio:>8}  {status}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Watermark processor throughput benchmarks")
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='quick')
+    parser.add_argument('--cases', default=','.join(CASES),
+                        help=f"Comma-separated subset of: {', '.join(CASES)}")
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'mghosting_bench'))
+    parser.add_argument('--output', help="Write the results JSON here")
+    parser.add_argument('--baseline', help="Compare against this results JSON")
+    parser.add_argument('--save-baseline', help="Store this run as the baseline")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    cases = [c.strip() for c in args.cases.split(',') if c.strip()]
+    unknown = [c for c in cases if c not in CASES]
+    if unknown:
+        parser.error(f"Unknown cases: {', '.join(unknown)}")
+
+    # Same FFmpeg lookup as the processor (PATH, then bundled locations)
+    from media_probe import find_ffmpeg
+    ffmpeg_path = find_ffmpeg()
+
+    report = run_suite(PRESETS[args.preset], cases, args.work_dir, threads=args.threads,
+                       ffmpeg_path=ffmpeg_path, log=lambda line: print(line, file=sys.stderr, flush=True))
+    report['preset'] = args.preset
+
+    comparison = None
+    if args.baseline:
+        if os.path.exists(args.baseline):
+            comparison = compare_results(report, load_json(args.baseline), args.tolerance)
+            report['comparison'] = comparison
+            if not comparison['same_host']:
+                print("Warning: baseline was recorded on a different host", file=sys.stderr)
+        else:
+            print(f"Warning: baseline not found: {args.baseline}", file=sys.stderr)
+
+    if args.output:
+        save_json(report, args.output)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.save_baseline:
+        save_json(report, args.save_baseline)
+
+    _print_table(report, comparison)
+    return 1 if comparison and comparison['regressions'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
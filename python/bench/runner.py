@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Benchmark - Runner
+Runs processor commands on synthetic videos and records their throughput
+
+Every case runs in a freshly spawned process so its peak RSS (and that of
+its pool workers and FFmpeg children) is measured in isolation. Cases call
+run_command() with the same arguments the CLI and the Electron app send.
+"""
+
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import time
+from datetime import datetime, timezone
+
+from profiling import peak_rss_mb
+
+from .synthetic import ensure_video
+
+
+BENCH_KEYS = [11, 12, 13, 14]
+BENCH_SEQUENCE = "0231"
+DEFAULT_TOLERANCE = 0.15
+
+# name -> (command, extra args, source video: None = clean input, else the embed case it reads)
+CASES = {
+    'embed': ('embed-key', {}, None),
+    'embed-chunks': ('embed-key', {'embed_mode': 'chunks'}, None),
+    'embed-resume': ('embed-key', {'resume': True}, None),
+    'embed-yuv420': ('embed-key', {'pixel_format': 'yuv420'}, None),
+    # Tiles only kick in once a frame's transform outgrows the budget share of a worker
+    'embed-tiled': ('embed-key', {'tile_memory_mb': 64}, None),
+    'embed-sparse': ('embed-key', {'mark_per_fragment': 4}, None),
+    'extract': ('extract-key', {}, 'embed'),
+    'extract-sampled': ('extract-key', {'detection_mode': 'sampled'}, 'embed'),
+    'extract-multi': ('extract-key-multi', {}, 'embed'),
+    'extract-yuv420': ('extract-key', {'pixel_format': 'yuv420'}, 'embed-yuv420'),
+    'extract-tiled': ('extract-key', {}, 'embed-tiled'),
+    'extract-sparse': ('extract-key', {'mark_per_fragment': 4}, 'embed-sparse'),
+}
+
+
+def _case_process(conn, command, args, threads, cache_dir):
+    """Spawned child: run one command with processor output silenced, send back timings"""
+    try:
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            from watermark_engine import WatermarkProcessor
+            from watermark_processor import run_command
+            processor = WatermarkProcessor(threads=threads, cache_dir=cache_dir)
+            start = time.perf_counter()
+            try:
+                result = run_command(processor, command, args)
+            finally:
+                processor.close()
+            wall = time.perf_counter() - start
+        peak, peak_child = peak_rss_mb()
+        conn.send({"result": result, "wall_s": wall, "peak_rss_mb": peak, "peak_child_rss_mb": peak_child})
+    except Exception as e:
+        conn.send({"result": {"success": False, "error": str(e)}, "wall_s": 0.0,
+                   "peak_rss_mb": None, "peak_child_rss_mb": None})
+    finally:
+        conn.close()
+
+
+def _run_isolated(command, args, threads, cache_dir):
+    ctx = multiprocessing.get_context('spawn')
+    parent, child = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_case_process, args=(child, command, args, threads, cache_dir))
+    process.start()
+    child.close()
+    try:
+        return parent.recv()
+    except EOFError:
+        return {"result": {"success": False, "error": f"Case process died (exit code {process.exitcode})"},
+                "wall_s": 0.0, "peak_rss_mb": None, "peak_child_rss_mb": None}
+    finally:
+        process.join()
+
+
+def _case_args(name, video_path, output_path, overrides=None):
+    command, extra, _ = CASES[name]
+    args = {"video_path": video_path}
+    if command == 'embed-key':
+        args.update(output_path=output_path, keys=BENCH_KEYS, sequence=BENCH_SEQUENCE)
+    elif command == 'extract-key':
+        args.update(keys=BENCH_KEYS)
+    elif command == 'extract-key-multi':
+        args.update(candidates=[
+            {"id": "match", "keys": BENCH_KEYS, "sequence": BENCH_SEQUENCE},
+            {"id": "other", "keys": [21, 22, 23, 24], "sequence": "0123"},
+        ])
+    args.update(extra)
+    args.update(overrides or {})
+    return command, args
+
+
+def _is_correct(command, result):
+    """Whether a detection result found the embedded data"""
+    if command == 'extract-key':
+        detected = result.get('detected_sequence')
+        if not isinstance(detected, str) or not detected or '#' in detected:
+            return False
+        expected = BENCH_SEQUENCE * (len(detected) // len(BENCH_SEQUENCE) + 1)
+        return expected.startswith(detected)
+    if command == 'extract-key-multi':
+        return bool(result.get('matched')) and result['best'].get('id') == 'match'
+    return None
+
+
+def run_case(name, spec, video_path, work_dir, threads, cache_dir, extra=None):
+    """
+    Run one benchmark case on one video
+
+    `extra` adds to (or overrides) the case's arguments, e.g. a batch size.
+
+    Returns:
+        dict: Result record (video, case, success, fps, wall time, peak RSS, ...)
+    """
+    output_path = os.path.join(work_dir, f"out_{spec.name}_{name}.mp4")
+    command, args = _case_args(name, video_path, output_path, extra)
+    run = _run_isolated(command, args, threads, cache_dir)
+    result = run['result']
+
+    record = {
+        "video": spec.name,
+        "case": name,
+        "command": command,
+        "args": {k: v for k, v in args.items() if k not in ('video_path', 'output_path', 'keys', 'candidates')},
+        "success": bool(result.get('success')),
+        "frames": spec.frame_count,
+        "wall_s": round(run['wall_s'], 3),
+        "fps": round(spec.frame_count / run['wall_s'], 3) if run['wall_s'] > 0 else 0.0,
+        "peak_rss_mb": round(run['peak_rss_mb'], 1) if run['peak_rss_mb'] is not None else None,
+        "peak_child_rss_mb": round(run['peak_child_rss_mb'], 1) if run['peak_child_rss_mb'] is not None else None,
+    }
+    if not record['success']:
+        record['error'] = result.get('error')
+    if command == 'embed-key' and record['success']:
+        record['output_path'] = output_path
+        record['size_ratio'] = round(os.path.getsize(output_path) / os.path.getsize(video_path), 4)
+    if command == 'extract-key' and 'frames_decoded' in result:
+        record['frames_decoded'] = result['frames_decoded']
+    if command == 'extract-key-multi' and record['success']:
+        match = next((c for c in result.get('ranked', []) if c.get('id') == 'match'), {})
+        record['match_ratio'] = match.get('match_ratio')
+        record['margin'] = match.get('score')
+    correct = _is_correct(command, result) if record['success'] else None
+    if correct is not None:
+        record['correct'] = correct
+    return record
+
+
+def host_info():
+    """Identify the machine a result file was produced on"""
+    return {
+        "hostname": platform.node(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count()
+    }
+
+
+def run_suite(specs, cases, work_dir, threads=None, cache_dir=None, ffmpeg_path='ffmpeg', log=print):
+    """
+    Render the videos and run every case on each of them
+
+    Extraction cases read the output of the embed case named in CASES; that
+    embed runs (and is recorded) first even if it was not requested.
+
+    Args:
+        specs (list): VideoSpec list
+        cases (list): Case names from CASES
+        work_dir (str): Directory for synthetic inputs and outputs
+        threads (int): Processor pool size (default: CPU count)
+        cache_dir (str): Pattern cache directory (default: <work_dir>/cache)
+        ffmpeg_path (str): FFmpeg executable for rendering inputs
+        log (callable): Progress line printer
+
+    Returns:
+        dict: {"host", "created", "threads", "videos", "results"}
+    """
+    threads = threads or os.cpu_count() or 1
+    cache_dir = cache_dir or os.path.join(work_dir, 'cache')
+    results = []
+
+    for spec in specs:
+        log(f"Rendering {spec.name} ({spec.frame_count} frames)...")
+        video_path = ensure_video(spec, work_dir, ffmpeg_path)
+
+        done = {}
+        order = []
+        for name in cases:
+            source = CASES[name][2]
+            if source and source not in order:
+                order.append(source)
+            if name not in order:
+                order.append(name)
+
+        for name in order:
+            source = CASES[name][2]
+            if source:
+                if not done.get(source, {}).get('success'):
+                    log(f"  {name}: skipped, {source} failed")
+                    continue
+                input_path = done[source]['output_path']
+            else:
+                input_path = video_path
+            record = run_case(name, spec, input_path, work_dir, threads, cache_dir)
+            done[name] = record
+            results.append(record)
+            status = f"{record['fps']:.2f} fps, {record['wall_s']:.2f}s" if record['success'] else f"FAILED: {record.get('error')}"
+            log(f"  {name}: {status}")
+
+    for record in results:
+        record.pop('output_path', None)
+
+    return {
+        "host": host_info(),
+        "created": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        "threads": threads,
+        "videos": [spec.to_dict() for spec in specs],
+        "results": results
+    }
+
+
+def compare_results(current, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare a run against a stored baseline
+
+    A case regresses when its fps drops by more than `tolerance`, its peak
+    RSS grows by more than `tolerance`, or it stops succeeding or detecting.
+
+    Returns:
+        dict: {"tolerance", "same_host", "cases": [...], "regressions": count}
+    """
+    base_index = {(r['video'], r['case']): r for r in baseline.get('results', [])}
+    rows = []
+    for record in current['results']:
+        base = base_index.get((record['video'], record['case']))
+        row = {"video": record['video'], "case": record['case'], "fps": record['fps']}
+        if base is None:
+            row['status'] = 'new'
+            rows.append(row)
+            continue
+
+        problems = []
+        if base.get('success') and not record['success']:
+            problems.append('failed')
+        if base.get('correct') and record.get('correct') is False:
+            problems.append('detection lost')
+        if record['success'] and base.get('fps'):
+            row['baseline_fps'] = base['fps']
+            row['fps_ratio'] = round(record['fps'] / base['fps'], 3)
+            if row['fps_ratio'] < 1 - tolerance:
+                problems.append('slower')
+        if record.get('peak_rss_mb') and base.get('peak_rss_mb'):
+            row['rss_ratio'] = round(record['peak_rss_mb'] / base['peak_rss_mb'], 3)
+            if row['rss_ratio'] > 1 + tolerance:
+                problems.append('more memory')
+
+        row['status'] = 'regression' if problems else 'ok'
+        if problems:
+            row['problems'] = problems
+        rows.append(row)
+
+    return {
+        "tolerance": tolerance,
+        "same_host": baseline.get('host', {}).get('hostname') == current['host']['hostname'],
+        "cases": rows,
+        "regressions": sum(1 for row in rows if row['status'] == 'regression')
+    }
+
+
+def load_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_json(data, path):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
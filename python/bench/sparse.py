@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Benchmark - Sparse Marking
+Embedding speed vs. detection after recompression, per frame marking
+
+Usage (from the python/ directory):
+    python -m bench.sparse [--size 1280x720] [--fps 25] [--seconds 4]
+                           [--every 2,4] [--per-fragment 1,3,6]
+                           [--crf 23,28,33] [--threads N] [--work-dir DIR]
+
+Every marking (all frames first, then each mark_every and mark_per_fragment
+value) embeds the same synthetic clip through the embed case of
+bench.runner. The output is re-encoded with FFmpeg's libx264 at every CRF,
+as a re-upload would, and each copy is scored by the extract-multi case
+with the same marking: whether the embedded candidate wins, the share of
+fragments read correctly and the mean correlation margin over the
+runner-up key. Prints one JSON line per measurement, then a summary table.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from frame_marking import FrameMarking
+from media_probe import find_ffmpeg
+
+from .runner import run_case
+from .synthetic import VideoSpec, ensure_video
+
+
+def recompress(ffmpeg_path, source, output, crf, preset='medium'):
+    """Re-encode the video stream with libx264 at `crf`, copying the audio"""
+    result = subprocess.run([
+        ffmpeg_path, '-v', 'error', '-i', source,
+        '-map', '0:v:0', '-map', '0:a:0?',
+        '-c:v', 'libx264', '-preset', preset, '-crf', str(crf), '-pix_fmt', 'yuv420p',
+        '-c:a', 'copy', '-y', output
+    ], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Recompression failed: {result.stderr[-300:]}")
+    return output
+
+
+def markings(every, per_fragment):
+    """(label, embed arguments) of every marking to measure, all frames first"""
+    yield 'all frames', {}
+    for k in every:
+        yield f"every {k}", {"mark_every": k}
+    for k in per_fragment:
+        yield f"{k} per fragment", {"mark_per_fragment": k}
+
+
+def bench_marking(label, marking_args, spec, video_path, crfs, work_dir, threads, cache_dir, ffmpeg_path):
+    """Embed with one marking, then detect it after each recompression"""
+    marking = FrameMarking.from_args(spec.fps, marking_args.get('mark_every'), marking_args.get('mark_per_fragment'))
+    marked = marking.count(0, spec.frame_count) if marking else spec.frame_count
+    embed = run_case('embed', spec, video_path, work_dir, threads, cache_dir, extra=marking_args)
+    results = [{"marking": label, "op": "embed", "success": embed['success'], "fps": embed['fps'],
+                "marked_share": marked / spec.frame_count, "error": embed.get('error')}]
+    if not embed['success']:
+        return results
+
+    for crf in crfs:
+        copy_path = os.path.join(work_dir, f"sparse_{spec.name}_crf{crf}.mp4")
+        recompress(ffmpeg_path, embed['output_path'], copy_path, crf)
+        detect = run_case('extract-multi', spec, copy_path, work_dir, threads, cache_dir, extra=marking_args)
+        results.append({"marking": label, "op": "detect", "crf": crf, "success": detect['success'],
+                        "fps": detect['fps'], "detected": bool(detect.get('correct')),
+                        "match_ratio": detect.get('match_ratio'), "margin": detect.get('margin'),
+                        "error": detect.get('error')})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--size', default='1280x720')
+    parser.add_argument('--fps', type=float, default=25)
+    parser.add_argument('--seconds', type=float, default=4)
+    parser.add_argument('--every', default='2,4')
+    parser.add_argument('--per-fragment', default='1,3,6')
+    parser.add_argument('--crf', default='23,28,33')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'mghosting_bench'))
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    spec = VideoSpec(width, height, args.fps, args.seconds)
+    every = [int(k) for k in args.every.split(',') if k.strip()]
+    per_fragment = [int(k) for k in args.per_fragment.split(',') if k.strip()]
+    crfs = [int(c) for c in args.crf.split(',') if c.strip()]
+    threads = args.threads or os.cpu_count() or 1
+    cache_dir = os.path.join(args.work_dir, 'cache')
+    ffmpeg_path = find_ffmpeg()
+
+    print(f"Rendering {spec.name} ({spec.frame_count} frames)...", file=sys.stderr, flush=True)
+    video_path = ensure_video(spec, args.work_dir, ffmpeg_path)
+    results = []
+    for label, marking_args in markings(every, per_fragment):
+        for result in bench_marking(label, marking_args, spec, video_path, crfs, args.work_dir,
+                                    threads, cache_dir, ffmpeg_path):
+            print(json.dumps(result), flush=True)
+            results.append(result)
+
+    baseline = next((r for r in results if r['op'] == 'embed' and r['marking'] == 'all frames'), None)
+    print()
+    print(f"{'marking':<16} {'marked':>7} {'embed fps':>10} {'speedup':>8} {'crf':>4} "
+          f"{'detect fps':>10} {'detected':>9} {'fragments':>9} {'margin':>8}")
+    for embed in (r for r in results if r['op'] == 'embed'):
+        speedup = embed['fps'] / baseline['fps'] if baseline and baseline['fps'] else 0.0
+        head = (f"{embed['marking']:<16} {embed['marked_share']:>6.0%} {embed['fps']:>10.2f} "
+                f"{speedup:>7.2f}x")
+        detects = [r for r in results if r['op'] == 'detect' and r['marking'] == embed['marking']]
+        if not detects:
+            print(f"{head}    -  embed failed: {embed['error']}")
+        for detect in detects:
+            ratio = f"{detect['match_ratio']:.0%}" if detect['match_ratio'] is not None else '-'
+            margin = f"{detect['margin']:.4f}" if detect['margin'] is not None else '-'
+            print(f"{head} {detect['crf']:>4} {detect['fps']:>10.2f} {'yes' if detect['detected'] else 'no':>9} "
+                  f"{ratio:>9} {margin:>8}")
+            head = ' ' * len(head)
+
+
+if __name__ == "__main__":
+    main()
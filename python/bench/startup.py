@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Benchmark - CLI Startup Latency
+
+Usage (from the python/ directory):
+    python -m bench.startup [--runs 10] [--video input.mp4] [--output startup.json]
+
+Spawns `python watermark_processor.py <command>` repeatedly and measures the
+time from process start to its first line of output (the first progress
+event, or the result for commands that print only that) and to exit. A bare
+interpreter (`python -c pass`) is measured the same way, so the overhead of
+the processor itself can be read off against it.
+
+Exits with status 1 when a non-media command's median first-output latency
+exceeds the target above the bare interpreter.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from .runner import host_info, save_json
+
+
+TARGET_MS = 100.0
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'watermark_processor.py')
+
+# name -> (argv after the script, media command?)
+COMMANDS = {
+    'health': (['health'], False),
+    'usage-error': ([], False),
+    'unknown-command': (['no-such-command'], False),
+    'coeff-cache-list': (['coeff-cache-list'], False),
+    'health-deep': (['health', '{"deep": true}'], True),
+}
+
+
+def _time_process(argv, cwd):
+    """Run one process; return (ms to first output line, ms to exit)"""
+    start = time.perf_counter()
+    process = subprocess.Popen(argv, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    first_line = process.stdout.readline()
+    first = time.perf_counter()
+    process.stdout.read()
+    process.wait()
+    end = time.perf_counter()
+    if not first_line:
+        first = end
+    return (first - start) * 1000, (end - start) * 1000
+
+
+def measure(name, argv, runs, cwd):
+    """Median and min latency of a command over `runs` runs (after one warm-up run)"""
+    _time_process(argv, cwd)  # warm the OS file cache
+    samples = [_time_process(argv, cwd) for _ in range(runs)]
+    firsts = [s[0] for s in samples]
+    exits = [s[1] for s in samples]
+    return {
+        "name": name,
+        "first_output_ms": round(statistics.median(firsts), 1),
+        "first_output_min_ms": round(min(firsts), 1),
+        "exit_ms": round(statistics.median(exits), 1),
+    }
+
+
+def run_startup(runs=10, video_path=None, cache_dir=None, log=print):
+    """
+    Measure the bare interpreter and every command in COMMANDS
+
+    Args:
+        runs (int): Timed runs per command
+        video_path (str): Also time `probe` on this video (a media command)
+        cache_dir (str): Cache directory for coeff-cache-list (default: a temp dir)
+        log (callable): Progress line printer
+
+    Returns:
+        dict: {"host", "python", "target_ms", "baseline", "commands": [...]}
+    """
+    cwd = os.path.dirname(SCRIPT)
+    cache_dir = cache_dir or tempfile.mkdtemp(prefix='mghosting_startup_')
+    commands = dict(COMMANDS)
+    commands['coeff-cache-list'] = (['coeff-cache-list', json.dumps({"cache_dir": cache_dir})], False)
+    if video_path:
+        commands['probe'] = (['probe', json.dumps({"video_path": os.path.abspath(video_path)})], True)
+
+    baseline = measure('python -c pass', [sys.executable, '-c', 'pass'], runs, cwd)
+    log(f"  interpreter: {baseline['first_output_ms']:.1f} ms")
+
+    rows = []
+    for name, (extra, media) in commands.items():
+        row = measure(name, [sys.executable, SCRIPT] + extra, runs, cwd)
+        row['media'] = media
+        row['overhead_ms'] = round(row['first_output_ms'] - baseline['exit_ms'], 1)
+        if not media:
+            row['within_target'] = row['overhead_ms'] <= TARGET_MS
+        rows.append(row)
+        log(f"  {name}: {row['first_output_ms']:.1f} ms")
+
+    return {
+        "host": host_info(),
+        "python": sys.executable,
+        "runs": runs,
+        "target_ms": TARGET_MS,
+        "baseline": baseline,
+        "commands": rows
+    }
+
+
+def _print_table(report):
+    print()
+    print(f"interpreter startup (python -c pass): {report['baseline']['exit_ms']:.1f} ms")
+    print(f"{'command':<18} {'first out ms':>12} {'min ms':>8} {'exit ms':>8} {'overhead':>9}  status")
+    for row in report['commands']:
+        if row['media']:
+            status = 'media'
+        else:
+            status = 'ok' if row['within_target'] else f"over {report['target_ms']:.0f} ms"
+        print(f"{row['name']:<18} {row['first_output_ms']:>12.1f} {row['first_output_min_ms']:>8.1f} "
+              f"{row['exit_ms']:>8.1f} {row['overhead_ms']:>9.1f}  {status}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Watermark processor CLI startup latency")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--video', help="Also time the probe command on this video")
+    parser.add_argument('--output', help="Write the results JSON here")
+    args = parser.parse_args()
+
+    report = run_startup(args.runs, args.video, log=lambda line: print(line, file=sys.stderr, flush=True))
+    if args.output:
+        save_json(report, args.output)
+    _print_table(report)
+    return 0 if all(row.get('within_target', True) for row in report['commands']) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
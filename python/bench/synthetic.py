@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Benchmark - Synthetic Videos
+Deterministic textured test videos with an audio track
+
+Frames are built from a seeded noise texture that scrolls diagonally, a
+drifting colour gradient and a moving block, so every frame has detail for
+the perceptual mask and consecutive frames differ like real footage. The
+audio is a two-tone sine in a WAV file, encoded to AAC while muxing.
+"""
+
+import math
+import os
+import wave
+
+import cv2
+import numpy as np
+
+from frame_io import FFmpegFrameWriter
+
+
+class VideoSpec:
+    """Size, frame rate and length of one synthetic test video"""
+
+    def __init__(self, width, height, fps, seconds):
+        self.width = int(width)
+        self.height = int(height)
+        self.fps = fps
+        self.seconds = seconds
+
+    @property
+    def name(self):
+        return f"{self.width}x{self.height}_{self.fps:g}fps_{self.seconds:g}s"
+
+    @property
+    def frame_count(self):
+        return int(round(self.fps * self.seconds))
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "width": self.width,
+            "height": self.height,
+            "fps": self.fps,
+            "seconds": self.seconds,
+            "frames": self.frame_count
+        }
+
+
+PRESETS = {
+    'quick': [
+        VideoSpec(320, 240, 25, 4),
+    ],
+    'standard': [
+        VideoSpec(1280, 720, 25, 4),
+        VideoSpec(1920, 1080, 30, 4),
+    ],
+    'full': [
+        VideoSpec(1280, 720, 25, 10),
+        VideoSpec(1920, 1080, 30, 10),
+        VideoSpec(1920, 1080, 60, 5),
+        VideoSpec(3840, 2160, 30, 3),
+    ],
+}
+
+
+def iter_frames(spec, seed=0):
+    """Yield the deterministic (height, width, 3) uint8 BGR frames of a spec"""
+    rng = np.random.RandomState(seed)
+    h, w = spec.height, spec.width
+    texture = cv2.GaussianBlur(rng.randint(0, 256, (h, w, 3)).astype(np.uint8), (0, 0), 2)
+
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    block = max(8, min(h, w) // 6)
+
+    for i in range(spec.frame_count):
+        phase = i / max(1, spec.frame_count)
+        gradient = np.stack([
+            127 + 120 * np.sin(2 * np.pi * (xx / w + phase)),
+            127 + 120 * np.sin(2 * np.pi * (yy / h + phase)),
+            127 + 120 * np.cos(2 * np.pi * ((xx + yy) / (w + h) - phase)),
+        ], axis=-1)
+        frame = np.roll(texture, (i, 2 * i), axis=(0, 1)).astype(np.float32)
+        frame = (0.6 * frame + 0.4 * gradient).astype(np.uint8)
+
+        x = int((w - block) * (0.5 + 0.5 * math.sin(2 * math.pi * phase)))
+        y = int((h - block) * (0.5 + 0.5 * math.cos(2 * math.pi * phase)))
+        cv2.rectangle(frame, (x, y), (x + block, y + block), (40, 200, 240), -1)
+        yield frame
+
+
+def write_tone(path, seconds, rate=48000):
+    """Write a deterministic 16-bit stereo WAV (440 Hz left, 660 Hz right)"""
+    samples = int(seconds * rate)
+    t = np.arange(samples) / rate
+    left = (0.3 * 32767 * np.sin(2 * np.pi * 440 * t)).astype('<i2')
+    right = (0.3 * 32767 * np.sin(2 * np.pi * 660 * t)).astype('<i2')
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(np.stack([left, right], axis=1).tobytes())
+
+
+def generate_video(spec, path, ffmpeg_path='ffmpeg', seed=0):
+    """
+    Render a synthetic test video
+
+    Args:
+        spec (VideoSpec): Video parameters
+        path (str): Output .mp4 path
+        ffmpeg_path (str): FFmpeg executable
+        seed (int): Texture seed
+
+    Returns:
+        str: The output path
+    """
+    tone_path = f"{path}.wav"
+    tmp_path = f"{path}.{os.getpid()}.tmp.mp4"
+    write_tone(tone_path, spec.seconds)
+    try:
+        with FFmpegFrameWriter(
+            ffmpeg_path, tmp_path, spec.width, spec.height, spec.fps,
+            audio_source=tone_path, audio_codec='aac', threads=1
+        ) as writer:
+            for frame in iter_frames(spec, seed):
+                writer.write(frame)
+        os.replace(tmp_path, path)
+    finally:
+        for leftover in (tone_path, tmp_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    return path
+
+
+def ensure_video(spec, work_dir, ffmpeg_path='ffmpeg', seed=0):
+    """Return the path of a spec's video in work_dir, rendering it on first use"""
+    os.makedirs(work_dir, exist_ok=True)
+    path = os.path.join(work_dir, f"synthetic_{spec.name}_s{seed}.mp4")
+    if not os.path.exists(path):
+        generate_video(spec, path, ffmpeg_path, seed)
+    return path
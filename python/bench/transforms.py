@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Benchmark - DTCWT Transforms
+Frames/second of the per-frame library transforms vs. the batched stack path
+and the native YUV 4:2:0 chroma-plane path
+
+Usage (from the python/ directory):
+    python -m bench.transforms [--resolutions 720p,1080p,4k]
+                               [--batch-sizes 1,4,8] [--frames 16]
+                               [--backends dtcwt,float32]
+
+Runs single-process (no pool) so the numbers compare the transforms only.
+The batched paths are measured once per column filter backend (see
+dtcwt_backends). Every backend's watermarks are then decoded with every
+other backend, and the correlation with the embedded pattern is reported.
+Prints one JSON line per measurement, then a summary table.
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import cv2
+
+import watermark_engine  # noqa: F401  (applies the numpy/dtcwt compatibility patches)
+from blind_video_watermark import DtcwtKeyEncoder, DtcwtKeyDecoder
+from blind_video_watermark.utils import generate_wm
+
+import dtcwt_batch
+
+
+RESOLUTIONS = {
+    '720p': (720, 1280),
+    '1080p': (1080, 1920),
+    '4k': (2160, 3840),
+}
+
+
+def synthetic_frames(count, height, width, seed=0):
+    """Textured BGR frames (smoothed noise) so masks are not trivially zero"""
+    rng = np.random.RandomState(seed)
+    base = cv2.GaussianBlur(rng.randint(0, 256, (height, width, 3)).astype(np.uint8), (0, 0), 3)
+    return np.stack([np.roll(base, 4 * i, axis=1) for i in range(count)])
+
+
+def _fps(frames, seconds):
+    return frames / seconds if seconds > 0 else 0.0
+
+
+def bench_resolution(name, frames, batch_sizes, backends=('float32',), strength=1.0, step=5.0):
+    """Measure encode and decode throughput for one resolution"""
+    height, width = RESOLUTIONS[name]
+    encoder = DtcwtKeyEncoder(strength, step)
+    decoder = DtcwtKeyDecoder(strength, step)
+    wm = generate_wm(11, encoder.infer_wm_shape((height, width))).astype(np.int8)
+    stack = synthetic_frames(frames, height, width)
+    results = []
+
+    start = time.perf_counter()
+    reference = [DtcwtKeyEncoder.encode_async(f, wm, encoder.alpha, step, i)[1] for i, f in enumerate(stack)]
+    results.append({"resolution": name, "op": "encode", "path": "per-frame", "batch_size": 1,
+                    "fps": _fps(frames, time.perf_counter() - start)})
+
+    start = time.perf_counter()
+    for f in reference:
+        DtcwtKeyDecoder.decode_async(cv2.cvtColor(f.astype(np.float32), cv2.COLOR_BGR2YUV),
+                                     decoder.alpha, step, 0)
+    results.append({"resolution": name, "op": "decode", "path": "per-frame", "batch_size": 1,
+                    "fps": _fps(frames, time.perf_counter() - start)})
+
+    planar = np.stack([cv2.cvtColor(f, cv2.COLOR_BGR2YUV_I420) for f in stack])
+    wm420 = generate_wm(11, encoder.infer_wm_shape((height // 2, width // 2))).astype(np.int8)
+    for backend in backends:
+        dtcwt_batch.set_backend(backend)
+        for batch_size in batch_sizes:
+            start = time.perf_counter()
+            encoded = []
+            for b in range(0, frames, batch_size):
+                batch = stack[b:b + batch_size]
+                encoded.extend(dtcwt_batch.encode_batch(batch, [wm] * len(batch), encoder.alpha, step))
+            elapsed = time.perf_counter() - start
+            diff = np.abs(np.stack(encoded).astype(np.int16) - np.stack(reference).astype(np.int16))
+            results.append({"resolution": name, "op": "encode", "path": "batched", "backend": backend,
+                            "batch_size": batch_size, "fps": _fps(frames, elapsed),
+                            "max_pixel_diff": int(diff.max())})
+
+            start = time.perf_counter()
+            for b in range(0, frames, batch_size):
+                dtcwt_batch.decode_batch(np.stack(reference[b:b + batch_size]), decoder.alpha, step)
+            results.append({"resolution": name, "op": "decode", "path": "batched", "backend": backend,
+                            "batch_size": batch_size, "fps": _fps(frames, time.perf_counter() - start)})
+
+        for batch_size in batch_sizes:
+            start = time.perf_counter()
+            encoded = []
+            for b in range(0, frames, batch_size):
+                batch = planar[b:b + batch_size]
+                encoded.extend(dtcwt_batch.encode_batch_yuv420(batch, [wm420] * len(batch), encoder.alpha, step))
+            results.append({"resolution": name, "op": "encode", "path": "yuv420", "backend": backend,
+                            "batch_size": batch_size, "fps": _fps(frames, time.perf_counter() - start)})
+
+            start = time.perf_counter()
+            for b in range(0, frames, batch_size):
+                dtcwt_batch.decode_batch_yuv420(np.stack(encoded[b:b + batch_size]), decoder.alpha, step)
+            results.append({"resolution": name, "op": "decode", "path": "yuv420", "backend": backend,
+                            "batch_size": batch_size, "fps": _fps(frames, time.perf_counter() - start)})
+
+    return results
+
+
+def cross_detection(name, backends, frames=4, strength=1.0, step=5.0):
+    """Correlation of the pattern each backend embeds with what every backend decodes"""
+    height, width = RESOLUTIONS[name]
+    encoder = DtcwtKeyEncoder(strength, step)
+    wm = generate_wm(11, encoder.infer_wm_shape((height, width))).astype(np.int8)
+    nwm = (wm - wm.mean()) / wm.std()
+    stack = synthetic_frames(frames, height, width)
+    results = []
+    for embed_backend in backends:
+        dtcwt_batch.set_backend(embed_backend)
+        encoded = np.stack(dtcwt_batch.encode_batch(stack, [wm] * frames, encoder.alpha, step))
+        for detect_backend in backends:
+            dtcwt_batch.set_backend(detect_backend)
+            corrs = []
+            for decoded in dtcwt_batch.decode_batch(encoded, encoder.alpha, step):
+                decoded = decoded.astype(np.float64)
+                decoded = (decoded - decoded.mean()) / (decoded.std() + 1e-10)
+                corrs.append(float((decoded * nwm).mean()))
+            results.append({"resolution": name, "op": "cross", "embed_backend": embed_backend,
+                            "detect_backend": detect_backend, "correlation": float(np.mean(corrs))})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--resolutions', default='720p,1080p,4k')
+    parser.add_argument('--batch-sizes', default='1,4,8')
+    parser.add_argument('--frames', type=int, default=16)
+    parser.add_argument('--backends', default='dtcwt,float32')
+    args = parser.parse_args()
+
+    batch_sizes = [int(b) for b in args.batch_sizes.split(',')]
+    backends = [b.strip() for b in args.backends.split(',')]
+    results, cross = [], []
+    for name in args.resolutions.split(','):
+        name = name.strip().lower()
+        for result in bench_resolution(name, args.frames, batch_sizes, backends):
+            print(json.dumps(result), flush=True)
+            results.append(result)
+        for result in cross_detection(name, backends):
+            print(json.dumps(result), flush=True)
+            cross.append(result)
+
+    print()
+    print(f"{'resolution':<10} {'op':<7} {'path':<10} {'backend':<8} {'batch':>5} {'fps':>8} {'speedup':>8}")
+    for result in results:
+        baseline = next(r for r in results if r['resolution'] == result['resolution']
+                        and r['op'] == result['op'] and r['path'] == 'per-frame')
+        speedup = result['fps'] / baseline['fps'] if baseline['fps'] else 0.0
+        print(f"{result['resolution']:<10} {result['op']:<7} {result['path']:<10} {result.get('backend', '-'):<8} "
+              f"{result['batch_size']:>5} {result['fps']:>8.2f} {speedup:>7.2f}x")
+
+    print()
+    print(f"{'resolution':<10} {'embedded with':<14} {'detected with':<14} {'correlation':>11}")
+    for result in cross:
+        print(f"{result['resolution']:<10} {result['embed_backend']:<14} {result['detect_backend']:<14} "
+              f"{result['correlation']:>11.4f}")
+
+
+if __name__ == "__main__":
+    main()
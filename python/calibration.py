@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Calibration
+Per-machine thread, batch and process settings measured on synthetic clips
+
+The best worker count depends on the machine (a 4-core laptop thrashes with
+8 pool processes, a 64-core server idles) and on the frame size (large
+frames are memory-bound earlier). `calibrate` renders a short synthetic clip
+for each resolution class and runs real embed and detect trials on it, each
+in a freshly spawned process as the benchmark cases do:
+
+    1. embed with every worker count of the grid (batch size 1, frames mode)
+    2. embed with every batch size at the fastest worker count
+    3. embed in chunks mode (one chunk per worker process) at those settings
+    4. detect (extract-key) with every worker count
+
+Trials whose output fails detection are discarded, and a setting tried
+later has to be MIN_GAIN faster than the best so far to replace it. The
+fastest embed and detect settings are stored per host and resolution class
+in calibration.json in the cache directory.
+
+Job commands whose arguments leave `threads` (and, for embeds, `batch_size`
+and `embed_mode`) unset get the stored settings for the input's resolution
+class, or the nearest calibrated class; see calibrated_args(). extract-batch
+takes the class of the first file of its list. Passing the
+arguments, `"calibration": false`, or MGHOSTING_CALIBRATION=0 turns that off.
+Uncalibrated hosts fall back to default_threads().
+
+Only the standard library is imported at load time; media_probe comes in
+when a job's input is probed and the benchmark package when calibrating.
+"""
+
+import json
+import os
+import platform
+import time
+
+from app_paths import default_cache_dir
+
+
+FORMAT_VERSION = 1
+# name -> (width, height) of the synthetic clip; a video belongs to the
+# smallest class with at least its pixel count
+RESOLUTION_CLASSES = [
+    ('480p', 854, 480),
+    ('720p', 1280, 720),
+    ('1080p', 1920, 1080),
+    ('2160p', 3840, 2160),
+]
+DEFAULT_THREADS = 8
+DEFAULT_BATCH_SIZES = (1, 2, 4)
+TRIAL_SECONDS = 2
+TRIAL_FPS = 25
+MIN_GAIN = 0.05  # speedup a costlier setting needs over the current best
+EMBED_COMMANDS = ('embed-key', 'embed-key-batch')
+DETECT_COMMANDS = ('extract-key', 'extract-key-multi', 'identify-key', 'extract-batch')
+
+
+def default_threads():
+    """Worker count for uncalibrated hosts: 8, or fewer on smaller machines"""
+    return max(1, min(DEFAULT_THREADS, os.cpu_count() or 1))
+
+
+def host_key():
+    """Identify this machine (name, architecture and core count) in calibration.json"""
+    return f"{platform.node()}|{platform.machine()}|{os.cpu_count()}"
+
+
+def resolution_class(width, height):
+    """Name of the resolution class a frame size belongs to"""
+    pixels = int(width) * int(height)
+    for name, w, h in RESOLUTION_CLASSES:
+        if pixels <= w * h:
+            return name
+    return RESOLUTION_CLASSES[-1][0]
+
+
+def thread_grid(cpu_count=None):
+    """Worker counts to try: powers of two from 2 up to the core count, plus the core count"""
+    cpu_count = cpu_count or os.cpu_count() or 1
+    grid = {cpu_count}
+    n = 2 if cpu_count >= 2 else 1
+    while n < cpu_count:
+        grid.add(n)
+        n *= 2
+    return sorted(grid)
+
+
+class CalibrationStore:
+    """Calibrated settings of every host, in <cache_dir>/calibration.json"""
+
+    def __init__(self, cache_dir=None):
+        """
+        Initialize store
+
+        Args:
+            cache_dir (str): Root cache directory (default: default_cache_dir())
+        """
+        self.path = os.path.join(cache_dir or default_cache_dir(), 'calibration.json')
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {"version": FORMAT_VERSION, "hosts": {}}
+        if data.get('version') != FORMAT_VERSION:
+            return {"version": FORMAT_VERSION, "hosts": {}}
+        return data
+
+    def host(self, key=None):
+        """Calibrated classes of a host: {class name: entry}"""
+        return self.load()['hosts'].get(key or host_key(), {}).get('classes', {})
+
+    def save_class(self, name, entry, key=None):
+        """Store the calibration of one resolution class for a host"""
+        data = self.load()
+        host = data['hosts'].setdefault(key or host_key(), {
+            "hostname": platform.node(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "classes": {}
+        })
+        host['classes'][name] = entry
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def lookup(self, width, height, key=None):
+        """
+        Calibration for a frame size
+
+        Returns:
+            tuple: (class name, entry), using the nearest calibrated class when
+                the frame's own class has not been calibrated; (None, None) if
+                the host has no calibration
+        """
+        classes = self.host(key)
+        if not classes:
+            return None, None
+        names = [name for name, _, _ in RESOLUTION_CLASSES]
+        wanted = names.index(resolution_class(width, height))
+        nearest = min((name for name in classes if name in names),
+                      key=lambda name: (abs(names.index(name) - wanted), -names.index(name)),
+                      default=None)
+        return nearest, classes.get(nearest)
+
+
+def _input_path(args):
+    """The video a job's settings are looked up for: video_path, or the first file of an extract-batch"""
+    if args.get('video_path'):
+        return args['video_path']
+    try:
+        files = list(args.get('files') or [])
+        if not files and args.get('files_file'):
+            with open(args['files_file'], 'r', encoding='utf-8') as f:
+                files = json.load(f)
+        if not files and args.get('directory'):
+            from batch_scheduler import VIDEO_EXTENSIONS
+            files = sorted(os.path.join(args['directory'], name) for name in os.listdir(args['directory'])
+                           if name.lower().endswith(VIDEO_EXTENSIONS))
+    except (OSError, ValueError):
+        return None
+    if not files:
+        return None
+    return files[0]['path'] if isinstance(files[0], dict) else files[0]
+
+
+def calibrated_args(command, args, cache_dir=None):
+    """
+    Fill unset worker settings of a job from this host's calibration
+
+    Args:
+        command (str): Processor command
+        args (dict): Its arguments (not modified)
+
+    Returns:
+        tuple: (args with threads and the calibrated settings filled in,
+            dict of the settings taken from the calibration or None)
+    """
+    if command not in EMBED_COMMANDS + DETECT_COMMANDS:
+        return args, None
+    args = dict(args)
+    enabled = args.pop('calibration', True) and os.environ.get('MGHOSTING_CALIBRATION') != '0'
+    applied = None
+    video_path = _input_path(args) if enabled else None
+    if video_path:
+        try:
+            import media_probe
+            info = media_probe.probe(video_path, ffmpeg_path=media_probe.find_ffmpeg())
+            name, entry = CalibrationStore(cache_dir or args.get('cache_dir')).lookup(info['width'], info['height'])
+        except Exception:
+            name, entry = None, None
+        settings = entry and entry.get('embed' if command in EMBED_COMMANDS else 'detect')
+        if settings:
+            applied = {"class": name}
+            keys = ['threads']
+            if command in EMBED_COMMANDS:
+                keys.append('batch_size')
+                # The coefficient cache is only read in frames mode
+                if command == 'embed-key' and not args.get('coefficient_cache'):
+                    keys.append('embed_mode')
+            for key in keys:
+                if args.get(key) is None and settings.get(key) is not None:
+                    args[key] = applied[key] = settings[key]
+    if args.get('threads') is None:
+        args['threads'] = default_threads()
+    return args, applied
+
+
+def _fastest(trials):
+    """
+    Best successful trial, in trial order
+
+    A later trial (more workers, a bigger batch, chunks) only wins if it is
+    MIN_GAIN faster, so run-to-run noise does not pick costlier settings.
+    """
+    best = None
+    for t in trials:
+        if t['success'] and t.get('correct') is not False and (best is None or t['fps'] > best['fps'] * (1 + MIN_GAIN)):
+            best = t
+    return best
+
+
+def calibrate(resolutions=None, threads=None, batch_sizes=None, seconds=TRIAL_SECONDS,
+              cache_dir=None, work_dir=None, log=print):
+    """
+    Run the trial grid for each resolution class and store the fastest settings
+
+    Args:
+        resolutions (list): Class names to calibrate (default: 720p and 1080p)
+        threads (list): Worker counts to try (default: thread_grid())
+        batch_sizes (list): Batch sizes to try (default: DEFAULT_BATCH_SIZES)
+        seconds (float): Length of the synthetic clips (default: 2)
+        cache_dir (str): Cache directory the result is stored in
+        work_dir (str): Where clips and trial outputs go (default: <cache>/calibration)
+        log (callable): Receives one JSON-ready event dict per trial
+
+    Returns:
+        dict: success, host and the stored entry of every calibrated class
+    """
+    from bench.runner import run_case
+    from bench.synthetic import VideoSpec, ensure_video
+    import media_probe
+
+    classes = {name: (w, h) for name, w, h in RESOLUTION_CLASSES}
+    resolutions = resolutions or ['720p', '1080p']
+    unknown = [name for name in resolutions if name not in classes]
+    if unknown:
+        raise ValueError(f"Unknown resolution class: {', '.join(unknown)} (known: {', '.join(classes)})")
+    threads = sorted({int(t) for t in threads}) if threads else thread_grid()
+    batch_sizes = sorted({int(b) for b in batch_sizes}) if batch_sizes else list(DEFAULT_BATCH_SIZES)
+    cache_dir = cache_dir or default_cache_dir()
+    work_dir = work_dir or os.path.join(cache_dir, 'calibration')
+    store = CalibrationStore(cache_dir)
+    ffmpeg_path = media_probe.find_ffmpeg()
+
+    results = {}
+    for name in resolutions:
+        spec = VideoSpec(*classes[name], TRIAL_FPS, seconds)
+        video_path = ensure_video(spec, work_dir, ffmpeg_path)
+        trials = []
+
+        def trial(case, kind, n, extra, source=video_path):
+            record = run_case(case, spec, source, work_dir, n, cache_dir, extra=extra)
+            record.update(kind=kind, threads=n)
+            trials.append(record)
+            log({"status": "processing", "phase": "calibrate", "resolution": name,
+                 "message": f"{name} {kind}: {n} workers" + "".join(f", {k} {v}" for k, v in extra.items())
+                            + (f" -> {record['fps']:.2f} fps" if record['success'] else f" failed: {record.get('error')}")})
+            return record
+
+        embeds = [trial('embed', 'embed', n, {"batch_size": batch_sizes[0]}) for n in threads]
+        best = _fastest(embeds)
+        if best is None:
+            raise RuntimeError(f"Every {name} embed trial failed: {embeds[-1].get('error')}")
+        best_threads = best['threads']
+        embeds += [trial('embed', 'embed', best_threads, {"batch_size": b}) for b in batch_sizes[1:]]
+        best_batch = _fastest(embeds)['args'].get('batch_size', batch_sizes[0])
+        embeds.append(trial('embed', 'embed', best_threads, {"batch_size": best_batch, "embed_mode": 'chunks'}))
+        best = _fastest(embeds)
+
+        # Detection reads the output the embed trials left behind
+        embedded_path = os.path.join(work_dir, f"out_{spec.name}_embed.mp4")
+        detects = [trial('extract', 'detect', n, {}, embedded_path) for n in threads]
+        best_detect = _fastest(detects)
+
+        entry = {
+            "embed": {
+                "threads": best['threads'],
+                "batch_size": best['args'].get('batch_size', batch_sizes[0]),
+                "embed_mode": best['args'].get('embed_mode', 'frames'),
+                "fps": best['fps']
+            },
+            "detect": {"threads": best_detect['threads'], "fps": best_detect['fps']} if best_detect else None,
+            "clip": spec.to_dict(),
+            "calibrated_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "trials": [{key: t.get(key) for key in ('kind', 'threads', 'args', 'success', 'correct', 'fps', 'wall_s')}
+                       for t in trials]
+        }
+        store.save_class(name, entry)
+        results[name] = entry
+        log({"status": "debug", "phase": "calibrate", "resolution": name,
+             "message": f"{name}: embed {entry['embed']['threads']} workers, batch {entry['embed']['batch_size']}, "
+                        f"{entry['embed']['embed_mode']} ({entry['embed']['fps']:.2f} fps)"
+                        + (f"; detect {entry['detect']['threads']} workers ({entry['detect']['fps']:.2f} fps)"
+                           if entry['detect'] else "")})
+
+    return {
+        "success": True,
+        "host": host_key(),
+        "cpu_count": os.cpu_count(),
+        "calibration_path": store.path,
+        "classes": results
+    }
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Coefficient Cache
+On-disk LRU cache of per-frame DTCWT masks for master videos
+
+Embedding needs exactly one forward transform per frame: the level-2 luma
+highpasses that become the level-3 perceptual masks (see
+dtcwt_batch.embed_masks). They depend only on the source frames, the mask
+quantization step and the pixel format domain, so a master that was
+watermarked before can skip that transform for every later recipient.
+
+Each entry is a directory of chunk_NNNNN.npy files with (frames, h3, w3, 6)
+masks, memory-mapped on read, plus a manifest.json. Masks are small integers
+(ceil(magnitude / step)) and are stored as uint8, or uint16 for chunks that
+need it, so reading them back is exact. Entries are keyed by a content hash
+of the source file and the parameters above; strength only scales the
+watermark afterwards and is not part of the key.
+
+numpy is imported where masks are read or written, so listing and purging
+(coeff-cache-list / coeff-cache-purge) run without it.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from app_paths import default_cache_dir
+
+
+DEFAULT_COEFF_CACHE_MB = 4096
+CHUNK_FRAMES = 256
+FORMAT_VERSION = 1
+
+
+def _dir_size(path):
+    total = 0
+    for name in os.listdir(path):
+        try:
+            total += os.path.getsize(os.path.join(path, name))
+        except OSError:
+            pass
+    return total
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class MaskEntry:
+    """Read access to a complete cache entry"""
+
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.manifest = manifest
+        self.frames = manifest['frames']
+        self.chunk_frames = manifest['chunk_frames']
+        self._chunks = {}
+
+    def _chunk(self, index):
+        import numpy as np
+        chunk = self._chunks.get(index)
+        if chunk is None:
+            path = os.path.join(self.directory, f"chunk_{index:05d}.npy")
+            chunk = self._chunks[index] = np.load(path, mmap_mode='r')
+        return chunk
+
+    def read(self, start, count):
+        """
+        Masks of frames [start, start + count) in dtcwt_batch layout
+
+        Returns:
+            np.ndarray: (h3, w3, 6, count) float32 masks, or None past the cached frames
+        """
+        import numpy as np
+        if start + count > self.frames:
+            return None
+        parts = []
+        frame = start
+        while frame < start + count:
+            index, offset = divmod(frame, self.chunk_frames)
+            take = min(self.chunk_frames - offset, start + count - frame)
+            parts.append(self._chunk(index)[offset:offset + take])
+            frame += take
+        masks = np.concatenate(parts) if len(parts) > 1 else parts[0]
+        return np.moveaxis(masks.astype(np.float32), 0, -1)
+
+
+class MaskWriter:
+    """Collects masks in frame order into a temporary entry and publishes it on commit"""
+
+    def __init__(self, cache, key, manifest):
+        self.cache = cache
+        self.key = key
+        self.manifest = manifest
+        self.directory = os.path.join(cache.directory, f"{key}.{os.getpid()}.tmp")
+        self.frames = 0
+        self._pending = []
+        self._pending_frames = 0
+        self._chunks = 0
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+
+    def append(self, masks):
+        """Add the (h3, w3, 6, N) masks of the next N frames"""
+        import numpy as np
+        self._pending.append(np.moveaxis(masks, -1, 0))
+        self._pending_frames += masks.shape[-1]
+        self.frames += masks.shape[-1]
+        while self._pending_frames >= CHUNK_FRAMES:
+            self._flush(CHUNK_FRAMES)
+
+    def _flush(self, count):
+        import numpy as np
+        stacked = np.concatenate(self._pending) if len(self._pending) > 1 else self._pending[0]
+        chunk, rest = stacked[:count], stacked[count:]
+        dtype = np.uint8 if chunk.max(initial=0) <= 255 else np.uint16
+        np.save(os.path.join(self.directory, f"chunk_{self._chunks:05d}.npy"), chunk.astype(dtype))
+        self._chunks += 1
+        self._pending = [rest] if len(rest) else []
+        self._pending_frames = len(rest)
+
+    def commit(self):
+        """Write the remaining masks and the manifest, then publish the entry"""
+        try:
+            if self._pending_frames:
+                self._flush(self._pending_frames)
+            self.manifest.update(frames=self.frames, chunks=self._chunks)
+            _write_json(os.path.join(self.directory, 'manifest.json'), self.manifest)
+            self.cache._publish(self.key, self.directory)
+        except OSError:
+            # Full or read-only disk: the job itself already succeeded
+            self.abort()
+
+    def abort(self):
+        """Drop the partial entry"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class CoefficientCache:
+    """LRU-evicting cache of per-frame embedding masks keyed by source content and parameters"""
+
+    def __init__(self, cache_dir=None, max_mb=None):
+        """
+        Initialize cache
+
+        Args:
+            cache_dir (str): Root cache directory (default: default_cache_dir())
+            max_mb (float): Size budget in MB (default: MGHOSTING_COEFF_CACHE_MB or 4096)
+        """
+        if max_mb is None:
+            max_mb = float(os.environ.get('MGHOSTING_COEFF_CACHE_MB', DEFAULT_COEFF_CACHE_MB))
+        self.directory = os.path.join(cache_dir or default_cache_dir(), 'coefficients')
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def content_hash(self, video_path):
+        """
+        BLAKE2b digest of a file's contents
+
+        Digests are remembered by (path, size, mtime) in hashes.json, so an
+        unchanged master is only read once.
+        """
+        st = os.stat(video_path)
+        path = os.path.abspath(video_path)
+        index_path = os.path.join(self.directory, 'hashes.json')
+        with self._lock:
+            try:
+                with open(index_path, 'r', encoding='utf-8') as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = {}
+            known = index.get(path)
+            if known and known['size'] == st.st_size and known['mtime_ns'] == st.st_mtime_ns:
+                return known['digest']
+
+        digest = hashlib.blake2b(digest_size=20)
+        with open(video_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        digest = digest.hexdigest()
+
+        with self._lock:
+            index[path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "digest": digest}
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                _write_json(index_path, index)
+            except OSError:
+                pass
+        return digest
+
+    @staticmethod
+    def entry_key(digest, step, width, height, pixel_format):
+        return f"{digest}_{int(width)}x{int(height)}_{pixel_format}_step{float(step):g}"
+
+    def open(self, video_path, step, width, height, pixel_format):
+        """
+        Return a MaskEntry for a source, or None if it is not cached
+
+        Args:
+            video_path (str): Source video
+            step (float): Mask quantization step
+            width (int): Frame width
+            height (int): Frame height
+            pixel_format (str): 'bgr' or 'yuv420'
+        """
+        key = self.entry_key(self.content_hash(video_path), step, width, height, pixel_format)
+        directory = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(directory, 'manifest.json'), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if manifest.get('version') != FORMAT_VERSION:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touch(directory)
+        return MaskEntry(directory, manifest)
+
+    def writer(self, video_path, step, width, height, pixel_format, frames, mask_shape):
+        """
+        Start a new entry for a source, or return None if it would not fit the budget
+
+        Args:
+            frames (int): Expected frame count, used for the size estimate
+            mask_shape (tuple): (h3, w3) of the level-3 subbands
+            (other arguments as for open())
+        """
+        if int(frames) * int(mask_shape[0]) * int(mask_shape[1]) * 6 > self.max_bytes:
+            return None
+        digest = self.content_hash(video_path)
+        key = self.entry_key(digest, step, width, height, pixel_format)
+        manifest = {
+            "version": FORMAT_VERSION,
+            "source": os.path.basename(video_path),
+            "source_size": os.path.getsize(video_path),
+            "digest": digest,
+            "step": float(step),
+            "width": int(width),
+            "height": int(height),
+            "pixel_format": pixel_format,
+            "mask_shape": [int(mask_shape[0]), int(mask_shape[1]), 6],
+            "chunk_frames": CHUNK_FRAMES,
+            "created": time.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        return MaskWriter(self, key, manifest)
+
+    def _publish(self, key, tmp_directory):
+        final = os.path.join(self.directory, key)
+        with self._lock:
+            shutil.rmtree(final, ignore_errors=True)
+            os.replace(tmp_directory, final)
+            self._touch(final)
+            self._evict(keep=key)
+
+    def _touch(self, directory):
+        """Record an access for LRU ordering (manifest mtime persists it across runs)"""
+        try:
+            os.utime(os.path.join(directory, 'manifest.json'), None)
+        except OSError:
+            pass
+
+    def entries(self):
+        """
+        List complete entries, most recently used first
+
+        Returns:
+            list: Manifest dicts with 'key', 'size_bytes' and 'last_used' added
+        """
+        result = []
+        if not os.path.isdir(self.directory):
+            return result
+        for key in os.listdir(self.directory):
+            manifest_path = os.path.join(self.directory, key, 'manifest.json')
+            try:
+                with open(manifest_path, 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+                last_used = os.path.getmtime(manifest_path)
+            except (OSError, ValueError):
+                continue
+            manifest.update(
+                key=key,
+                size_bytes=_dir_size(os.path.join(self.directory, key)),
+                last_used=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(last_used)),
+                _mtime=last_used
+            )
+            result.append(manifest)
+        result.sort(key=lambda m: m['_mtime'], reverse=True)
+        for manifest in result:
+            del manifest['_mtime']
+        return result
+
+    def _evict(self, keep=None):
+        """Delete least recently used entries until the cache fits its budget"""
+        entries = self.entries()
+        total = sum(e['size_bytes'] for e in entries)
+        for entry in reversed(entries):
+            if total <= self.max_bytes:
+                break
+            if entry['key'] == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, entry['key']), ignore_errors=True)
+            total -= entry['size_bytes']
+
+    def purge(self, keys=None, older_than_days=None):
+        """
+        Delete entries (and abandoned partial ones)
+
+        Args:
+            keys (list): Entry keys to delete (default: all, subject to older_than_days)
+            older_than_days (float): Only delete entries not used for this many days
+
+        Returns:
+            dict: {"removed": count, "freed_bytes": bytes}
+        """
+        removed, freed = 0, 0
+        cutoff = time.time() - older_than_days * 86400 if older_than_days is not None else None
+        with self._lock:
+            for entry in self.entries():
+                if keys is not None and entry['key'] not in keys:
+                    continue
+                path = os.path.join(self.directory, entry['key'])
+                if cutoff is not None and os.path.getmtime(os.path.join(path, 'manifest.json')) > cutoff:
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+                freed += entry['size_bytes']
+            if keys is None and cutoff is None and os.path.isdir(self.directory):
+                # Leftovers of interrupted writes
+                for name in os.listdir(self.directory):
+                    if name.endswith('.tmp') and os.path.isdir(os.path.join(self.directory, name)):
+                        shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        return {"removed": removed, "freed_bytes": freed}
+
+    def stats(self):
+        """Return cache statistics"""
+        entries = self.entries()
+        return {
+            "directory": self.directory,
+            "entries": len(entries),
+            "size_bytes": sum(e['size_bytes'] for e in entries),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses
+        }
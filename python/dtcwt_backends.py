@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting DTCWT Backends
+Column filter implementations behind dtcwt_batch.forward/inverse
+
+The batched transform needs three filters, each applied along one axis of a
+(height, width, frames) stack: a non-decimating FIR (colfilter, level 1), a
+decimate-by-two Q-shift pair (coldfilt, forward levels 2+) and an
+interpolate-by-two Q-shift pair (colifilt, inverse levels 2+).
+
+'dtcwt' runs the dtcwt package's NumPy filters: every call builds the
+symmetric extension by fancy indexing, allocates the output and one temporary
+per tap, and row filtering first copies the transposed stack. It is the
+reference the other backend is checked against.
+
+'float32' computes the same sums in float32 with OpenCV's vectorized
+filter2D. Level 1 filters either axis directly with OpenCV's symmetric
+border; the Q-shift pairs read their polyphase inputs as strided row views
+of one symmetric extension, and rows are filtered by transposing with
+cv2.transpose. The extension, transpose and per-phase buffers are kept per
+thread and per shape, so a stream of equally sized frames reuses them
+instead of allocating.
+
+Both give the same coefficients to float32 precision (see
+dtcwt_batch.check_backend), so watermarks embedded with one are detected by
+the other.
+"""
+
+import threading
+
+import cv2
+import numpy as np
+
+from dtcwt.numpy.lowlevel import colfilter as _dtcwt_colfilter, coldfilt as _dtcwt_coldfilt, _column_convolve
+from dtcwt.utils import as_column_vector, reflect
+
+
+# Buffers kept per thread before they are all dropped (tile edges and the
+# three transform levels make a handful of shapes per frame size)
+MAX_BUFFERS = 48
+
+
+def _reference_colifilt(X, ha, hb):
+    """
+    dtcwt.numpy.lowlevel.colifilt without its all-zero input scan
+
+    The scan costs about as much as the filter itself; callers here never pass
+    all-zero subbands (they pass None instead, see dtcwt_batch.inverse()).
+    """
+    r, c = X.shape
+    m = ha.shape[0]
+    m2 = m // 2
+    Y = np.zeros((r * 2, c), dtype=X.dtype)
+
+    xe = reflect(np.arange(-m2, r + m2, dtype=np.int64), -0.5, r - 0.5)
+    t = np.arange(3, r + m, 2) if m2 % 2 == 0 else np.arange(2, r + m - 1, 2)
+    if np.sum(ha * hb) > 0:
+        ta, tb = t, t - 1
+    else:
+        ta, tb = t - 1, t
+    hao = as_column_vector(ha[0:m:2])
+    hae = as_column_vector(ha[1:m:2])
+    hbo = as_column_vector(hb[0:m:2])
+    hbe = as_column_vector(hb[1:m:2])
+    s = np.arange(0, r * 2, 4)
+
+    if m2 % 2 == 0:
+        Y[s, :] = _column_convolve(X[xe[tb - 2], :], hae)
+        Y[s + 1, :] = _column_convolve(X[xe[ta - 2], :], hbe)
+        Y[s + 2, :] = _column_convolve(X[xe[tb], :], hao)
+        Y[s + 3, :] = _column_convolve(X[xe[ta], :], hbo)
+    else:
+        Y[s, :] = _column_convolve(X[xe[tb], :], hao)
+        Y[s + 1, :] = _column_convolve(X[xe[ta], :], hbo)
+        Y[s + 2, :] = _column_convolve(X[xe[tb], :], hae)
+        Y[s + 3, :] = _column_convolve(X[xe[ta], :], hbe)
+    return Y
+
+
+class ReferenceBackend:
+    """The dtcwt package's column filters applied to N-D stacks"""
+
+    name = 'dtcwt'
+
+    @staticmethod
+    def _along(func, X, axis, *filters):
+        if axis == 1:
+            X = X.swapaxes(0, 1)
+        Y = func(X.reshape(X.shape[0], -1), *filters)
+        Y = Y.reshape((Y.shape[0],) + X.shape[1:])
+        return Y.swapaxes(0, 1) if axis == 1 else Y
+
+    def colfilter(self, X, axis, h):
+        """Non-decimating FIR along `axis` (dtcwt colfilter)"""
+        return self._along(_dtcwt_colfilter, X, axis, h)
+
+    def coldfilt(self, X, axis, ha, hb):
+        """Decimate-by-two Q-shift filter pair along `axis` (dtcwt coldfilt)"""
+        return self._along(_dtcwt_coldfilt, X, axis, ha, hb)
+
+    def colifilt(self, X, axis, ha, hb):
+        """Interpolate-by-two Q-shift filter pair along `axis` (dtcwt colifilt)"""
+        return self._along(_reference_colifilt, X, axis, ha, hb)
+
+
+def _symmetric_index(length, pad):
+    """Indices of a half-sample symmetric extension by `pad` on both sides (as dtcwt reflect)"""
+    idx = np.arange(-pad, length + pad) % (2 * length)
+    return np.where(idx >= length, 2 * length - 1 - idx, idx)
+
+
+class Float32Backend:
+    """float32 column filters with OpenCV FIR kernels and reused working buffers"""
+
+    name = 'float32'
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _buffer(self, tag, shape):
+        """Working buffer for (tag, shape), reused by later calls on this thread"""
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None:
+            buffers = self._local.buffers = {}
+        key = (tag, shape)
+        buf = buffers.get(key)
+        if buf is None:
+            if len(buffers) >= MAX_BUFFERS:
+                buffers.clear()
+            buf = buffers[key] = np.empty(shape, dtype=np.float32)
+        return buf
+
+    @staticmethod
+    def _prepare(X):
+        return np.ascontiguousarray(X, dtype=np.float32)
+
+    @staticmethod
+    def _transpose(X, out=None):
+        """Swap the first two axes of a C-contiguous stack into a C-contiguous array"""
+        shape = (X.shape[1], X.shape[0]) + X.shape[2:]
+        if out is None:
+            out = np.empty(shape, dtype=X.dtype)
+        try:
+            # Blocked transpose; OpenCV takes up to 4 (and 8) float channels
+            cv2.transpose(X.reshape(X.shape[0], X.shape[1], -1), out.reshape(shape[0], shape[1], -1))
+        except cv2.error:
+            np.copyto(out, X.swapaxes(0, 1))
+        return out
+
+    def _extend(self, A, pad):
+        """Rows of 2-D A symmetrically extended by `pad` on both sides"""
+        ext = self._buffer('ext', (A.shape[0] + 2 * pad, A.shape[1]))
+        np.take(A, _symmetric_index(A.shape[0], pad), axis=0, out=ext)
+        return ext
+
+    def _fir(self, tag, ext, taps, start, stride, n):
+        """
+        Rows j < n of sum_k taps[k] * ext[start + stride * (j + len(taps) - 1 - k)]
+
+        The input rows are a strided view of `ext`, so no phase is copied.
+        """
+        q = len(taps)
+        view = ext[start:start + stride * (n + q - 2) + 1:stride]
+        dst = self._buffer(tag, view.shape)
+        cv2.filter2D(view, -1, np.ascontiguousarray(taps[::-1]).reshape(q, 1), dst=dst,
+                     anchor=(0, 0), borderType=cv2.BORDER_CONSTANT)
+        return dst[:n]
+
+    def _along(self, func, X, axis, *filters):
+        """Run a rows filter of 2-D arrays along `axis` of an N-D stack"""
+        X = self._prepare(X)
+        if axis == 1:
+            T = self._transpose(X, self._buffer('transpose', (X.shape[1], X.shape[0]) + X.shape[2:]))
+            Y = func(T.reshape(T.shape[0], -1), *filters)
+            return self._transpose(Y.reshape((Y.shape[0],) + T.shape[1:]))
+        Y = func(X.reshape(X.shape[0], -1), *filters)
+        return Y.reshape((Y.shape[0],) + X.shape[1:])
+
+    def colfilter(self, X, axis, h):
+        """Non-decimating FIR along `axis` (odd-length filters, as the biorthogonal level 1)"""
+        X = self._prepare(X)
+        h = np.asarray(h, dtype=np.float32).ravel()
+        m = h.shape[0]
+        if m % 2 == 0:
+            raise ValueError('Float32 colfilter needs an odd-length filter')
+        # BORDER_REFLECT repeats the end samples like dtcwt's symmetric extension,
+        # and filters along either axis without transposing
+        kernel = np.ascontiguousarray(h[::-1])
+        if axis == 0:
+            src = X.reshape(X.shape[0], -1)
+            Y = cv2.filter2D(src, -1, kernel.reshape(m, 1), anchor=(0, m // 2), borderType=cv2.BORDER_REFLECT)
+        else:
+            src = X.reshape(X.shape[0], X.shape[1], -1)
+            Y = cv2.filter2D(src, -1, kernel.reshape(1, m), anchor=(m // 2, 0), borderType=cv2.BORDER_REFLECT)
+        return Y.reshape(X.shape)
+
+    def _coldfilt(self, A, ha, hb):
+        r, c = A.shape
+        if r % 4 != 0:
+            raise ValueError('No. of rows in X must be a multiple of 4')
+        ext = self._extend(A, ha.shape[0])
+        n = r // 4
+        Y = np.empty((r // 2, c), dtype=np.float32)
+        sa, sb = (Y[0::2], Y[1::2]) if np.sum(ha * hb) > 0 else (Y[1::2], Y[0::2])
+        # Even taps of each filter read the samples one pair after the odd ones
+        np.add(self._fir('a0', ext, ha[0::2], 4, 4, n), self._fir('a1', ext, ha[1::2], 2, 4, n), out=sa)
+        np.add(self._fir('b0', ext, hb[0::2], 5, 4, n), self._fir('b1', ext, hb[1::2], 3, 4, n), out=sb)
+        return Y
+
+    def _colifilt(self, A, ha, hb):
+        r, c = A.shape
+        m2 = ha.shape[0] // 2
+        ext = self._extend(A, m2)
+        n = r // 2
+        Y = np.empty((r * 2, c), dtype=np.float32)
+        # Sample offsets of the a and b phases (ta, tb in dtcwt colifilt)
+        da, db = (0, 1) if np.sum(ha * hb) > 0 else (1, 0)
+        if m2 % 2 == 0:
+            phases = ((ha[1::2], 1 - db), (hb[1::2], 1 - da), (ha[0::2], 3 - db), (hb[0::2], 3 - da))
+        else:
+            phases = ((ha[0::2], 2 - db), (hb[0::2], 2 - da), (ha[1::2], 2 - db), (hb[1::2], 2 - da))
+        for p, (taps, start) in enumerate(phases):
+            Y[p::4] = self._fir('phase', ext, taps, start, 2, n)
+        return Y
+
+    def coldfilt(self, X, axis, ha, hb):
+        """Decimate-by-two Q-shift filter pair along `axis` (dtcwt coldfilt layout)"""
+        ha = np.asarray(ha, dtype=np.float32).ravel()
+        hb = np.asarray(hb, dtype=np.float32).ravel()
+        return self._along(self._coldfilt, X, axis, ha, hb)
+
+    def colifilt(self, X, axis, ha, hb):
+        """Interpolate-by-two Q-shift filter pair along `axis` (dtcwt colifilt layout)"""
+        ha = np.asarray(ha, dtype=np.float32).ravel()
+        hb = np.asarray(hb, dtype=np.float32).ravel()
+        return self._along(self._colifilt, X, axis, ha, hb)
+
+
+BACKENDS = {
+    ReferenceBackend.name: ReferenceBackend,
+    Float32Backend.name: Float32Backend,
+}
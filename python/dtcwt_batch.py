@@ -0,0 +1,881 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Batched DTCWT
+Forward/inverse 2-D DTCWT and key watermark encode/decode over frame stacks
+
+The dtcwt NumPy backend filters the columns of a single 2-D image. Stacks are
+kept in (height, width, frames) layout so that filtering along the first axis
+becomes one 2-D filter over a (height, width * frames) view, and row filtering
+is the same call on the transposed stack. Every NumPy operation then covers a
+whole batch instead of one frame.
+
+Only the subbands the watermark uses are computed: masks need the level-2
+highpasses of Y, detection needs the level-3 highpasses of U, and embedding
+adds the inverse transform of the level-3 change to U instead of running a
+full forward/inverse pair on it.
+
+The arithmetic (filters, extension rules, dtypes) follows dtcwt.Transform2d
+and blind_video_watermark.dtcwt_key, so watermarks embedded here are detected
+by the library decoder and vice versa. The column filters themselves come
+from a backend (see dtcwt_backends and set_backend): the dtcwt package's own,
+or a faster float32 one that check_backend compares against Transform2d.
+
+encode_batch/decode_batch work on BGR frames like the library. The *_yuv420
+variants take raw planar 4:2:0 frames from the decoder and watermark the U
+plane at its native half resolution; those watermarks form their own domain
+and are only detected by decode_batch_yuv420.
+
+encode_tile/encode_tile_yuv420 embed into one overlapping tile of a larger
+frame (see tile_plan), so the working set follows the tile size instead of
+the frame size. Every filter is local and tile windows keep the decimation
+phase of the whole plane, so the core of each tile is exactly the whole-frame
+result: tiles join without seams and detection is unchanged.
+"""
+
+import hashlib
+import os
+from collections import OrderedDict, namedtuple
+from contextlib import nullcontext
+
+import cv2
+import numpy as np
+
+from dtcwt.coeffs import biort as _biort, qshift as _qshift
+from dtcwt.defaults import DEFAULT_BIORT, DEFAULT_QSHIFT
+
+from dtcwt_backends import BACKENDS
+
+
+# Larger stacks mean fewer, bigger NumPy calls but a working set that
+# outgrows the CPU caches at HD sizes; `python -m bench.transforms` measures
+# the trade-off on the current machine
+DEFAULT_BATCH_SIZE = 1
+
+# Tile windows start on multiples of TILE_ALIGN and have the plane's size
+# modulo TILE_ALIGN, so every level pads and decimates like the whole plane.
+# TILE_MARGIN covers the support of the level-2 forward and level-3 inverse
+# filters (the smallest margin that reproduces whole frames exactly).
+TILE_ALIGN = 32
+TILE_MARGIN = 64
+# Peak encode working set per watermarked plane pixel and frame (float32 YUV,
+# complex subbands and the inverse), measured with tracemalloc
+WORKING_SET_BYTES_PER_PIXEL = 48
+
+Tile = namedtuple('Tile', ['rows', 'cols', 'core_rows', 'core_cols'])
+Tile.__doc__ = """Window slices of a tile and the core slices it is exact for, in plane coordinates"""
+
+_WM_CACHE_SIZE = 4
+_wm_highpasses = OrderedDict()  # pattern digest -> level-1 highpass
+
+# Column filters used by forward/inverse, selected with set_backend()
+DEFAULT_BACKEND = 'float32'
+_backend = None
+
+_H0O, _G0O, _H1O, _G1O = _biort(DEFAULT_BIORT)
+_H0A, _H0B, _G0A, _G0B, _H1A, _H1B, _G1A, _G1B = _qshift(DEFAULT_QSHIFT)
+
+
+def set_backend(name=None):
+    """
+    Select the column filter backend of this process (see dtcwt_backends)
+
+    Args:
+        name (str): 'dtcwt' or 'float32' (default: MGHOSTING_DTCWT_BACKEND or DEFAULT_BACKEND)
+
+    Returns:
+        str: Name of the active backend
+    """
+    global _backend
+    name = name or os.environ.get('MGHOSTING_DTCWT_BACKEND') or DEFAULT_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown DTCWT backend: {name} (choose from {', '.join(BACKENDS)})")
+    if _backend is None or _backend.name != name:
+        _backend = BACKENDS[name]()
+    return name
+
+
+def backend_name():
+    """Name of the active backend"""
+    return _backend.name
+
+
+def check_backend(name, height=72, width=88, frames=2, seed=0):
+    """
+    Compare a backend's forward/inverse with dtcwt.Transform2d in float64
+
+    Args:
+        name (str): Backend to check
+        height (int): Test image height
+        width (int): Test image width
+        frames (int): Frames in the test stack
+        seed (int): Random seed of the test images
+
+    Returns:
+        dict: {"backend", "max_error": largest coefficient difference relative to
+            the input range, "reconstruction_error", "tolerance", "passed"}
+    """
+    import dtcwt
+
+    previous = backend_name()
+    stack = np.random.RandomState(seed).uniform(0, 255, (height, width, frames)).astype(np.float32)
+    try:
+        set_backend(name)
+        lowpass, highpasses = forward(stack, nlevels=3)
+        reconstructed = inverse(lowpass, highpasses)
+    finally:
+        set_backend(previous)
+
+    transform = dtcwt.Transform2d()
+    error = 0.0
+    for i in range(frames):
+        reference = transform.forward(stack[:, :, i].astype(np.float64), nlevels=3)
+        error = max(error, float(np.abs(reference.lowpass - lowpass[..., i]).max()))
+        for ref_level, level in zip(reference.highpasses, highpasses):
+            error = max(error, float(np.abs(ref_level - level[..., i]).max()))
+    reconstruction = float(np.abs(reconstructed[:height, :width] - stack).max())
+    # float32 rounding stays far below this; a wrong filter phase or border does not
+    tolerance = 1e-5
+    return {
+        "backend": name,
+        "max_error": error / 255,
+        "reconstruction_error": reconstruction / 255,
+        "tolerance": tolerance,
+        "passed": error / 255 < tolerance and reconstruction / 255 < tolerance
+    }
+
+
+# An unknown MGHOSTING_DTCWT_BACKEND is reported when a processor selects it
+set_backend(os.environ.get('MGHOSTING_DTCWT_BACKEND') if os.environ.get('MGHOSTING_DTCWT_BACKEND') in BACKENDS
+            else DEFAULT_BACKEND)
+
+
+def _complex_type_for(X):
+    return np.complex64 if X.dtype == np.float32 else np.complex128
+
+
+def _q2c(y):
+    """Quads to complex pairs, stacked on axis 2: (2h, 2w, N) -> (h, w, 2, N)"""
+    j2 = (np.sqrt(0.5) * np.array([1, 1j])).astype(_complex_type_for(y))
+    p = y[0::2, 0::2] * j2[0] + y[0::2, 1::2] * j2[1]
+    q = y[1::2, 1::2] * j2[0] - y[1::2, 0::2] * j2[1]
+    return np.stack((p - q, p + q), axis=2)
+
+
+def _c2q(w):
+    """Complex pairs to quads: (h, w, 2, N) -> (2h, 2w, N)"""
+    x = np.zeros((w.shape[0] << 1, w.shape[1] << 1) + w.shape[3:], dtype=w.real.dtype)
+    sc = np.sqrt(0.5)
+    P = w[:, :, 0] * sc + w[:, :, 1] * sc
+    Q = w[:, :, 0] * sc - w[:, :, 1] * sc
+    x[0::2, 0::2] = P.real
+    x[0::2, 1::2] = P.imag
+    x[1::2, 0::2] = Q.imag
+    x[1::2, 1::2] = -Q.real
+    return x
+
+
+def _apply(op, X, axis, *filters):
+    """Backend filter `op` that passes None (an all-zero array) through"""
+    return None if X is None else getattr(_backend, op)(X, axis, *filters)
+
+
+def _add(a, b):
+    """Sum of two optional terms (None stands for an all-zero array)"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
+
+
+def forward(X, nlevels=3, levels=None):
+    """
+    Forward DTCWT of a frame stack
+
+    Args:
+        X (np.ndarray): (height, width, frames) real stack; float32 input stays float32
+        nlevels (int): Decomposition levels (default: 3)
+        levels (set): Zero-based levels whose highpasses are needed (default: all).
+            Other levels only compute the lowpass chain and are returned as None.
+
+    Returns:
+        tuple: (lowpass, highpasses) where lowpass is (h, w, frames) and each
+            highpass level is (h, w, 6, frames), matching Transform2d.forward
+            per frame with the frame axis appended
+    """
+    X = np.asarray(X)
+    if not np.issubdtype(X.dtype, np.floating):
+        X = X.astype(np.float64)
+    if X.ndim == 2:
+        X = X[:, :, np.newaxis]
+    if levels is None:
+        levels = range(nlevels)
+
+    if X.shape[0] % 2 != 0:
+        X = np.concatenate((X, X[-1:]), axis=0)
+    if X.shape[1] % 2 != 0:
+        X = np.concatenate((X, X[:, -1:]), axis=1)
+
+    complex_dtype = _complex_type_for(X)
+    highpasses = []
+
+    Lo = _backend.colfilter(X, 0, _H0O)
+    LoLo = _backend.colfilter(Lo, 1, _H0O)
+    if 0 in levels:
+        Hi = _backend.colfilter(X, 0, _H1O)
+        Yh = np.zeros((LoLo.shape[0] >> 1, LoLo.shape[1] >> 1, 6) + LoLo.shape[2:], dtype=complex_dtype)
+        Yh[:, :, 0:6:5] = _q2c(_backend.colfilter(Hi, 1, _H0O))  # Horizontal pair
+        Yh[:, :, 2:4:1] = _q2c(_backend.colfilter(Lo, 1, _H1O))  # Vertical pair
+        Yh[:, :, 1:5:3] = _q2c(_backend.colfilter(Hi, 1, _H1O))  # Diagonal pair
+        highpasses.append(Yh)
+    else:
+        highpasses.append(None)
+
+    for level in range(1, nlevels):
+        if LoLo.shape[0] % 4 != 0:
+            LoLo = np.concatenate((LoLo[:1], LoLo, LoLo[-1:]), axis=0)
+        if LoLo.shape[1] % 4 != 0:
+            LoLo = np.concatenate((LoLo[:, :1], LoLo, LoLo[:, -1:]), axis=1)
+
+        Lo = _backend.coldfilt(LoLo, 0, _H0B, _H0A)
+        if level in levels:
+            Hi = _backend.coldfilt(LoLo, 0, _H1B, _H1A)
+        LoLo = _backend.coldfilt(Lo, 1, _H0B, _H0A)
+        if level in levels:
+            Yh = np.zeros((LoLo.shape[0] >> 1, LoLo.shape[1] >> 1, 6) + LoLo.shape[2:], dtype=complex_dtype)
+            Yh[:, :, 0:6:5] = _q2c(_backend.coldfilt(Hi, 1, _H0B, _H0A))  # Horizontal
+            Yh[:, :, 2:4:1] = _q2c(_backend.coldfilt(Lo, 1, _H1B, _H1A))  # Vertical
+            Yh[:, :, 1:5:3] = _q2c(_backend.coldfilt(Hi, 1, _H1B, _H1A))  # Diagonal
+            highpasses.append(Yh)
+        else:
+            highpasses.append(None)
+
+    return LoLo, highpasses
+
+
+def highpass_shapes(height, width, nlevels=3):
+    """(h, w) of each highpass level for a height x width input, as produced by forward()"""
+    h, w = height + height % 2, width + width % 2
+    shapes = [(h >> 1, w >> 1)]
+    for _ in range(1, nlevels):
+        h, w = h + h % 4, w + w % 4
+        h, w = h >> 1, w >> 1
+        shapes.append((h >> 1, w >> 1))
+    return shapes
+
+
+def inverse(lowpass, highpasses, shapes=None):
+    """
+    Inverse DTCWT of a frame stack
+
+    Args:
+        lowpass (np.ndarray): (h, w, frames) lowpass, or None for zeros
+        highpasses (list): Per-level (h, w, 6, frames) complex highpasses; None
+            entries are treated as zero subbands and skipped
+        shapes (list): Per-level (h, w) highpass shapes, required when some
+            highpasses are None (see highpass_shapes)
+
+    Returns:
+        np.ndarray: (height, width, frames) reconstruction
+    """
+    if shapes is None:
+        shapes = [Yh.shape[:2] for Yh in highpasses]
+
+    def subbands(Yh):
+        if Yh is None:
+            return None, None, None
+        return _c2q(Yh[:, :, [0, 5]]), _c2q(Yh[:, :, [2, 3]]), _c2q(Yh[:, :, [1, 4]])
+
+    Z = lowpass
+    for level in range(len(highpasses), 1, -1):
+        lh, hl, hh = subbands(highpasses[level - 1])
+        y1 = _add(_apply('colifilt', Z, 0, _G0B, _G0A), _apply('colifilt', lh, 0, _G1B, _G1A))
+        y2 = _add(_apply('colifilt', hl, 0, _G0B, _G0A), _apply('colifilt', hh, 0, _G1B, _G1A))
+        Z = _add(_apply('colifilt', y1, 1, _G0B, _G0A), _apply('colifilt', y2, 1, _G1B, _G1A))
+        if Z is None:
+            continue
+
+        size = shapes[level - 2]
+        if Z.shape[0] != 2 * size[0]:
+            Z = Z[1:-1]
+        if Z.shape[1] != 2 * size[1]:
+            Z = Z[:, 1:-1]
+        if Z.shape[0] != 2 * size[0] or Z.shape[1] != 2 * size[1]:
+            raise ValueError('Sizes of highpasses are not valid for DTWAVEIFM2')
+
+    lh, hl, hh = subbands(highpasses[0])
+    y1 = _add(_apply('colfilter', Z, 0, _G0O), _apply('colfilter', lh, 0, _G1O))
+    y2 = _add(_apply('colfilter', hl, 0, _G0O), _apply('colfilter', hh, 0, _G1O))
+    return _add(_apply('colfilter', y1, 1, _G0O), _apply('colfilter', y2, 1, _G1O))
+
+
+def _bgr_to_yuv(frames):
+    """(N, H, W, 3) uint8 BGR -> (N, H, W, 3) float32 YUV in one cvtColor call"""
+    n, h, w, _ = frames.shape
+    flat = frames.reshape(n * h, w, 3).astype(np.float32)
+    return cv2.cvtColor(flat, cv2.COLOR_BGR2YUV).reshape(n, h, w, 3)
+
+
+def _yuv_to_bgr(yuv):
+    """(N, H, W, 3) float32 YUV -> (N, H, W, 3) uint8 BGR, rounded and clipped like the library"""
+    n, h, w, _ = yuv.shape
+    bgr = cv2.cvtColor(np.ascontiguousarray(yuv).reshape(n * h, w, 3), cv2.COLOR_YUV2BGR)
+    bgr = np.clip(bgr, a_min=0, a_max=255)
+    return np.around(bgr).astype(np.uint8).reshape(n, h, w, 3)
+
+
+def _level3_masks(level2, shape3, step):
+    """
+    Perceptual masks for the level-3 subbands, as in DtcwtKeyEncoder.encode
+
+    Equivalent to ceil(rebin(filter2D(|level 2|, 2x2 mean), level 3 shape) / step)
+    for each of the six orientations of every frame.
+    """
+    mag = np.abs(level2)
+    # filter2D with a 2x2 kernel anchored at (1, 1) averages each sample with
+    # its upper/left neighbours; the border is BORDER_REFLECT_101
+    padded = np.pad(mag, ((1, 0), (1, 0), (0, 0), (0, 0)), mode='reflect')
+    smooth = (padded[:-1, :-1] + padded[:-1, 1:] + padded[1:, :-1] + padded[1:, 1:]) * mag.dtype.type(0.25)
+
+    h3, w3 = shape3
+    if smooth.shape[0] % 2 == 1:
+        smooth = np.concatenate((smooth, np.zeros((1,) + smooth.shape[1:])), axis=0)
+    rows, cols = smooth.shape[:2]
+    binned = smooth.reshape((h3, rows // h3, w3, cols // w3) + smooth.shape[2:]).mean(axis=3).mean(axis=1)
+    return np.ceil(binned / step)
+
+
+def _wm_highpass(wm):
+    """
+    Level-1 highpass of a pattern, remembered per process
+
+    Tile jobs see the same few patterns over and over, each as a new array
+    after pickling, so they are recognized by content.
+    """
+    wm = np.asarray(wm)
+    key = (wm.shape, wm.dtype.str, hashlib.blake2b(wm.tobytes(), digest_size=16).digest())
+    coeff = _wm_highpasses.get(key)
+    if coeff is None:
+        _, (coeff,) = forward(wm.astype(np.float64), nlevels=1)
+        coeff = _wm_highpasses[key] = coeff[:, :, :, 0]
+        while len(_wm_highpasses) > _WM_CACHE_SIZE:
+            _wm_highpasses.popitem(last=False)
+    else:
+        _wm_highpasses.move_to_end(key)
+    return coeff
+
+
+def _tiled_wm_coeffs(wm, shape3, window=None):
+    """
+    Level-1 highpass of a pattern copied into the four corners of a level-3 subband
+
+    Args:
+        wm (np.ndarray): +1/-1 pattern
+        shape3 (tuple): (h3, w3) level-3 subband shape of the whole plane
+        window (tuple): ((top, left), (rows, cols)) in level-3 samples to
+            build only that part of the subband (default: all of it)
+    """
+    coeff = _wm_highpass(wm)
+    h, w = coeff.shape[:2]
+    h3, w3 = shape3
+    (top, left), (rows, cols) = window or ((0, 0), shape3)
+    tiled = np.zeros((rows, cols, 6), dtype=np.complex128)
+    # Later corners overwrite earlier ones where small subbands make them overlap
+    for r0, c0 in ((0, 0), (h3 - h, 0), (0, w3 - w), (h3 - h, w3 - w)):
+        r_lo, r_hi = max(r0, top), min(r0 + h, top + rows)
+        c_lo, c_hi = max(c0, left), min(c0 + w, left + cols)
+        if r_lo < r_hi and c_lo < c_hi:
+            tiled[r_lo - top:r_hi - top, c_lo - left:c_hi - left] = \
+                coeff[r_lo - r0:r_hi - r0, c_lo - c0:c_hi - c0]
+    return tiled
+
+
+def embed_masks(y, step):
+    """
+    Level-3 perceptual masks of a stack of luma planes
+
+    This is the only forward transform embedding needs. It depends on the
+    frames alone, so one result serves every watermark embedded into them.
+
+    Args:
+        y (np.ndarray): (N, h, w) float32 luma at the chroma plane's resolution
+        step (float): Mask quantization step
+
+    Returns:
+        np.ndarray: (h3, w3, 6, N) masks
+    """
+    shapes = highpass_shapes(y.shape[1], y.shape[2])
+    # Masks only need the level-2 highpasses of Y
+    _, y_highpasses = forward(np.moveaxis(y, 0, -1), nlevels=2, levels={1})
+    return _level3_masks(y_highpasses[1], shapes[2], step)
+
+
+def embed_delta(masks, wms, alpha, height, width, tiles=None, plane=None):
+    """
+    Spatial-domain change that embeds patterns into (height, width) chroma planes
+
+    Args:
+        masks (np.ndarray): embed_masks() of the frames
+        wms (list): One +1/-1 pattern per frame; frames of the same fragment
+            should share the same array object so its transform is computed once
+        alpha (float): Embedding scale (encoder.alpha)
+        height (int): Chroma plane height
+        width (int): Chroma plane width
+        tiles (dict): Optional id(wm) -> tiled coefficients cache shared between calls
+        plane (tuple): (height, width, top, left) of the whole plane when the
+            planes are a tile window of it (see tile_plan); the patterns are
+            laid out for the whole plane
+
+    Returns:
+        np.ndarray: (N, height, width) float32 values to add to the chroma planes
+    """
+    shapes = highpass_shapes(height, width)
+    window = None
+    shape3 = shapes[2]
+    if plane is not None:
+        shape3 = highpass_shapes(plane[0], plane[1])[2]
+        window = ((plane[2] // 8, plane[3] // 8), shapes[2])
+    tiles = {} if tiles is None else tiles
+    delta = np.empty(masks.shape, dtype=np.complex64)
+    for i, wm in enumerate(wms):
+        tiled = tiles.get(id(wm))
+        if tiled is None:
+            tiled = tiles[id(wm)] = _tiled_wm_coeffs(wm, shape3, window)
+        delta[..., i] = alpha * (masks[..., i] * tiled)
+
+    # The transform is linear and perfectly reconstructing, so adding the
+    # inverse of the level-3 change to U equals inverse(forward(U) + change)
+    # without transforming U at all
+    u_delta = inverse(None, [None, None, delta], shapes)
+    return np.moveaxis(u_delta[:height, :width], -1, 0)
+
+
+def embed_planes(y, u, wms, alpha, step):
+    """
+    Embed watermark patterns into chroma planes
+
+    Args:
+        y (np.ndarray): (N, h, w) float32 luma at the chroma plane's resolution (mask source)
+        u (np.ndarray): (N, h, w) float32 chroma planes to watermark
+        wms (list): One +1/-1 pattern per frame (see embed_delta)
+        alpha (float): Embedding scale (encoder.alpha)
+        step (float): Mask quantization step
+
+    Returns:
+        np.ndarray: (N, h, w) float32 watermarked chroma planes
+    """
+    height, width = u.shape[1:]
+    return u + embed_delta(embed_masks(y, step), wms, alpha, height, width)
+
+
+def extract_planes(y, u, alpha, step):
+    """
+    Recover the embedded pattern from chroma planes
+
+    Args:
+        y (np.ndarray): (N, h, w) float32 luma at the chroma plane's resolution
+        u (np.ndarray): (N, h, w) float32 watermarked chroma planes
+        alpha (float): Embedding scale (decoder.alpha)
+        step (float): Mask quantization step
+
+    Returns:
+        np.ndarray: (N, wm_h, wm_w) decoded patterns
+    """
+    shapes = highpass_shapes(u.shape[1], u.shape[2])
+
+    _, y_highpasses = forward(np.moveaxis(y, 0, -1), nlevels=2, levels={1})
+    _, u_highpasses = forward(np.moveaxis(u, 0, -1), nlevels=3, levels={2})
+    masks = _level3_masks(y_highpasses[1], shapes[2], step)
+    masks[masks == 0] = 0.01
+
+    coeff = u_highpasses[2] * (1.0 / masks) * (1 / alpha)
+    h, w = (coeff.shape[0] + 1) // 2, (coeff.shape[1] + 1) // 2
+    folded = coeff[:h, :w] + coeff[:h, -w:] + coeff[-h:, :w] + coeff[-h:, -w:]
+    lowpass = np.zeros((h * 2, w * 2, folded.shape[-1]))
+    return np.moveaxis(inverse(lowpass, [folded]), -1, 0)
+
+
+def _untimed(stage):
+    return nullcontext()
+
+
+def encode_batch(frames, wms, alpha, step, timer=None):
+    """
+    Embed watermark patterns into a batch of BGR frames
+
+    Args:
+        frames (np.ndarray): (N, H, W, 3) uint8 BGR frames (or a list of them)
+        wms (list): One +1/-1 pattern per frame (see embed_delta)
+        alpha (float): Embedding scale (encoder.alpha)
+        step (float): Mask quantization step
+        timer (callable): Optional stage timer, timer(name) -> context manager
+            (see profiling.StageTimer); charges 'color' and 'dtcwt'
+
+    Returns:
+        np.ndarray: (N, H, W, 3) uint8 BGR watermarked frames; matches
+            DtcwtKeyEncoder.encode_async up to float32 rounding (an occasional
+            pixel differs by one level)
+    """
+    return encode_batch_multi(frames, [wms], alpha, step, timer)[0][0]
+
+
+def encode_batch_multi(frames, wm_sets, alpha, step, timer=None, masks=None):
+    """
+    Embed several watermarks into the same BGR frames, one output batch per set
+
+    Color conversion and the mask transform run once; each set only adds its
+    own inverse transform and conversion back to BGR.
+
+    Args:
+        frames (np.ndarray): (N, H, W, 3) uint8 BGR frames (or a list of them)
+        wm_sets (list): Per output, one +1/-1 pattern per frame (see embed_delta)
+        alpha (float): Embedding scale (encoder.alpha)
+        step (float): Mask quantization step
+        timer (callable): Optional stage timer (see encode_batch)
+        masks (np.ndarray): embed_masks() of these frames if already known
+            (e.g. from the coefficient cache); computed otherwise
+
+    Returns:
+        tuple: (list of (N, H, W, 3) uint8 BGR batches, one per entry of wm_sets; masks)
+    """
+    timer = timer or _untimed
+    frames = np.asarray(frames)
+    n, height, width = frames.shape[:3]
+    with timer('color'):
+        yuv = _bgr_to_yuv(frames)
+        u = yuv[..., 1].copy()
+    if masks is None:
+        with timer('dtcwt'):
+            masks = embed_masks(yuv[..., 0], step)
+
+    outputs = []
+    tiles = {}
+    for wms in wm_sets:
+        with timer('dtcwt'):
+            yuv[..., 1] = u + embed_delta(masks, wms, alpha, height, width, tiles)
+        with timer('color'):
+            outputs.append(_yuv_to_bgr(yuv))
+    return outputs, masks
+
+
+def decode_batch(frames, alpha, step, timer=None):
+    """
+    Recover the embedded pattern of each BGR frame in a batch
+
+    Args:
+        frames (np.ndarray): (N, H, W, 3) uint8 BGR frames (or a list of them)
+        alpha (float): Embedding scale (decoder.alpha)
+        step (float): Mask quantization step
+        timer (callable): Optional stage timer (see encode_batch)
+
+    Returns:
+        np.ndarray: (N, h, w) decoded patterns, identical to DtcwtKeyDecoder.decode_async
+    """
+    timer = timer or _untimed
+    with timer('color'):
+        yuv = _bgr_to_yuv(np.asarray(frames))
+    with timer('dtcwt'):
+        return extract_planes(yuv[..., 0], yuv[..., 1], alpha, step)
+
+
+def split_yuv420(frames):
+    """
+    Plane views of raw planar YUV 4:2:0 frames
+
+    Args:
+        frames (np.ndarray): (N, H * 3 // 2, W) uint8 frames as read with pix_fmt yuv420p
+
+    Returns:
+        tuple: (y, u, v) views shaped (N, H, W), (N, H/2, W/2), (N, H/2, W/2)
+    """
+    n, rows, width = frames.shape
+    height = rows * 2 // 3
+    flat = frames.reshape(n, rows * width)
+    luma = height * width
+    chroma = luma // 4
+    y = flat[:, :luma].reshape(n, height, width)
+    u = flat[:, luma:luma + chroma].reshape(n, height // 2, width // 2)
+    v = flat[:, luma + chroma:].reshape(n, height // 2, width // 2)
+    return y, u, v
+
+
+def _luma_at_chroma(y):
+    """2x2 box-downsample uint8 luma to float32 at the 4:2:0 chroma resolution"""
+    y = y.astype(np.float32)
+    return (y[:, 0::2, 0::2] + y[:, 0::2, 1::2] + y[:, 1::2, 0::2] + y[:, 1::2, 1::2]) * np.float32(0.25)
+
+
+def encode_batch_yuv420(frames, wms, alpha, step, timer=None):
+    """
+    Embed watermark patterns into raw YUV 4:2:0 frames at chroma resolution
+
+    Only the U plane is converted to float and rewritten; Y and V are passed
+    through untouched. The mask is taken from luma averaged down to the
+    chroma grid, so patterns have infer_wm_shape((H // 2, W // 2)).
+
+    Args:
+        frames (np.ndarray): (N, H * 3 // 2, W) uint8 frames (or a list of them)
+        wms (list): One +1/-1 pattern per frame (see embed_delta)
+        alpha (float): Embedding scale (encoder.alpha)
+        step (float): Mask quantization step
+        timer (callable): Optional stage timer (see encode_batch)
+
+    Returns:
+        np.ndarray: Watermarked frames in the same layout
+    """
+    return encode_batch_multi_yuv420(frames, [wms], alpha, step, timer)[0][0]
+
+
+def encode_batch_multi_yuv420(frames, wm_sets, alpha, step, timer=None, masks=None):
+    """
+    Embed several watermarks into the same YUV 4:2:0 frames, one output batch per set
+
+    Args:
+        frames (np.ndarray): (N, H * 3 // 2, W) uint8 frames (or a list of them)
+        wm_sets (list): Per output, one +1/-1 pattern per frame (see embed_delta)
+        alpha (float): Embedding scale (encoder.alpha)
+        step (float): Mask quantization step
+        timer (callable): Optional stage timer (see encode_batch)
+        masks (np.ndarray): embed_masks() of these frames if already known
+
+    Returns:
+        tuple: (list of watermarked batches in the input layout, one per entry of wm_sets; masks)
+    """
+    timer = timer or _untimed
+    with timer('color'):
+        frames = np.asarray(frames, dtype=np.uint8)
+        y, u, _ = split_yuv420(frames)
+        chroma = u.astype(np.float32)
+    if masks is None:
+        with timer('dtcwt'):
+            masks = embed_masks(_luma_at_chroma(y), step)
+
+    outputs = []
+    tiles = {}
+    for wms in wm_sets:
+        with timer('dtcwt'):
+            marked = chroma + embed_delta(masks, wms, alpha, chroma.shape[1], chroma.shape[2], tiles)
+        with timer('color'):
+            out = frames.copy()
+            split_yuv420(out)[1][...] = np.around(np.clip(marked, 0, 255))
+        outputs.append(out)
+    return outputs, masks
+
+
+def decode_batch_yuv420(frames, alpha, step, timer=None):
+    """
+    Recover the embedded pattern of each raw YUV 4:2:0 frame in a batch
+
+    Args:
+        frames (np.ndarray): (N, H * 3 // 2, W) uint8 frames (or a list of them)
+        alpha (float): Embedding scale (decoder.alpha)
+        step (float): Mask quantization step
+        timer (callable): Optional stage timer (see encode_batch)
+
+    Returns:
+        np.ndarray: (N, h, w) decoded patterns
+    """
+    timer = timer or _untimed
+    with timer('color'):
+        y, u, _ = split_yuv420(np.asarray(frames))
+        luma, chroma = _luma_at_chroma(y), u.astype(np.float32)
+    with timer('dtcwt'):
+        return extract_planes(luma, chroma, alpha, step)
+
+
+def _tile_spans(size, tile):
+    """(window, core) slice pairs covering one axis of a plane"""
+    spans = []
+    for start in range(0, size, tile):
+        stop = min(size, start + tile)
+        lo = max(0, start - TILE_MARGIN)
+        # Windows that stop inside the plane end with its remainder modulo
+        # TILE_ALIGN, so they pad at every level exactly like the plane
+        hi = size if stop == size else min(size, stop + TILE_MARGIN + size % TILE_ALIGN)
+        spans.append((slice(lo, hi), slice(start, stop)))
+    return spans
+
+
+def tile_plan(height, width, tile):
+    """
+    Overlapping tiles covering a height x width plane, in row-major order
+
+    Args:
+        height (int): Watermarked plane height (the frame for BGR, the U plane for 4:2:0)
+        width (int): Watermarked plane width
+        tile (int): Core side in pixels, rounded down to a multiple of TILE_ALIGN
+
+    Returns:
+        list: Tile tuples; the cores partition the plane
+    """
+    tile = max(TILE_ALIGN, int(tile) // TILE_ALIGN * TILE_ALIGN)
+    return [Tile(rows, cols, core_rows, core_cols)
+            for rows, core_rows in _tile_spans(height, tile)
+            for cols, core_cols in _tile_spans(width, tile)]
+
+
+def tile_size_for_budget(budget_bytes, frames=1):
+    """
+    Largest tile core side whose window working set fits a memory budget
+
+    Args:
+        budget_bytes (float): Working set allowed for one tile job
+        frames (int): Frames transformed together (the batch size)
+
+    Returns:
+        int: Core side in pixels, a multiple of TILE_ALIGN (at least two of them)
+    """
+    side = int((budget_bytes / (WORKING_SET_BYTES_PER_PIXEL * max(1, frames))) ** 0.5)
+    core = (side - 2 * TILE_MARGIN - TILE_ALIGN) // TILE_ALIGN * TILE_ALIGN
+    return max(2 * TILE_ALIGN, core)
+
+
+def _core(tile):
+    """Slices of a tile's core within its window, for (N, rows, cols, ...) stacks"""
+    return (slice(None),
+            slice(tile.core_rows.start - tile.rows.start, tile.core_rows.stop - tile.rows.start),
+            slice(tile.core_cols.start - tile.cols.start, tile.core_cols.stop - tile.cols.start))
+
+
+def encode_tile(frames, wm_sets, alpha, step, plane, tile, timer=None):
+    """
+    Embed several watermarks into one tile of larger BGR frames
+
+    Args:
+        frames (np.ndarray): (N, rows, cols, 3) uint8 BGR pixels of the tile window
+        wm_sets (list): Per output, one +1/-1 pattern per frame laid out for the
+            whole frame (see embed_delta)
+        alpha (float): Embedding scale (encoder.alpha)
+        step (float): Mask quantization step
+        plane (tuple): (H, W) of the whole frames
+        tile (Tile): The tile, from tile_plan(H, W, ...)
+        timer (callable): Optional stage timer (see encode_batch)
+
+    Returns:
+        list: (N, core rows, core cols, 3) uint8 BGR cores, one per entry of
+            wm_sets, equal to the same region of encode_batch_multi's output
+    """
+    timer = timer or _untimed
+    frames = np.asarray(frames)
+    height, width = frames.shape[1:3]
+    core = _core(tile)
+    origin = tuple(plane) + (tile.rows.start, tile.cols.start)
+    with timer('color'):
+        yuv = _bgr_to_yuv(frames)
+    with timer('dtcwt'):
+        masks = embed_masks(yuv[..., 0], step)
+    yuv_core = yuv[core].copy()
+    u = yuv_core[..., 1].copy()
+
+    outputs = []
+    tiles = {}
+    for wms in wm_sets:
+        with timer('dtcwt'):
+            yuv_core[..., 1] = u + embed_delta(masks, wms, alpha, height, width, tiles, origin)[core]
+        with timer('color'):
+            outputs.append(_yuv_to_bgr(yuv_core))
+    return outputs
+
+
+def encode_tile_yuv420(y, u, wm_sets, alpha, step, plane, tile, timer=None):
+    """
+    Embed several watermarks into one tile of larger raw YUV 4:2:0 frames
+
+    Args:
+        y (np.ndarray): (N, 2 * rows, 2 * cols) uint8 luma under the tile window
+        u (np.ndarray): (N, rows, cols) uint8 U pixels of the tile window
+        wm_sets (list): Per output, one +1/-1 pattern per frame laid out for the
+            whole U plane (see embed_delta)
+        alpha (float): Embedding scale (encoder.alpha)
+        step (float): Mask quantization step
+        plane (tuple): (H // 2, W // 2) of the whole U planes
+        tile (Tile): The tile, from tile_plan(H // 2, W // 2, ...)
+        timer (callable): Optional stage timer (see encode_batch)
+
+    Returns:
+        list: (N, core rows, core cols) uint8 U cores, one per entry of wm_sets
+    """
+    timer = timer or _untimed
+    height, width = u.shape[1:]
+    core = _core(tile)
+    origin = tuple(plane) + (tile.rows.start, tile.cols.start)
+    with timer('color'):
+        chroma = u[core].astype(np.float32)
+    with timer('dtcwt'):
+        masks = embed_masks(_luma_at_chroma(y), step)
+
+    outputs = []
+    tiles = {}
+    for wms in wm_sets:
+        with timer('dtcwt'):
+            marked = chroma + embed_delta(masks, wms, alpha, height, width, tiles, origin)[core]
+        with timer('color'):
+            outputs.append(np.around(np.clip(marked, 0, 255)).astype(np.uint8))
+    return outputs
+
+
+def tile_inputs(frames, tile, yuv420=False):
+    """
+    Pixels of a batch a tile job needs, as contiguous arrays
+
+    Returns:
+        tuple: (BGR window,) or, with yuv420, (luma window, U window)
+    """
+    if yuv420:
+        y, u, _ = split_yuv420(frames)
+        luma = slice(2 * tile.rows.start, 2 * tile.rows.stop), slice(2 * tile.cols.start, 2 * tile.cols.stop)
+        return (np.ascontiguousarray(y[:, luma[0], luma[1]]),
+                np.ascontiguousarray(u[:, tile.rows, tile.cols]))
+    return (np.ascontiguousarray(frames[:, tile.rows, tile.cols]),)
+
+
+def tiled_outputs(frames, count, yuv420=False):
+    """Output batches for `count` watermarks that place_tile() fills in"""
+    if yuv420:
+        return [frames.copy() for _ in range(count)]
+    return [np.empty_like(frames) for _ in range(count)]
+
+
+def place_tile(outputs, tile, cores, yuv420=False):
+    """Write the cores returned by encode_tile(_yuv420) into their output batches"""
+    for out, core in zip(outputs, cores):
+        target = split_yuv420(out)[1] if yuv420 else out
+        target[:, tile.core_rows, tile.core_cols] = core
+
+
+def encode_batch_tiled(frames, wm_sets, alpha, step, tile, timer=None, yuv420=False):
+    """
+    encode_batch_multi (or, with yuv420, encode_batch_multi_yuv420) one tile at a time
+
+    Args:
+        frames (np.ndarray): Batch in the layout of the untiled function
+        tile (int): Tile core side in pixels (see tile_plan)
+        (other arguments as for encode_batch_multi)
+
+    Returns:
+        list: Watermarked batches, one per entry of wm_sets
+    """
+    frames = np.asarray(frames, dtype=np.uint8)
+    if yuv420:
+        plane = split_yuv420(frames)[1].shape[1:]
+    else:
+        plane = frames.shape[1:3]
+    encode = encode_tile_yuv420 if yuv420 else encode_tile
+    outputs = tiled_outputs(frames, len(wm_sets), yuv420)
+    for t in tile_plan(plane[0], plane[1], tile):
+        cores = encode(*tile_inputs(frames, t, yuv420), wm_sets, alpha, step, plane, t, timer)
+        place_tile(outputs, t, cores, yuv420)
+    return outputs
+
+
+def iter_batches(items, batch_size):
+    """Group an iterable into lists of at most batch_size items"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
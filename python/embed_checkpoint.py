@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Embed Checkpoints
+Resumable fragment segments for long key-based embeds
+
+A resumable embed encodes every fragment as its own segment: a complete MP4
+that starts on a keyframe and can be decoded on its own. A segment is written
+under a temporary name and renamed once its encoder has exited cleanly, so a
+file with the final name is always finished. The manifest records the job
+(the input content hash and every parameter that changes the output), the
+fragment layout, and the fragment indices known to be done.
+
+A later run of the same job finds the same directory, skips the finished
+fragments and only concatenates at the end. A crash therefore loses at most
+the fragment each worker was encoding at the time.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+
+from app_paths import default_cache_dir
+
+
+FORMAT_VERSION = 1
+MAX_AGE_DAYS = 7  # abandoned checkpoints older than this are deleted
+
+_SEGMENT_NAME = re.compile(r"^fragment_(\d{6})\.mp4$")
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class EmbedCheckpoint:
+    """Segment files and manifest of one resumable embed job"""
+
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.manifest = manifest
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+
+    def segment_path(self, index):
+        """Final path of fragment `index`"""
+        return os.path.join(self.directory, f"fragment_{index:06d}.mp4")
+
+    def partial_path(self, index):
+        """Path a worker encodes fragment `index` to before publishing it"""
+        return os.path.join(self.directory, f"fragment_{index:06d}.{os.getpid()}.part.mp4")
+
+    def completed(self):
+        """Indices of fragments whose segment has been published"""
+        done = set()
+        for name in os.listdir(self.directory):
+            match = _SEGMENT_NAME.match(name)
+            if match and os.path.getsize(os.path.join(self.directory, name)) > 0:
+                done.add(int(match.group(1)))
+        return done
+
+    def mark_done(self, indices):
+        """Record finished fragments in the manifest"""
+        done = set(self.manifest['done'])
+        done.update(int(i) for i in indices)
+        self.manifest['done'] = sorted(done)
+        self.manifest['updated'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        _write_json(self.manifest_path, self.manifest)
+
+    def remove(self):
+        """Delete the checkpoint (after the output has been stitched)"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class CheckpointStore:
+    """Checkpoint directories of resumable embeds, keyed by input and parameters"""
+
+    def __init__(self, cache_dir=None):
+        """
+        Initialize store
+
+        Args:
+            cache_dir (str): Root cache directory (default: default_cache_dir())
+        """
+        self.directory = os.path.join(cache_dir or default_cache_dir(), 'checkpoints')
+
+    @staticmethod
+    def job_key(params):
+        """Stable key of a job's parameter dict (which includes the input digest)"""
+        text = json.dumps(params, sort_keys=True)
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+    def open(self, params, fragments):
+        """
+        Return the checkpoint of a job, reusing a matching one from an earlier run
+
+        Args:
+            params (dict): Input content hash and every output-affecting parameter
+            fragments (int): Number of fragments in the job
+
+        Returns:
+            EmbedCheckpoint: With leftover partial segments removed
+        """
+        key = self.job_key(params)
+        directory = os.path.join(self.directory, key)
+        self.prune(keep=key)
+
+        manifest = None
+        try:
+            with open(os.path.join(directory, 'manifest.json'), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if (not manifest or manifest.get('version') != FORMAT_VERSION
+                or manifest.get('params') != params or manifest.get('fragments') != fragments):
+            shutil.rmtree(directory, ignore_errors=True)
+            manifest = None
+
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith('.part.mp4'):
+                # Encoder was killed mid-fragment
+                os.remove(os.path.join(directory, name))
+
+        now = time.strftime('%Y-%m-%dT%H:%M:%S')
+        if manifest is None:
+            manifest = {
+                "version": FORMAT_VERSION,
+                "key": key,
+                "params": params,
+                "fragments": fragments,
+                "done": [],
+                "created": now
+            }
+        checkpoint = EmbedCheckpoint(directory, manifest)
+        # Segments published after the last manifest update count as well
+        manifest['done'] = sorted(checkpoint.completed())
+        manifest['updated'] = now
+        _write_json(checkpoint.manifest_path, manifest)
+        return checkpoint
+
+    def prune(self, max_age_days=MAX_AGE_DAYS, keep=None):
+        """Delete checkpoints not touched for `max_age_days`"""
+        if not os.path.isdir(self.directory):
+            return
+        cutoff = time.time() - max_age_days * 86400
+        for key in os.listdir(self.directory):
+            if key == keep:
+                continue
+            path = os.path.join(self.directory, key)
+            try:
+                last_used = os.path.getmtime(os.path.join(path, 'manifest.json'))
+            except OSError:
+                last_used = os.path.getmtime(path)
+            if last_used < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
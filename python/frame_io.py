@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Frame I/O
+Raw frame decoding and encoding through FFmpeg pipes
+
+The reader decodes a video to raw frames on stdout. The writer encodes raw
+frames from stdin and maps the audio of the original file in the same FFmpeg
+invocation, so no temporary video or second remux pass is needed.
+"""
+
+import subprocess
+import threading
+from collections import deque
+
+import numpy as np
+
+
+# Defaults for the output encoder (overridable per job)
+DEFAULT_VIDEO_CODEC = 'libx264'
+DEFAULT_PRESET = 'veryfast'
+DEFAULT_CRF = 18
+
+
+def frame_shape(width, height, pix_fmt):
+    """Array shape of one raw frame: (H, W, 3) for bgr24, (H * 3 // 2, W) for yuv420p"""
+    if pix_fmt == 'bgr24':
+        return (height, width, 3)
+    if pix_fmt == 'yuv420p':
+        if width % 2 or height % 2:
+            raise ValueError(f"yuv420p frames need even dimensions, got {width}x{height}")
+        return (height * 3 // 2, width)
+    raise ValueError(f"Unsupported raw pixel format: {pix_fmt}")
+
+
+class FFmpegError(RuntimeError):
+    """Raised when an FFmpeg pipe process fails"""
+
+
+class _StderrTail:
+    """Drain a process's stderr on a thread, keeping the last lines for error messages"""
+
+    def __init__(self, stream, max_lines=20):
+        self.lines = deque(maxlen=max_lines)
+        self._thread = threading.Thread(target=self._drain, args=(stream,), daemon=True)
+        self._thread.start()
+
+    def _drain(self, stream):
+        for line in iter(stream.readline, b''):
+            self.lines.append(line.decode('utf-8', errors='replace').rstrip())
+        stream.close()
+
+    def text(self):
+        self._thread.join(timeout=1)
+        return '\n'.join(self.lines)
+
+
+class FFmpegFrameReader:
+    """Iterate over the frames of a video as uint8 arrays shaped by frame_shape()"""
+
+    def __init__(self, ffmpeg_path, video_path, width, height, pix_fmt='bgr24', start=None, frames=None):
+        """
+        Initialize reader
+
+        Args:
+            ffmpeg_path (str): FFmpeg executable
+            video_path (str): Input video file path
+            width (int): Frame width
+            height (int): Frame height
+            pix_fmt (str): Raw output pixel format, bgr24 or yuv420p (default: bgr24)
+            start (float): Input-side seek position in seconds (optional)
+            frames (int): Stop after this many frames (optional)
+        """
+        self.width = width
+        self.height = height
+        self.shape = frame_shape(width, height, pix_fmt)
+        self.frame_bytes = int(np.prod(self.shape))
+        cmd = [
+            ffmpeg_path,
+            '-v', 'error',
+            '-noautorotate',     # Keep frames in stream orientation (matches OpenCV metadata)
+        ]
+        if start:
+            cmd += ['-ss', f'{max(0.0, start):.6f}']
+        cmd += [
+            '-i', video_path,
+            '-map', '0:v:0',
+        ]
+        if start:
+            # The first frame after a seek is stamped a little after the seek
+            # point; constant frame rate output would repeat it to fill the gap
+            cmd += ['-vsync', 'passthrough']
+        if frames is not None:
+            cmd += ['-frames:v', str(int(frames))]
+        cmd += [
+            '-f', 'rawvideo',
+            '-pix_fmt', pix_fmt,
+            '-'
+        ]
+        self.process = subprocess.Popen(
+            cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            bufsize=self.frame_bytes
+        )
+        self._stderr = _StderrTail(self.process.stderr)
+
+    def __iter__(self):
+        try:
+            while True:
+                data = self.process.stdout.read(self.frame_bytes)
+                if len(data) < self.frame_bytes:
+                    break
+                yield np.frombuffer(data, dtype=np.uint8).reshape(self.shape)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FFmpegFrameWriter:
+    """Encode raw frames into a video file, copying audio from the source in the same pass"""
+
+    def __init__(self, ffmpeg_path, output_path, width, height, fps, audio_source=None,
+                 video_codec=DEFAULT_VIDEO_CODEC, preset=DEFAULT_PRESET, crf=DEFAULT_CRF, threads=0,
+                 pix_fmt='bgr24', audio_codec='copy'):
+        """
+        Initialize writer
+
+        Args:
+            ffmpeg_path (str): FFmpeg executable
+            output_path (str): Output video file path
+            width (int): Frame width
+            height (int): Frame height
+            fps (float): Frame rate
+            audio_source (str): File whose first audio stream is copied (optional)
+            video_codec (str): FFmpeg video encoder (default: libx264)
+            preset (str): Encoder preset (default: veryfast)
+            crf (int): Constant rate factor (default: 18)
+            threads (int): Encoder threads, 0 = FFmpeg decides (default: 0)
+            pix_fmt (str): Raw input pixel format, bgr24 or yuv420p (default: bgr24)
+            audio_codec (str): Codec for the mapped audio stream (default: copy)
+        """
+        self.output_path = output_path
+        self.frame_bytes = int(np.prod(frame_shape(width, height, pix_fmt)))
+        self.frames_written = 0
+
+        cmd = [
+            ffmpeg_path,
+            '-v', 'error',
+            '-y',
+            '-f', 'rawvideo',
+            '-pix_fmt', pix_fmt,
+            '-s', f'{width}x{height}',
+            '-r', repr(float(fps)),
+            '-i', '-'
+        ]
+        if audio_source:
+            cmd += ['-i', audio_source, '-map', '0:v:0', '-map', '1:a:0?', '-c:a', audio_codec, '-shortest']
+
+        # 4:2:0 needs even dimensions; fall back to 4:4:4 otherwise
+        out_pix_fmt = 'yuv420p' if width % 2 == 0 and height % 2 == 0 else 'yuv444p'
+        cmd += ['-c:v', video_codec, '-pix_fmt', out_pix_fmt, '-threads', str(int(threads))]
+        if video_codec in ('libx264', 'libx265'):
+            cmd += ['-preset', preset, '-crf', str(crf)]
+        cmd.append(output_path)
+
+        self.command = cmd
+        self.process = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            bufsize=self.frame_bytes
+        )
+        self._stderr = _StderrTail(self.process.stderr)
+
+    def write(self, frame):
+        """Write one uint8 frame in the writer's raw pixel format"""
+        try:
+            self.process.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+        except (BrokenPipeError, OSError):
+            self.process.wait()
+            raise FFmpegError(f"FFmpeg encoder exited early: {self._stderr.text()[-500:]}")
+        self.frames_written += 1
+
+    def close(self):
+        """Finish encoding; raises FFmpegError if FFmpeg failed"""
+        try:
+            self.process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        returncode = self.process.wait()
+        if returncode != 0:
+            raise FFmpegError(f"FFmpeg encoder failed (code {returncode}): {self._stderr.text()[-500:]}")
+
+    def abort(self):
+        """Stop encoding without waiting for a valid file"""
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
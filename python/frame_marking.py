@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Frame Marking
+Which frames of each fragment carry the watermark
+
+By default every frame of every fragment goes through the forward DTCWT,
+the embedding and the inverse transform, although detection only needs
+enough frames per fragment for the key correlation to settle. A sparse
+marking watermarks a subset of each fragment instead:
+
+    every=k          frames 0, k, 2k, ... of each fragment
+    per_fragment=k   k frames spread evenly over each fragment
+
+The other frames go to the encoder untouched. Positions are counted from
+the first frame of each fragment (fragment f starts at frame
+ceil(f * frag_frames), as the chunked embedding cuts them), so the marked
+set does not depend on where a chunk or a seek starts. Detection builds the
+same FrameMarking from the same arguments, skips the unmarked frames before
+any transform and rescales the fragment sums to full-fragment equivalents,
+so DETECTION_THRESHOLD keeps its meaning.
+
+Detectors cut fragments on that same grid (fragment_of, fragment_bounds):
+with a fractional fps * frag_length, as at 29.97 fps, cutting
+on int(fps * frag_length) frames drifts a whole fragment every few dozen.
+"""
+
+import math
+
+
+def fragment_bounds(fragment, frag_frames):
+    """(first frame, end frame) of a fragment on the grid of `frag_frames` (fps * frag_length) frames"""
+    return (int(math.ceil(fragment * frag_frames)),
+            int(math.ceil((fragment + 1) * frag_frames)))
+
+
+def fragment_of(index, frag_frames):
+    """Fragment frame `index` belongs to, as the embedders assign it"""
+    return int(index // frag_frames)
+
+
+def fragment_count(frames, frag_frames):
+    """Number of whole fragments in the first `frames` frames"""
+    count = int(frames // frag_frames)
+    while count and fragment_bounds(count - 1, frag_frames)[1] > frames:
+        count -= 1
+    while fragment_bounds(count, frag_frames)[1] <= frames:
+        count += 1
+    return count
+
+
+class FrameMarking:
+    """Marked frame positions for a fragment length in frames"""
+
+    def __init__(self, frag_frames, every=None, per_fragment=None):
+        """
+        Initialize marking
+
+        Args:
+            frag_frames (float): Fragment length in frames (fps * frag_length)
+            every (int): Mark every k-th frame of each fragment
+            per_fragment (int): Mark k evenly spaced frames of each fragment
+        """
+        if every and per_fragment:
+            raise ValueError("Set either mark_every or mark_per_fragment, not both")
+        if (every is not None and int(every) < 1) or (per_fragment is not None and int(per_fragment) < 1):
+            raise ValueError("Frame marking counts must be at least 1")
+        self.frag_frames = float(frag_frames)
+        self.every = int(every) if every else None
+        self.per_fragment = int(per_fragment) if per_fragment else None
+        self._positions = {}
+
+    @classmethod
+    def from_args(cls, frag_frames, every=None, per_fragment=None):
+        """FrameMarking for job arguments, or None when every frame is marked"""
+        marking = cls(frag_frames, every, per_fragment)
+        if marking.every in (None, 1) and marking.per_fragment is None:
+            return None
+        return marking
+
+    def fragment_bounds(self, fragment):
+        """(first frame, end frame) of a fragment"""
+        return fragment_bounds(fragment, self.frag_frames)
+
+    def positions(self, length):
+        """Sorted marked positions inside a fragment of `length` frames"""
+        if length not in self._positions:
+            if self.every:
+                marked = range(0, length, self.every)
+            else:
+                k = min(self.per_fragment, length)
+                # Centred in k equal parts of the fragment
+                marked = sorted({int((j + 0.5) * length / k) for j in range(k)})
+            self._positions[length] = frozenset(marked), list(marked)
+        return self._positions[length][1]
+
+    def marked(self, index):
+        """Whether frame `index` carries the watermark"""
+        fragment = fragment_of(index, self.frag_frames)
+        start, end = self.fragment_bounds(fragment)
+        self.positions(end - start)
+        return index - start in self._positions[end - start][0]
+
+    def count(self, start, end):
+        """Number of marked frames in [start, end)"""
+        return sum(1 for i in range(start, end) if self.marked(i))
+
+    def to_dict(self):
+        return {"every": self.every} if self.every else {"per_fragment": self.per_fragment}
+
+
+def marked_spans(frames, marking, batch_size, start=0):
+    """
+    Group a frame stream into spans holding `batch_size` marked frames each
+
+    Args:
+        frames (iterable): Frames in source order
+        marking (FrameMarking): Marked positions
+        batch_size (int): Marked frames per span
+        start (int): Source index of the first frame
+
+    Yields:
+        tuple: (source index of the span's first frame, list of frames,
+            indices into that list of the marked frames); the last span may
+            hold fewer marked frames, or none
+    """
+    span, marked = [], []
+    index = start
+    for frame in frames:
+        if marking.marked(index):
+            marked.append(len(span))
+        span.append(frame)
+        index += 1
+        if len(marked) == batch_size:
+            yield index - len(span), span, marked
+            span, marked = [], []
+    if span:
+        yield index - len(span), span, marked
+
+
+def fragment_scales(frag_frames, seen, marking=None):
+    """
+    Factors that turn per-fragment correlation sums into full-fragment sums
+
+    DETECTION_THRESHOLD is defined on sums over int(fps * frag_length)
+    frames, so every fragment is scaled to that many, whether the grid gave
+    it the rounded-down or the rounded-up frame count.
+
+    Args:
+        frag_frames (float): Fragment length in frames, fps * frag_length
+        seen (list): Frames summed into each fragment, in fragment order
+        marking (FrameMarking): Marking the frames were selected by (None = all)
+
+    Returns:
+        list: int(frag_frames) / frames summed for each fragment of the
+            leading run whose frames were all read; later fragments are incomplete
+    """
+    full_frames = max(1, int(frag_frames))
+    scales = []
+    for fragment, n in enumerate(seen):
+        start, end = fragment_bounds(fragment, frag_frames)
+        expected = marking.count(start, end) if marking is not None else end - start
+        if n == 0 or n < expected:
+            break
+        scales.append(full_frames / n)
+    return scales
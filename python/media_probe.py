@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Media Probe
+Video and audio stream metadata from a single ffprobe call
+
+probe() returns codec, dimensions, frame rate, frame count, duration and the
+first audio stream of a file. Results are cached in memory by (path, size,
+mtime), so within one process (a CLI run or the persistent serve worker)
+each file is probed once until it changes.
+
+Without ffprobe the video stream is read with one OpenCV open and the audio
+stream from the banner FFmpeg prints for `ffmpeg -i`.
+"""
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+from collections import OrderedDict
+from fractions import Fraction
+from pathlib import Path
+
+
+CACHE_SIZE = 256
+PROBE_TIMEOUT = 30
+
+_cache = OrderedDict()  # (path, size, mtime_ns) -> info
+_lock = threading.Lock()
+
+
+class ProbeError(Exception):
+    """The file could not be probed as a video"""
+
+
+def find_ffmpeg():
+    """Find FFmpeg executable: on PATH, bundled, or in a common location ('ffmpeg' if none)"""
+    # Check if ffmpeg is in PATH
+    ffmpeg_exe = shutil.which('ffmpeg')
+    if ffmpeg_exe:
+        return ffmpeg_exe
+    
+    # Check bundled FFmpeg (relative to script location)
+    script_dir = Path(__file__).parent.parent
+    bundled_paths = [
+        script_dir / 'ffmpeg' / 'bin' / 'ffmpeg.exe',  # Project bundled (Windows)
+        script_dir / 'ffmpeg' / 'bin' / 'ffmpeg',      # Project bundled (Linux/macOS)
+        Path('C:/ffmpeg/bin/ffmpeg.exe'),              # Common Windows location
+        Path('/usr/bin/ffmpeg'),                        # Common Linux location
+    ]
+    
+    for path in bundled_paths:
+        if path.exists():
+            return str(path)
+    
+    # Fallback to 'ffmpeg' and hope it's in PATH
+    return 'ffmpeg'
+
+
+def find_ffprobe(ffmpeg_path=None):
+    """
+    Locate ffprobe: next to the FFmpeg executable in use, on PATH, or bundled
+
+    Returns:
+        str: ffprobe path, or None if there is none
+    """
+    candidates = []
+    if ffmpeg_path and os.path.dirname(ffmpeg_path):
+        name = os.path.basename(ffmpeg_path).replace('ffmpeg', 'ffprobe')
+        candidates.append(os.path.join(os.path.dirname(ffmpeg_path), name))
+    script_dir = Path(__file__).parent.parent
+    candidates += [
+        shutil.which('ffprobe'),
+        str(script_dir / 'ffmpeg' / 'bin' / 'ffprobe.exe'),
+        str(script_dir / 'ffmpeg' / 'bin' / 'ffprobe'),
+        'C:/ffmpeg/bin/ffprobe.exe',
+    ]
+    for path in candidates:
+        if path and os.path.isfile(path):
+            return path
+    return None
+
+
+def _rate(text):
+    """'30000/1001' -> 29.97..., 0.0 for missing or invalid rates"""
+    try:
+        rate = Fraction(text)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return 0.0
+    return float(rate) if rate > 0 else 0.0
+
+
+def _number(value, kind=float):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _from_ffprobe(data):
+    """Build the probe result from ffprobe's -show_streams -show_format JSON"""
+    streams = data.get('streams') or []
+    fmt = data.get('format') or {}
+    video = next((s for s in streams if s.get('codec_type') == 'video'
+                  and not (s.get('disposition') or {}).get('attached_pic')), None)
+    if video is None:
+        raise ProbeError("No video stream found")
+
+    # Like OpenCV (av_guess_frame_rate): the nominal rate, unless the average
+    # shows it is a timebase-like overestimate
+    r_rate, avg_rate = _rate(video.get('r_frame_rate')), _rate(video.get('avg_frame_rate'))
+    fps = r_rate if r_rate and not (avg_rate and r_rate > 1.5 * avg_rate) else avg_rate
+
+    duration = _number(video.get('duration')) or _number(fmt.get('duration')) or 0.0
+    frame_count = _number(video.get('nb_frames'), int)
+    if not frame_count:
+        frame_count = int(round(duration * fps)) if fps else 0
+
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+    return {
+        "width": int(video.get('width') or 0),
+        "height": int(video.get('height') or 0),
+        "fps": fps,
+        "frame_count": frame_count,
+        "duration": duration,
+        "codec": video.get('codec_name'),
+        "pix_fmt": video.get('pix_fmt'),
+        "bit_rate": _number(fmt.get('bit_rate'), int),
+        "audio": {
+            "codec": audio.get('codec_name') or 'unknown',
+            "sample_rate": audio.get('sample_rate') or '44100',
+            "channels": str(audio.get('channels') or '2'),
+            "bitrate": audio.get('bit_rate') or 'N/A'
+        } if audio else None,
+        "probe": "ffprobe"
+    }
+
+
+_CHANNELS = {'mono': '1', 'stereo': '2', '5.1': '6', '5.1(side)': '6', '7.1': '8'}
+
+
+def _audio_from_banner(ffmpeg_path, video_path):
+    """First audio stream as reported by `ffmpeg -i` (exit code 1 is expected)"""
+    result = subprocess.run([ffmpeg_path, '-hide_banner', '-i', video_path],
+                            capture_output=True, text=True, timeout=PROBE_TIMEOUT)
+    for line in result.stderr.splitlines():
+        # Stream #0:1[0x2](und): Audio: aac (LC) (mp4a / 0x6134706D), 48000 Hz, stereo, fltp, 128 kb/s
+        codec = re.search(r"Stream #\d+:\d+.*: Audio: (\w+)", line)
+        if not codec:
+            continue
+        fields = [f.strip() for f in line.split(',')]
+        rate = next((i for i, f in enumerate(fields) if f.endswith(' Hz')), None)
+        layout = fields[rate + 1] if rate is not None and rate + 1 < len(fields) else ''
+        kbps = re.search(r"(\d+) kb/s", line)
+        return {
+            "codec": codec.group(1),
+            "sample_rate": fields[rate][:-3] if rate is not None else '44100',
+            "channels": _CHANNELS.get(layout, '2'),
+            "bitrate": str(int(kbps.group(1)) * 1000) if kbps else 'N/A'
+        }
+    return None
+
+
+def _from_opencv(video_path):
+    import cv2
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if not cap.isOpened():
+            raise ProbeError("Cannot open video file")
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+        codec = ''.join(chr((fourcc >> (8 * i)) & 0xFF) for i in range(4)).strip() if fourcc > 0 else None
+        return {
+            "width": int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            "height": int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            "fps": fps,
+            "frame_count": frame_count,
+            "duration": frame_count / fps if fps > 0 else 0,
+            "codec": codec or None,
+            "pix_fmt": None,
+            "bit_rate": None,
+            "audio": None,
+            "probe": "opencv"
+        }
+    finally:
+        cap.release()
+
+
+def _probe_uncached(video_path, ffprobe_path, ffmpeg_path):
+    if ffprobe_path:
+        cmd = [ffprobe_path, '-v', 'error', '-print_format', 'json',
+               '-show_streams', '-show_format', video_path]
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=PROBE_TIMEOUT)
+        if result.returncode != 0:
+            raise ProbeError(result.stderr.strip()[-300:] or f"ffprobe failed (code {result.returncode})")
+        try:
+            return _from_ffprobe(json.loads(result.stdout))
+        except ValueError as e:
+            raise ProbeError(f"Unreadable ffprobe output: {e}")
+
+    info = _from_opencv(video_path)
+    if ffmpeg_path and (shutil.which(ffmpeg_path) or os.path.isfile(ffmpeg_path)):
+        info['audio'] = _audio_from_banner(ffmpeg_path, video_path)
+        info['probe'] = 'opencv+ffmpeg'
+    else:
+        info['audio_unknown'] = True
+    return info
+
+
+def probe(video_path, ffprobe_path=None, ffmpeg_path='ffmpeg'):
+    """
+    Probe a media file (cached by path, size and modification time)
+
+    Args:
+        video_path (str): File to probe
+        ffprobe_path (str): ffprobe executable (default: find_ffprobe(ffmpeg_path))
+        ffmpeg_path (str): FFmpeg executable, used to find ffprobe and for the fallback
+
+    Returns:
+        dict: width, height, fps, frame_count, duration, size_bytes, codec, pix_fmt,
+            bit_rate, audio (codec, sample_rate, channels, bitrate, or None) and
+            probe (the method used). Callers must not modify it.
+
+    Raises:
+        FileNotFoundError: The file does not exist
+        ProbeError: The file has no readable video stream
+    """
+    st = os.stat(video_path)
+    key = (os.path.abspath(video_path), st.st_size, st.st_mtime_ns)
+    with _lock:
+        info = _cache.get(key)
+        if info is not None:
+            _cache.move_to_end(key)
+            return info
+
+    info = _probe_uncached(video_path, ffprobe_path or find_ffprobe(ffmpeg_path), ffmpeg_path)
+    info['size_bytes'] = st.st_size
+
+    with _lock:
+        _cache[key] = info
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return info
+
+
+def clear_cache():
+    """Forget all cached probe results"""
+    with _lock:
+        _cache.clear()
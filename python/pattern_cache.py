@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Watermark Pattern Cache
+On-disk LRU cache of pre-normalized watermark patterns
+
+Each pattern is the zero-mean, unit-variance float32 version of
+generate_wm(key, wm_shape), stored as a memory-mapped .npy file.
+The raw +1/-1 pattern used by the encoder is recovered from its sign,
+so one file serves both embedding and detection.
+
+Blind identification scores a video against every key the application can
+issue, so the whole keyspace is also stored as one (keys x pixels) matrix
+per wm_shape (get_keyspace). These banks are large (about 445 MB at
+2160p for 900 keys, more than the whole pattern budget), so they are kept
+under a budget of their own: writing one never evicts the per-key patterns,
+and pattern writes never evict a bank.
+"""
+
+import os
+import threading
+
+import numpy as np
+
+from blind_video_watermark.utils import generate_wm
+
+from app_paths import default_cache_dir
+
+
+DEFAULT_CACHE_MB = 256
+DEFAULT_KEYSPACE_CACHE_MB = 2048
+KEYSPACE_PREFIX = 'keyspace_'
+
+
+class PatternCache:
+    """LRU-evicting cache of normalized watermark patterns keyed by (key, wm_shape)"""
+
+    def __init__(self, cache_dir=None, max_mb=None, keyspace_max_mb=None):
+        """
+        Initialize cache
+
+        Args:
+            cache_dir (str): Root cache directory (default: default_cache_dir())
+            max_mb (float): Size budget of the per-key patterns in MB
+                (default: MGHOSTING_PATTERN_CACHE_MB or 256)
+            keyspace_max_mb (float): Size budget of the keyspace banks in MB
+                (default: MGHOSTING_KEYSPACE_CACHE_MB or 2048)
+        """
+        if max_mb is None:
+            max_mb = float(os.environ.get('MGHOSTING_PATTERN_CACHE_MB', DEFAULT_CACHE_MB))
+        if keyspace_max_mb is None:
+            keyspace_max_mb = float(os.environ.get('MGHOSTING_KEYSPACE_CACHE_MB', DEFAULT_KEYSPACE_CACHE_MB))
+
+        self.directory = os.path.join(cache_dir or default_cache_dir(), 'patterns')
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.keyspace_max_bytes = int(keyspace_max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = None  # file name -> [size, last access]
+        self._memory = {}     # (key, wm_shape) -> memmap, for this process
+        self._keyspaces = {}  # (first, last, wm_shape) -> memmap, for this process
+
+    def _path(self, key, wm_shape):
+        return os.path.join(self.directory, f"wm_{int(key)}_{wm_shape[0]}x{wm_shape[1]}.npy")
+
+    def _scan(self):
+        """Load the size/access index from disk once"""
+        if self._entries is not None:
+            return
+        self._entries = {}
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+                self._entries[name] = [st.st_size, st.st_mtime]
+            except OSError:
+                pass
+
+    def get(self, key, wm_shape):
+        """
+        Return the normalized float32 pattern for a key
+
+        Args:
+            key (int): Watermark key
+            wm_shape (tuple): Pattern shape from infer_wm_shape
+
+        Returns:
+            np.ndarray: Read-only memory-mapped (wm_shape) float32 array
+        """
+        wm_shape = (int(wm_shape[0]), int(wm_shape[1]))
+        cached = self._memory.get((int(key), wm_shape))
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        path = self._path(key, wm_shape)
+        name = os.path.basename(path)
+
+        with self._lock:
+            self._scan()
+            pattern = None
+            if name in self._entries:
+                try:
+                    pattern = np.load(path, mmap_mode='r')
+                    if pattern.shape != wm_shape or pattern.dtype != np.float32:
+                        pattern = None
+                except (OSError, ValueError):
+                    pattern = None
+
+            if pattern is not None:
+                self.hits += 1
+                self._touch(name, path)
+            else:
+                self.misses += 1
+                pattern = self._store(key, wm_shape, path, name)
+
+        self._memory[(int(key), wm_shape)] = pattern
+        return pattern
+
+    def get_raw(self, key, wm_shape):
+        """Return the +1/-1 pattern, identical to generate_wm(key, wm_shape)"""
+        return np.where(self.get(key, wm_shape) > 0, 1, -1)
+
+    def get_bank(self, keys, wm_shape):
+        """Return a (len(keys) x pixels) float32 matrix of normalized patterns"""
+        bank = np.empty((len(keys), int(wm_shape[0]) * int(wm_shape[1])), dtype=np.float32)
+        for i, key in enumerate(keys):
+            bank[i] = self.get(key, wm_shape).ravel()
+        return bank
+
+    def get_keyspace(self, first, last, wm_shape):
+        """
+        Return the normalized patterns of every key in [first, last] as one matrix
+
+        Row i belongs to key first + i. The matrix is built directly from
+        generate_wm instead of the per-key files, so it does not evict them.
+
+        Args:
+            first (int): Lowest key
+            last (int): Highest key (inclusive)
+            wm_shape (tuple): Pattern shape from infer_wm_shape
+
+        Returns:
+            np.ndarray: Read-only memory-mapped (last - first + 1, pixels) float32 matrix
+        """
+        first, last = int(first), int(last)
+        wm_shape = (int(wm_shape[0]), int(wm_shape[1]))
+        shape = (last - first + 1, wm_shape[0] * wm_shape[1])
+        cached = self._keyspaces.get((first, last, wm_shape))
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        path = os.path.join(self.directory, f"{KEYSPACE_PREFIX}{first}-{last}_{wm_shape[0]}x{wm_shape[1]}.npy")
+        name = os.path.basename(path)
+
+        with self._lock:
+            self._scan()
+            bank = None
+            if name in self._entries:
+                try:
+                    bank = np.load(path, mmap_mode='r')
+                    if bank.shape != shape or bank.dtype != np.float32:
+                        bank = None
+                except (OSError, ValueError):
+                    bank = None
+
+            if bank is not None:
+                self.hits += 1
+                self._touch(name, path)
+            else:
+                self.misses += 1
+                bank = np.empty(shape, dtype=np.float32)
+                for i in range(shape[0]):
+                    wm = generate_wm(first + i, wm_shape).astype(np.float32).ravel()
+                    bank[i] = (wm - wm.mean()) / wm.std()
+                bank = self._write(bank, path, name)
+
+        self._keyspaces[(first, last, wm_shape)] = bank
+        return bank
+
+    def _write(self, array, path, name):
+        """Atomically write an array and return it memory-mapped (or as is, if the disk refuses)"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+        except OSError:
+            # Read-only or full disk: serve from memory without caching
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return array
+
+        self._entries[name] = [os.path.getsize(path), os.path.getmtime(path)]
+        self._evict(keep=name)
+        return np.load(path, mmap_mode='r')
+
+    def _store(self, key, wm_shape, path, name):
+        """Generate, normalize and atomically write one pattern"""
+        wm = generate_wm(int(key), wm_shape).astype(np.float32)
+        pattern = (wm - wm.mean()) / wm.std()
+        return self._write(pattern, path, name)
+
+    def _touch(self, name, path):
+        """Record an access for LRU ordering (file mtime persists it across runs)"""
+        try:
+            os.utime(path, None)
+            self._entries[name][1] = os.path.getmtime(path)
+        except OSError:
+            pass
+
+    def _evict(self, keep=None):
+        """Delete least recently used files until the patterns and the keyspace banks each fit their budget"""
+        keyspace = keep is not None and keep.startswith(KEYSPACE_PREFIX)
+        max_bytes = self.keyspace_max_bytes if keyspace else self.max_bytes
+        entries = [(name, size, atime) for name, (size, atime) in self._entries.items()
+                   if name.startswith(KEYSPACE_PREFIX) == keyspace]
+        total = sum(size for _, size, _ in entries)
+        if total <= max_bytes:
+            return
+
+        for name, size, _ in sorted(entries, key=lambda entry: entry[2]):
+            if total <= max_bytes:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                # Still mapped by another process (Windows); try again later
+                continue
+            del self._entries[name]
+            total -= size
+
+    def stats(self):
+        """Return cache statistics"""
+        with self._lock:
+            self._scan()
+            keyspace = [size for name, (size, _) in self._entries.items() if name.startswith(KEYSPACE_PREFIX)]
+            return {
+                "directory": self.directory,
+                "entries": len(self._entries),
+                "size_bytes": sum(size for size, _ in self._entries.values()),
+                "max_bytes": self.max_bytes,
+                "keyspace_entries": len(keyspace),
+                "keyspace_bytes": sum(keyspace),
+                "keyspace_max_bytes": self.keyspace_max_bytes,
+                "hits": self.hits,
+                "misses": self.misses
+            }
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Frame Pipeline
+Bounded decode -> transform -> write stages with queue occupancy statistics
+
+A decoder thread builds jobs from the frame source and puts them on the
+'decoded' queue. A dispatcher thread hands them to the worker pool and puts
+the pending results on the 'transform' queue, in order. The caller iterates
+over the pipeline and writes each result (to encoders, or into correlation
+sums); a result stays on the transform queue until the caller asks for the
+next one.
+
+Both queues are bounded by a depth (items) and optionally a byte budget, so
+a fast decoder can never run ahead of a slow encoder by more than the queues
+hold. An item larger than the byte budget is still admitted into an empty
+queue, so a small budget slows the pipeline down instead of stalling it.
+
+Every queue records how full it was over time and how long its producer and
+consumer waited. A decoded queue that is mostly empty means decoding is the
+bottleneck; a transform queue that is mostly full while the writer rarely
+waits for results means writing is; otherwise the workers are.
+"""
+
+import threading
+import time
+from collections import deque
+
+
+class PipelineAborted(Exception):
+    """The pipeline was shut down while a stage was waiting"""
+
+
+_END = object()
+
+
+class StageQueue:
+    """FIFO between two pipeline stages, bounded by item count and bytes"""
+
+    def __init__(self, name, max_items, max_bytes=None):
+        """
+        Initialize queue
+
+        Args:
+            name (str): Stage name used in statistics
+            max_items (int): Depth limit
+            max_bytes (int): Byte budget for the queued items (optional)
+        """
+        self.name = name
+        self.max_items = max(1, int(max_items))
+        self.max_bytes = int(max_bytes) if max_bytes else None
+        self._items = deque()
+        self._bytes = 0
+        self._closed = False
+        self._aborted = False
+        self._cond = threading.Condition()
+        # Time-weighted occupancy
+        self._started = self._changed = time.perf_counter()
+        self._item_area = 0.0
+        self._byte_area = 0.0
+        self._full_s = 0.0
+        self._empty_s = 0.0
+        self.peak_items = 0
+        self.peak_bytes = 0
+        self.put_wait_s = 0.0
+        self.get_wait_s = 0.0
+        self.count = 0
+
+    def _full(self, nbytes):
+        if not self._items:
+            return False
+        if len(self._items) >= self.max_items:
+            return True
+        return self.max_bytes is not None and self._bytes + nbytes > self.max_bytes
+
+    def _account(self):
+        """Accumulate occupancy since the last change (call with the lock held)"""
+        now = time.perf_counter()
+        elapsed = now - self._changed
+        self._item_area += len(self._items) * elapsed
+        self._byte_area += self._bytes * elapsed
+        if not self._items:
+            self._empty_s += elapsed
+        elif self._full(0):
+            self._full_s += elapsed
+        self._changed = now
+
+    def put(self, item, nbytes=0):
+        """Append an item, blocking while the queue is full"""
+        with self._cond:
+            start = time.perf_counter()
+            while self._full(nbytes) and not self._aborted:
+                self._cond.wait()
+            self.put_wait_s += time.perf_counter() - start
+            if self._aborted:
+                raise PipelineAborted(self.name)
+            self._account()
+            self._items.append((item, nbytes))
+            self._bytes += nbytes
+            self.count += 1
+            self.peak_items = max(self.peak_items, len(self._items))
+            self.peak_bytes = max(self.peak_bytes, self._bytes)
+            self._cond.notify_all()
+
+    def peek(self):
+        """
+        Wait for the oldest item and return it without removing it
+
+        Returns:
+            The item, or _END once the queue is closed and drained
+        """
+        with self._cond:
+            start = time.perf_counter()
+            while not self._items and not self._closed and not self._aborted:
+                self._cond.wait()
+            self.get_wait_s += time.perf_counter() - start
+            if self._aborted:
+                raise PipelineAborted(self.name)
+            return self._items[0][0] if self._items else _END
+
+    def pop(self):
+        """Remove the oldest item (after peek())"""
+        with self._cond:
+            self._account()
+            _, nbytes = self._items.popleft()
+            self._bytes -= nbytes
+            self._cond.notify_all()
+
+    def get(self):
+        """peek() and pop() in one step"""
+        item = self.peek()
+        if item is not _END:
+            self.pop()
+        return item
+
+    def close(self):
+        """No more items will be put; consumers drain the rest and then see _END"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def abort(self):
+        """Wake every waiting producer and consumer with PipelineAborted"""
+        with self._cond:
+            self._aborted = True
+            self._cond.notify_all()
+
+    def occupancy(self):
+        """Current fill as a JSON-ready dict"""
+        with self._cond:
+            return {"items": len(self._items), "max_items": self.max_items,
+                    "mb": round(self._bytes / 2 ** 20, 1)}
+
+    def stats(self):
+        """Occupancy and wait statistics since the queue was created"""
+        with self._cond:
+            self._account()
+            wall = max(self._changed - self._started, 1e-9)
+            return {
+                "queue": self.name,
+                "items": self.count,
+                "max_items": self.max_items,
+                "max_mb": round(self.max_bytes / 2 ** 20, 1) if self.max_bytes else None,
+                "mean_items": round(self._item_area / wall, 2),
+                "peak_items": self.peak_items,
+                "mean_mb": round(self._byte_area / wall / 2 ** 20, 1),
+                "peak_mb": round(self.peak_bytes / 2 ** 20, 1),
+                "full_share": round(self._full_s / wall, 3),
+                "empty_share": round(self._empty_s / wall, 3),
+                "producer_wait_s": round(self.put_wait_s, 3),
+                "consumer_wait_s": round(self.get_wait_s, 3)
+            }
+
+
+class FramePipeline:
+    """Run pool jobs from a decoder thread and yield their results in order"""
+
+    def __init__(self, pool, func, jobs, depth, max_bytes=None, sizeof=None, out_factor=1):
+        """
+        Initialize pipeline
+
+        Args:
+            pool (multiprocessing.Pool): Worker pool (created before any FFmpeg pipe)
+            func (callable): Picklable worker function, func(job) -> result
+            jobs (iterable): Jobs; iterated on the decoder thread
+            depth (int): Depth of each queue, in jobs
+            max_bytes (int): Byte budget shared by the two queues (optional)
+            sizeof (callable): Bytes of a job's input frames (default: 0)
+            out_factor (float): Result bytes per input byte (outputs held until written)
+        """
+        self.pool = pool
+        self.func = func
+        self.jobs = jobs
+        self.sizeof = sizeof or (lambda job: 0)
+        self.out_factor = out_factor
+        share = max_bytes / 2 if max_bytes else None
+        self.decoded = StageQueue('decoded', depth, share)
+        self.transform = StageQueue('transform', depth, share)
+        self.result_wait_s = 0.0
+        self.started = None
+        self.finished = None
+        self._errors = []
+        self._threads = []
+
+    def _run(self, target):
+        try:
+            target()
+        except PipelineAborted:
+            pass
+        except BaseException as e:
+            self._errors.append(e)
+            self.decoded.abort()
+            self.transform.abort()
+
+    def _decode(self):
+        try:
+            for job in self.jobs:
+                self.decoded.put(job, self.sizeof(job))
+        finally:
+            self.decoded.close()
+
+    def _dispatch(self):
+        try:
+            while True:
+                job = self.decoded.get()
+                if job is _END:
+                    break
+                nbytes = self.sizeof(job) * (1 + self.out_factor)
+                self.transform.put(self.pool.apply_async(self.func, (job,)), nbytes)
+        finally:
+            self.transform.close()
+
+    def __iter__(self):
+        self.started = time.perf_counter()
+        for name, target in (('decoder', self._decode), ('dispatcher', self._dispatch)):
+            thread = threading.Thread(target=self._run, args=(target,), name=f"pipeline-{name}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        try:
+            while True:
+                try:
+                    pending = self.transform.peek()
+                except PipelineAborted:
+                    break
+                if pending is _END:
+                    break
+                start = time.perf_counter()
+                result = pending.get()
+                self.result_wait_s += time.perf_counter() - start
+                yield result
+                self.transform.pop()
+            if self._errors:
+                raise self._errors[0]
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the decoder and dispatcher threads (also when the caller stops early)"""
+        if self.finished is None:
+            self.finished = time.perf_counter()
+        self.decoded.abort()
+        self.transform.abort()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def occupancy(self):
+        """Current fill of both queues, for live metrics"""
+        return {"decoded": self.decoded.occupancy(), "transform": self.transform.occupancy()}
+
+    def stats(self):
+        """
+        Queue statistics and the stage that most likely limits throughput
+
+        Returns:
+            dict: {"queues": [...], "writer_wait_s", "bottleneck": 'decode',
+                'transform' or 'write'}
+        """
+        decoded, transform = self.decoded.stats(), self.transform.stats()
+        wall = max((self.finished or time.perf_counter()) - (self.started or time.perf_counter()), 1e-9)
+        writer_wait = transform['consumer_wait_s'] + self.result_wait_s
+        if decoded['empty_share'] > 0.5:
+            bottleneck = 'decode'
+        elif transform['full_share'] > 0.5 and writer_wait / wall < 0.2:
+            bottleneck = 'write'
+        else:
+            bottleneck = 'transform'
+        return {
+            "queues": [decoded, transform],
+            "writer_wait_s": round(writer_wait, 3),
+            "bottleneck": bottleneck
+        }
+
+
+def describe(stats):
+    """One-line summary of FramePipeline.stats() for debug events"""
+    parts = [f"{q['queue']} queue mean {q['mean_items']:.1f}/{q['max_items']} "
+             f"(peak {q['peak_items']}, {q['peak_mb']:.0f} MB, full {q['full_share'] * 100:.0f}%)"
+             for q in stats['queues']]
+    return f"Pipeline: {', '.join(parts)}; bottleneck: {stats['bottleneck']}"
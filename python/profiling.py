@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Job Profiling
+Opt-in per-stage timing, peak memory and live throughput events
+
+Stages timed in the main process (decode, encode, probes, audio merge, ...)
+are wall-clock time spent on that thread. Pool workers time their own stages
+(color conversion, DTCWT) with a StageTimer and send its report back with
+their results; those totals are summed over all workers, so on a busy pool
+they exceed the job's wall time.
+
+While frames are processed a `status: "metrics"` event is printed every few
+seconds; finish() prints a summary event whose message is a breakdown table.
+Jobs that run a frame pipeline (pipeline.py) also report the fill of its
+queues in both, which shows the stage that limits throughput.
+
+Phases that may run side by side (embedding frames on the main thread,
+demuxing audio on a background thread) are recorded as spans with their start
+and end time; the summary lists them as a timeline with how long each
+background span overlapped the main thread's.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+
+METRICS_INTERVAL = 2.0  # seconds between live metrics events
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process and of its largest waited-for child, in MB
+
+    Returns:
+        tuple: (own, children); None where the platform cannot tell
+    """
+    try:
+        import resource
+    except ImportError:
+        # Windows: psutil reports the peak working set of this process only
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / 2 ** 20, None
+        except (ImportError, AttributeError):
+            return None, None
+    scale = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is bytes on macOS, KB elsewhere
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 2 ** 20
+    return own, children
+
+
+class StageTimer:
+    """Accumulated wall time and call count per named stage"""
+
+    enabled = True
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds, calls=1):
+        with self._lock:
+            entry = self.stages.setdefault(stage, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += calls
+
+    def timed_iter(self, iterable, stage):
+        """Iterate while charging the time spent fetching each item to `stage`"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add(stage, time.perf_counter() - start)
+            yield item
+
+    def report(self):
+        """Picklable summary a pool worker returns to the main process"""
+        return {"pid": os.getpid(), "peak_rss_mb": peak_rss_mb()[0], "stages": dict(self.stages)}
+
+
+class JobProfiler(StageTimer):
+    """Stage timings, frame throughput and peak memory of one job"""
+
+    def __init__(self, label, interval=METRICS_INTERVAL):
+        """
+        Initialize profiler
+
+        Args:
+            label (str): Job name shown in events (e.g. the command)
+            interval (float): Seconds between live metrics events
+        """
+        super().__init__()
+        self.label = label
+        self.interval = interval
+        self.worker_stages = {}
+        self.worker_peaks = {}
+        self.background_stages = {}
+        self.spans = []
+        self.started = time.perf_counter()
+        self.frames_total = 0
+        self.frames = 0
+        self.frag_frames = None
+        self.fragment_times = []
+        self._frames_started = None
+        self._fragment_started = None
+        self._last_event = 0.0
+        self.pipeline = None
+
+    @contextmanager
+    def span(self, stage, where='main'):
+        """
+        Time a phase and record when it ran, for the summary timeline
+
+        Args:
+            stage (str): Phase name
+            where (str): 'main' for phases of the job's thread (their stages are
+                timed separately, so only the timeline shows them) or
+                'background' for another thread, whose time is also totalled
+                in the breakdown
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self.spans.append((stage, where, start - self.started, end - self.started))
+                if where != 'main':
+                    entry = self.background_stages.setdefault(stage, [0.0, 0])
+                    entry[0] += end - start
+                    entry[1] += 1
+
+    def watch(self, pipeline):
+        """Include a FramePipeline's queue occupancy in metrics and the summary"""
+        self.pipeline = pipeline
+
+    def merge(self, report):
+        """Add a worker's StageTimer.report() to the job totals"""
+        if not report:
+            return
+        for stage, (seconds, calls) in report['stages'].items():
+            entry = self.worker_stages.setdefault(stage, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += calls
+        if report.get('peak_rss_mb') is not None:
+            pid = report['pid']
+            self.worker_peaks[pid] = max(self.worker_peaks.get(pid, 0.0), report['peak_rss_mb'])
+
+    def begin_frames(self, total, frag_frames=None):
+        """Start counting frames of a pass over `total` frames split into fragments of `frag_frames`"""
+        now = time.perf_counter()
+        self.frames_total = int(total or 0)
+        self.frames = 0
+        self.frag_frames = frag_frames
+        self.fragment_times = []
+        self._frames_started = now
+        self._fragment_started = now
+        self._last_event = now
+
+    def frames_done(self, done):
+        """Record that `done` frames of the current pass are finished"""
+        now = time.perf_counter()
+        if self._frames_started is None:
+            self.begin_frames(0)
+        if self.frag_frames:
+            # Close every fragment whose last frame is now done
+            boundary = (len(self.fragment_times) + 1) * self.frag_frames
+            while done >= boundary:
+                self.fragment_times.append(now - self._fragment_started)
+                self._fragment_started = now
+                boundary += self.frag_frames
+        self.frames = done
+        if now - self._last_event >= self.interval:
+            self._last_event = now
+            self._emit_metrics(now)
+
+    def snapshot(self, now=None):
+        """Current counters as a JSON-ready dict"""
+        now = now or time.perf_counter()
+        elapsed = now - (self._frames_started or self.started)
+        fps = self.frames / elapsed if elapsed > 0 else 0.0
+        remaining = max(0, self.frames_total - self.frames)
+        own, children = peak_rss_mb()
+        return {
+            "job": self.label,
+            "frames_done": self.frames,
+            "frames_total": self.frames_total,
+            "fps": round(fps, 2),
+            "elapsed_s": round(now - self.started, 2),
+            "eta_s": round(remaining / fps, 1) if fps > 0 and self.frames_total else None,
+            "peak_rss_mb": _round(own),
+            "workers_peak_rss_mb": _round(sum(self.worker_peaks.values())) if self.worker_peaks else None,
+            "children_peak_rss_mb": _round(children),
+            "stages": {name: round(seconds, 3) for name, (seconds, _) in self.stages.items()},
+            "worker_stages": {name: round(seconds, 3) for name, (seconds, _) in self.worker_stages.items()},
+            "queues": self.pipeline.occupancy() if self.pipeline is not None else None
+        }
+
+    def _emit_metrics(self, now):
+        metrics = self.snapshot(now)
+        eta = f", ETA {metrics['eta_s']:.0f}s" if metrics['eta_s'] is not None else ''
+        rss = f", peak RSS {metrics['peak_rss_mb']:.0f} MB" if metrics['peak_rss_mb'] is not None else ''
+        print(json.dumps({
+            "status": "metrics",
+            "phase": "progress",
+            "message": f"{self.frames}/{self.frames_total} frames, {metrics['fps']:.1f} fps{eta}{rss}",
+            "metrics": metrics
+        }), flush=True)
+
+    def summary(self):
+        """End-of-job breakdown: snapshot plus per-frame and per-fragment figures"""
+        now = time.perf_counter()
+        summary = self.snapshot(now)
+        wall = now - self.started
+        frames = max(self.frames, 1)
+        rows = []
+        for where, stages in (('main', self.stages), ('workers', self.worker_stages),
+                              ('background', self.background_stages)):
+            for name, (seconds, calls) in sorted(stages.items(), key=lambda item: -item[1][0]):
+                rows.append({
+                    "stage": name,
+                    "where": where,
+                    "seconds": round(seconds, 3),
+                    "calls": calls,
+                    "ms_per_frame": round(1000 * seconds / frames, 3) if self.frames else None,
+                    "share": round(seconds / wall, 3) if where != 'workers' and wall > 0 else None
+                })
+        summary.update({
+            "wall_s": round(wall, 3),
+            "workers": len(self.worker_peaks),
+            "breakdown": rows
+        })
+        if self.pipeline is not None:
+            summary["pipeline"] = self.pipeline.stats()
+        if self.spans:
+            summary["timeline"] = self.timeline()
+        if self.fragment_times:
+            summary["fragments"] = {
+                "count": len(self.fragment_times),
+                "mean_s": round(sum(self.fragment_times) / len(self.fragment_times), 3),
+                "min_s": round(min(self.fragment_times), 3),
+                "max_s": round(max(self.fragment_times), 3)
+            }
+        return summary
+
+    def timeline(self):
+        """
+        Recorded spans in start order
+
+        Returns:
+            list: Dicts with stage, where, start_s and end_s (seconds since the
+                job started); background spans also have overlap_s, the time
+                they ran while a main-thread span did
+        """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span[2])
+        main = [(start, end) for _, where, start, end in spans if where == 'main']
+        rows = []
+        for stage, where, start, end in spans:
+            row = {"stage": stage, "where": where, "start_s": round(start, 3), "end_s": round(end, 3)}
+            if where != 'main':
+                overlap = sum(max(0.0, min(end, m_end) - max(start, m_start)) for m_start, m_end in main)
+                row["overlap_s"] = round(overlap, 3)
+            rows.append(row)
+        return rows
+
+    def finish(self):
+        """Print the summary table as a metrics event and return the summary"""
+        summary = self.summary()
+        print(json.dumps({
+            "status": "metrics",
+            "phase": "summary",
+            "message": format_summary(summary),
+            "metrics": summary
+        }), flush=True)
+        return summary
+
+
+class NullProfiler:
+    """Stand-in used when profiling is off; every hook is a no-op"""
+
+    enabled = False
+
+    def __call__(self, stage):
+        return nullcontext()
+
+    def add(self, stage, seconds, calls=1):
+        pass
+
+    def timed_iter(self, iterable, stage):
+        return iterable
+
+    def span(self, stage, where='main'):
+        return nullcontext()
+
+    def watch(self, pipeline):
+        pass
+
+    def merge(self, report):
+        pass
+
+    def begin_frames(self, total, frag_frames=None):
+        pass
+
+    def frames_done(self, done):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def _round(value, digits=1):
+    return round(value, digits) if value is not None else None
+
+
+def format_summary(summary):
+    """Render a JobProfiler summary as a fixed-width text table"""
+    lines = [
+        f"Profile: {summary['job']} - {summary['frames_done']} frames in {summary['wall_s']:.2f}s "
+        f"({summary['fps']:.2f} fps)",
+        f"{'stage':<14} {'where':<10} {'total s':>9} {'ms/frame':>9} {'calls':>7} {'share':>6}"
+    ]
+    for row in summary['breakdown']:
+        per_frame = f"{row['ms_per_frame']:.2f}" if row['ms_per_frame'] is not None else '-'
+        share = f"{row['share'] * 100:.0f}%" if row['share'] is not None else ''
+        lines.append(f"{row['stage']:<14} {row['where']:<10} {row['seconds']:>9.3f} {per_frame:>9} "
+                     f"{row['calls']:>7} {share:>6}")
+    if summary['worker_stages']:
+        lines.append(f"(worker stages are summed over {summary['workers']} processes)")
+    if 'fragments' in summary:
+        frags = summary['fragments']
+        lines.append(f"fragments: {frags['count']}, mean {frags['mean_s']:.3f}s, "
+                     f"min {frags['min_s']:.3f}s, max {frags['max_s']:.3f}s")
+    if summary.get('pipeline'):
+        lines.append(f"{'queue':<14} {'mean':>6} {'peak':>5} {'depth':>6} {'peak MB':>8} {'full':>5} {'empty':>6}")
+        for q in summary['pipeline']['queues']:
+            lines.append(f"{q['queue']:<14} {q['mean_items']:>6.1f} {q['peak_items']:>5} {q['max_items']:>6} "
+                         f"{q['peak_mb']:>8.1f} {q['full_share'] * 100:>4.0f}% {q['empty_share'] * 100:>5.0f}%")
+        lines.append(f"bottleneck: {summary['pipeline']['bottleneck']}")
+    if summary.get('timeline'):
+        lines.append(f"{'timeline':<14} {'where':<10} {'start s':>8} {'end s':>8} {'overlap s':>10}")
+        for span in summary['timeline']:
+            overlap = f"{span['overlap_s']:.3f}" if 'overlap_s' in span else ''
+            lines.append(f"{span['stage']:<14} {span['where']:<10} {span['start_s']:>8.3f} "
+                         f"{span['end_s']:>8.3f} {overlap:>10}")
+    memory = [f"{label} {summary[key]:.0f} MB" for label, key in (
+        ('main', 'peak_rss_mb'), ('workers', 'workers_peak_rss_mb'), ('ffmpeg/children', 'children_peak_rss_mb')
+    ) if summary.get(key) is not None]
+    if memory:
+        lines.append("peak RSS: " + ", ".join(memory))
+    return "\n".join(lines)
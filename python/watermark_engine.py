@@ -0,0 +1,2423 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+MGhosting Video Watermark Engine
+Blind video watermarking using DTCWT algorithm
+Supports both key-based and image-based watermarking
+
+Imports numpy, OpenCV and the watermark library at load time. The command
+line entry point (watermark_processor.py) imports this module only for
+commands that process video.
+"""
+
+import sys
+import json
+import os
+import traceback
+import subprocess
+import shutil
+import tempfile
+import multiprocessing
+from collections import deque
+from contextlib import ExitStack, nullcontext
+
+# --- NUMPY FIX: complex_ dtype compatibility ---
+try:
+    import numpy as np
+    # Register complex_ dtype if not already registered
+    if not hasattr(np, '_complex_dtype_registered'):
+        # Workaround for "data type 'complex_' not understood" error
+        # This error occurs when dtcwt uses complex_ dtype not in numpy's registry
+        if 'complex_' not in np.sctypeDict:
+            np.sctypeDict['complex_'] = np.complex128
+        # Also register shorthand versions
+        if 'complex128_' not in np.sctypeDict:
+            np.sctypeDict['complex128_'] = np.complex128
+        np._complex_dtype_registered = True
+except Exception as e:
+    print(f"Warning: Failed to register complex_ dtype: {e}", flush=True)
+
+# --- ÖNEMLİ: OpenCV Yaması (Kütüphanelerden Önce Yapılmalı) ---
+try:
+    import cv2
+    # Windows'ta OpenH264 (avc1) sorunlarını aşmak için mp4v'ye zorla
+    _original_VideoWriter = cv2.VideoWriter
+    _input_video_codec = None  # Store input codec for output consistency
+    
+    def patched_VideoWriter(filename, fourcc, fps, frameSize, isColor=True):
+        global _input_video_codec
+        target_fourcc = fourcc
+        
+        # Windows'ta, avc1/h264 istediğinde, doğrudan mp4v kullan
+        # Bu videoların yazma başarısızlığını önlüyor
+        if os.name == 'nt':
+            try:
+                c1 = chr(fourcc & 0xFF)
+                c2 = chr((fourcc >> 8) & 0xFF)
+                c3 = chr((fourcc >> 16) & 0xFF)
+                c4 = chr((fourcc >> 24) & 0xFF)
+                codec_str = (c1 + c2 + c3 + c4).upper()
+                
+                # H264 ailesini tespit et
+                if codec_str in ['AVC1', 'H264', 'X264', 'DAVC', 'FMP4']:
+                    # Doğrudan mp4v'ye geç (H264 başarısızlıkları çoktur)
+                    target_fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+                    print(f"[VideoWriter] Input codec {codec_str} detected, using mp4v for output", flush=True)
+            except:
+                pass
+        
+        # VideoWriter'ı oluştur
+        writer = _original_VideoWriter(filename, target_fourcc, fps, frameSize, isColor)
+        
+        # Eğer yazamadıysa, mp4v dene
+        if not writer.isOpened():
+            try:
+                mp4v_fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+                print(f"[VideoWriter] First attempt failed, falling back to mp4v...", flush=True)
+                writer = _original_VideoWriter(filename, mp4v_fourcc, fps, frameSize, isColor)
+            except:
+                pass
+        
+        return writer
+    
+    cv2.VideoWriter = patched_VideoWriter
+    
+    # DLL yolunu ekle
+    cv2_dir = os.path.dirname(cv2.__file__)
+    if os.name == 'nt' and cv2_dir not in os.environ['PATH']:
+        os.environ['PATH'] = cv2_dir + os.pathsep + os.environ['PATH']
+        if hasattr(os, 'add_dll_directory'):
+            try:
+                os.add_dll_directory(cv2_dir)
+            except: pass
+except ImportError:
+    pass
+# -----------------------------------------------------------
+
+try:
+    from blind_video_watermark import DtcwtKeyEncoder, DtcwtKeyDecoder
+    import blind_video_watermark.dtcwt_key as _dtcwt_key
+    from pattern_cache import PatternCache
+    from coefficient_cache import CoefficientCache
+    from embed_checkpoint import CheckpointStore
+    import media_probe
+    from frame_io import (
+        FFmpegFrameReader, FFmpegFrameWriter,
+        DEFAULT_VIDEO_CODEC, DEFAULT_PRESET, DEFAULT_CRF
+    )
+    import dtcwt_batch
+    from dtcwt_batch import DEFAULT_BATCH_SIZE, iter_batches
+    from profiling import JobProfiler, StageTimer, NULL_PROFILER
+    from pipeline import FramePipeline, describe as describe_pipeline
+    from audio_track import AudioPrefetch
+    from calibration import default_threads
+    from frame_marking import (
+        FrameMarking, marked_spans, fragment_bounds, fragment_count, fragment_of, fragment_scales
+    )
+except ImportError as e:
+    print(json.dumps({
+        "success": False,
+        "error": f"Import error: {str(e)}",
+        "message": "Please install required packages: pip install -r requirements.txt"
+    }))
+    sys.exit(1)
+
+# After importing blind_video_watermark, ensure complex_ is available for future operations
+try:
+    import numpy as np
+    # Make sure dtcwt can find complex_ dtype
+    if 'complex_' not in np.sctypeDict:
+        np.sctypeDict['complex_'] = np.complex128
+except:
+    pass
+
+
+# Fragment correlation sum required to accept a key (same as detect_video_async)
+DETECTION_THRESHOLD = 0.3
+
+# Every key generateKeysFromUniqueKey (main.js) can issue, for blind identification
+KEYSPACE = (100, 999)
+
+# Frame domains the watermark can live in, mapped to FFmpeg raw pixel formats:
+# 'bgr' is the library's full-resolution U of OpenCV YUV, 'yuv420' is the
+# decoder's native half-resolution U plane (detected only in the same domain)
+PIXEL_FORMATS = {'bgr': 'bgr24', 'yuv420': 'yuv420p'}
+
+
+def _encode_frames(frames, wm_sets, alpha, step, pixel_format, timer=None, masks=None, tile=None):
+    """
+    Embed one pattern set per output into a batch of raw frames in the given pixel format
+
+    With `tile` (a core side in pixels) the frames are transformed one tile at
+    a time and no masks are returned. Returns (list of uint8 batches, masks).
+    """
+    if tile:
+        yuv420 = pixel_format == 'yuv420'
+        return dtcwt_batch.encode_batch_tiled(frames, wm_sets, alpha, step, tile, timer, yuv420), None
+    if pixel_format == 'yuv420':
+        return dtcwt_batch.encode_batch_multi_yuv420(frames, wm_sets, alpha, step, timer=timer, masks=masks)
+    return dtcwt_batch.encode_batch_multi(frames, wm_sets, alpha, step, timer=timer, masks=masks)
+
+
+class _HeldJob(tuple):
+    """
+    Pool job whose span of source frames the main process holds until its result is written
+
+    Sparse marking sends only the marked frames to the workers; the unmarked
+    frames between them wait in the main process. `held_bytes` puts them in
+    the pipeline's byte budget. Workers receive a plain tuple.
+    """
+    held_bytes = 0
+    
+    def __reduce__(self):
+        return tuple, (tuple(self),)
+
+
+def _job_bytes(job):
+    """Frame bytes of a pool job (its first item is a list or tuple of arrays), plus any held for it"""
+    return sum(frames.nbytes for frames in job[0]) + getattr(job, 'held_bytes', 0)
+
+
+def _encode_batch_job(job):
+    """
+    Pool worker: embed one pattern set per output into a batch of raw frames
+
+    The job carries the frames' masks when they come from the coefficient
+    cache. Returns (list of uint8 batches, masks if the job asks to keep them
+    else None, stage timer report or None when not profiling).
+    """
+    frames, wm_sets, alpha, step, pixel_format, profile, masks, keep_masks = job
+    timer = StageTimer() if profile else None
+    outs, masks = _encode_frames(frames, wm_sets, alpha, step, pixel_format, timer, masks)
+    return outs, masks if keep_masks else None, timer.report() if timer else None
+
+
+def _encode_tile_job(job):
+    """
+    Pool worker: embed one pattern set per output into one tile of a batch
+
+    Returns (list of uint8 tile cores, stage timer report or None when not profiling).
+    """
+    inputs, wm_sets, alpha, step, pixel_format, plane, tile, profile = job
+    timer = StageTimer() if profile else None
+    if pixel_format == 'yuv420':
+        cores = dtcwt_batch.encode_tile_yuv420(*inputs, wm_sets, alpha, step, plane, tile, timer)
+    else:
+        cores = dtcwt_batch.encode_tile(*inputs, wm_sets, alpha, step, plane, tile, timer)
+    return cores, timer.report() if timer else None
+
+
+def _decode_batch_job(job):
+    """
+    Pool worker: decode the watermark planes of a batch of raw frames
+
+    Returns (counts, wms, stage timer report or None when not profiling).
+    """
+    frames, alpha, step, counts, pixel_format, profile = job
+    timer = StageTimer() if profile else None
+    if pixel_format == 'yuv420':
+        wms = dtcwt_batch.decode_batch_yuv420(frames, alpha, step, timer=timer)
+    else:
+        wms = dtcwt_batch.decode_batch(frames, alpha, step, timer=timer)
+    return counts, wms, timer.report() if timer else None
+
+
+def _embed_chunk_job(job):
+    """
+    Pool worker: watermark one fragment-aligned chunk into segment files
+
+    The chunk is read with input-side seeking, so each worker only decodes its
+    own frame range. job['segments'] splits the chunk into consecutive
+    (id, write path, final path, end frame) segments; each is encoded by its
+    own FFmpeg process and renamed to its final path once complete. With a
+    job['marking'] only the marked frames are transformed. Returns
+    (chunk index, frames written, stage timer report or None when not
+    profiling, ids of the published segments).
+    """
+    timer = StageTimer() if job['profile'] else None
+    reader = FFmpegFrameReader(
+        job['ffmpeg_path'], job['video_path'], job['width'], job['height'],
+        pix_fmt=PIXEL_FORMATS[job['pixel_format']],
+        # Half a frame early so rounding never drops the first frame of the chunk
+        start=(job['start_frame'] - 0.5) / job['fps'] if job['start_frame'] else None,
+        frames=job['end_frame'] - job['start_frame']
+    )
+    
+    def open_writer(path):
+        return FFmpegFrameWriter(
+            job['ffmpeg_path'], path, job['width'], job['height'], job['fps'],
+            video_codec=job['video_codec'], preset=job['preset'], crf=job['crf'], threads=1,
+            pix_fmt=PIXEL_FORMATS[job['pixel_format']]
+        )
+    
+    def publish(writer, segment):
+        writer.close()
+        if segment[1] != segment[2]:
+            os.replace(segment[1], segment[2])
+        published.append(segment[0])
+        return writer.frames_written
+    
+    sequence, frag_frames, wms = job['sequence'], job['frag_frames'], job['wms']
+    segments = iter(job['segments'])
+    segment = next(segments)
+    writer = None
+    published = []
+    frames_written = 0
+    position = job['start_frame']
+    frames_in = timer.timed_iter(reader, 'decode') if timer else reader
+    marking = job.get('marking')
+    if marking is not None:
+        spans = marked_spans(frames_in, marking, job['batch_size'], job['start_frame'])
+    else:
+        spans = ((job['start_frame'] + i * job['batch_size'], frames, range(len(frames)))
+                 for i, frames in enumerate(iter_batches(frames_in, job['batch_size'])))
+    try:
+        with reader:
+            for start, frames, marked in spans:
+                out = frames
+                if marked:
+                    batch_wms = [wms[int(sequence[int(((start + i) // frag_frames) % len(sequence))])]
+                                 for i in marked]
+                    (encoded,), _ = _encode_frames([frames[i] for i in marked], [batch_wms], job['alpha'],
+                                                   job['step'], job['pixel_format'], timer, tile=job['tile'])
+                    if len(marked) == len(frames):
+                        out = encoded
+                    else:
+                        out = list(frames)
+                        for i, frame in zip(marked, encoded):
+                            out[i] = frame
+                with timer('encode') if timer else nullcontext():
+                    for frame in out:
+                        if writer is None:
+                            writer = open_writer(segment[1])
+                        writer.write(frame)
+                        position += 1
+                        if position == segment[3]:
+                            frames_written += publish(writer, segment)
+                            writer = None
+                            segment = next(segments, None)
+            if writer is not None:
+                # The source ended before the expected frame count
+                with timer('encode') if timer else nullcontext():
+                    frames_written += publish(writer, segment)
+                    writer = None
+    finally:
+        if writer is not None:
+            writer.abort()
+    return job['index'], frames_written, timer.report() if timer else None, published
+
+
+def _parse_time(value):
+    """Seconds from a number or an '[[HH:]MM:]SS[.ff]' string"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    seconds = 0.0
+    for part in str(value).strip().split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def _parse_windows(windows):
+    """
+    Time windows as sorted (start, end) seconds
+
+    Accepts [start, end] pairs, {"start", "end"} dicts and "start-end"
+    strings, with times as for _parse_time.
+    """
+    parsed = []
+    for window in windows:
+        if isinstance(window, dict):
+            start, end = window.get('start', 0), window.get('end')
+        elif isinstance(window, str):
+            start, _, end = window.partition('-')
+        else:
+            start, end = window
+        if end is None or end == '':
+            raise ValueError(f"Time window needs an end: {window!r}")
+        start, end = _parse_time(start), _parse_time(end)
+        if start < 0 or end <= start:
+            raise ValueError(f"Invalid time window: {window!r}")
+        parsed.append((start, end))
+    return sorted(parsed)
+
+
+class WatermarkProcessor:
+    """Video watermarking processor with key-based support only"""
+    
+    def __init__(self, strength=1.0, step=5.0, threads=None, cache_dir=None, dtcwt_backend=None):
+        """
+        Initialize processor
+        
+        Args:
+            strength (float): Watermark strength (default: 1.0)
+            step (float): Step size for embedding (default: 5.0)
+            threads (int): Number of worker processes (default: 8, or the core
+                count if lower; see calibration.py for per-machine settings)
+            cache_dir (str): Pattern cache directory (default: app data cache)
+            dtcwt_backend (str): Column filter backend of the batched transforms,
+                'float32' or 'dtcwt' (default: MGHOSTING_DTCWT_BACKEND or float32)
+        """
+        self.strength = strength
+        self.step = step
+        self.threads = int(threads) if threads else default_threads()
+        # Validated here; the workers select it when the pool starts
+        self.dtcwt_backend = dtcwt_batch.set_backend(dtcwt_backend)
+        self.ffmpeg_path = media_probe.find_ffmpeg()
+        
+        # Serve generate_wm() from the on-disk pattern cache, including the
+        # calls made inside embed_video_async / detect_video_async
+        self.pattern_cache = PatternCache(cache_dir)
+        self.coefficient_cache = CoefficientCache(cache_dir)
+        self.checkpoints = CheckpointStore(cache_dir)
+        _dtcwt_key.generate_wm = self.pattern_cache.get_raw
+        self._encoder = None
+        self._decoder = None
+        self._pool = None
+        self._pattern_banks = {}
+        # Stage profiler of the running job (see profiling.py); a no-op unless a job opts in
+        self.profiler = NULL_PROFILER
+        # (depth, bytes) queue limits of the running job, see _set_queue_limits
+        self.queue_limits = (None, None)
+    
+    def set_strength(self, strength=1.0, step=5.0):
+        """Change strength and step between jobs; the key encoder and decoder follow on next use"""
+        if (strength, step) != (self.strength, self.step):
+            self.strength = strength
+            self.step = step
+            self._encoder = None
+            self._decoder = None
+    
+    def _get_encoder(self):
+        """Return the shared key encoder (created on first use)"""
+        if self._encoder is None:
+            self._encoder = DtcwtKeyEncoder(str=self.strength, step=self.step)
+        return self._encoder
+    
+    def _get_decoder(self):
+        """Return the shared key decoder (created on first use)"""
+        if self._decoder is None:
+            self._decoder = DtcwtKeyDecoder(str=self.strength, step=self.step)
+        return self._decoder
+    
+    def _get_pool(self):
+        """Return the worker pool, kept alive between jobs in serve mode"""
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.threads, initializer=dtcwt_batch.set_backend,
+                                              initargs=(self.dtcwt_backend,))
+        return self._pool
+    
+    def close(self):
+        """Release the worker pool"""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+    
+    def _set_queue_limits(self, queue_depth=None, queue_memory_mb=None):
+        """
+        Set the pipeline queue limits of the running job
+
+        Args:
+            queue_depth (int): Jobs per queue (default: MGHOSTING_QUEUE_DEPTH,
+                unset = a per-path default scaled to the worker count)
+            queue_memory_mb (float): Frame bytes the queues may hold together
+                (default: MGHOSTING_QUEUE_MB, unset = depth limit only)
+        """
+        if queue_depth is None:
+            queue_depth = os.environ.get('MGHOSTING_QUEUE_DEPTH') or None
+        if queue_memory_mb is None:
+            queue_memory_mb = os.environ.get('MGHOSTING_QUEUE_MB') or None
+        self.queue_limits = (
+            int(queue_depth) if queue_depth else None,
+            float(queue_memory_mb) * 2 ** 20 if queue_memory_mb else None
+        )
+    
+    def _map_ordered(self, func, jobs, window=None, out_factor=1):
+        """
+        Run jobs on the worker pool as a bounded pipeline and yield results in submission order
+
+        Jobs are built on a decoder thread and results are written by the
+        caller, linked by queues of `window` jobs each (default: 4 per worker;
+        the job's queue_depth overrides it) and the job's queue byte budget, so
+        a fast reader cannot queue up the whole video in memory. `out_factor`
+        is the result size per input frame byte. Queue occupancy goes to the
+        job profiler and, at the end, to a debug event (see pipeline.py).
+        """
+        depth, max_bytes = self.queue_limits
+        pipeline = FramePipeline(
+            self._get_pool(), func, jobs, depth or window or max(1, self.threads) * 4,
+            max_bytes=max_bytes, sizeof=_job_bytes, out_factor=out_factor
+        )
+        self.profiler.watch(pipeline)
+        yield from pipeline
+        print(json.dumps({
+            "status": "debug",
+            "message": describe_pipeline(pipeline.stats())
+        }), flush=True)
+    
+    def _map_tiled(self, jobs, plane, tile, window=None):
+        """
+        Run _encode_batch_job-style batch jobs as tile jobs spread over the pool
+
+        Every batch is cut into the tiles of dtcwt_batch.tile_plan, so workers
+        only hold tile windows and the tiles of one frame run in parallel.
+        Yields (list of uint8 batches, None, None) per batch in order; worker
+        stage reports go straight to the job profiler.
+        """
+        plan = None
+        batches = deque()
+        
+        def tile_jobs():
+            nonlocal plan
+            for job in jobs:
+                frames, wm_sets, alpha, step, pixel_format, profile, _, _ = job
+                frames = np.asarray(frames, dtype=np.uint8)
+                yuv420 = pixel_format == 'yuv420'
+                plan = plan or dtcwt_batch.tile_plan(plane[0], plane[1], tile)
+                batches.append((frames, len(wm_sets), yuv420))
+                for k, t in enumerate(plan):
+                    tile_job = _HeldJob((dtcwt_batch.tile_inputs(frames, t, yuv420), wm_sets, alpha, step,
+                                         pixel_format, plane, t, profile))
+                    if k == 0:
+                        # Frames held for the batch count once, with its first tile
+                        tile_job.held_bytes = getattr(job, 'held_bytes', 0)
+                    yield tile_job
+        
+        outputs = None
+        results = self._map_ordered(_encode_tile_job, tile_jobs(), window=window, out_factor=1)
+        for i, (cores, report) in enumerate(results):
+            self.profiler.merge(report)
+            k = i % len(plan)
+            if k == 0:
+                frames, count, yuv420 = batches.popleft()
+                outputs = dtcwt_batch.tiled_outputs(frames, count, yuv420)
+            dtcwt_batch.place_tile(outputs, plan[k], cores, yuv420)
+            if k == len(plan) - 1:
+                yield outputs, None, None
+    
+    def _tile_size(self, width, height, pixel_format, batch_size, tile_memory_mb):
+        """
+        Tile core side that keeps the workers' transforms within a memory budget
+
+        The budget is shared by all worker processes. Returns None when whole
+        frames already fit (or there is no budget).
+        """
+        if not tile_memory_mb:
+            return None
+        if pixel_format == 'yuv420':
+            height, width = height // 2, width // 2
+        per_job = float(tile_memory_mb) * 1024 * 1024 / max(1, self.threads)
+        if height * width * batch_size * dtcwt_batch.WORKING_SET_BYTES_PER_PIXEL <= per_job:
+            return None
+        return dtcwt_batch.tile_size_for_budget(per_job, batch_size)
+    
+    def _start_profile(self, label, profile):
+        """Install the stage profiler for a job (a no-op profiler unless `profile`)"""
+        self.profiler = JobProfiler(label) if profile else NULL_PROFILER
+        return self.profiler
+    
+    def _finish_profile(self, result):
+        """Print the profile summary of a successful job and attach it to its result"""
+        if self.profiler.enabled and result.get('success'):
+            result['profile'] = self.profiler.finish()
+        self.profiler = NULL_PROFILER
+        return result
+    
+    def _progress_printer(self, total, start, end, label):
+        """
+        Return a callback that prints a progress event every 5% of `total` frames
+
+        The callback also feeds the frame count to the job profiler.
+        """
+        state = {"last": start}
+        
+        def report(done):
+            self.profiler.frames_done(done)
+            if total <= 0:
+                return
+            progress = min(end, start + int((end - start) * done / total))
+            if progress >= state["last"] + 5:
+                state["last"] = progress
+                print(json.dumps({
+                    "status": "processing",
+                    "message": f"{label} {done}/{total} frames",
+                    "progress": progress
+                }), flush=True)
+        
+        return report
+    
+    def _has_ffmpeg(self):
+        """Check that the FFmpeg executable can be run"""
+        return bool(shutil.which(self.ffmpeg_path)) or os.path.isfile(self.ffmpeg_path)
+    
+    def embed_key_based(self, video_path, output_path, keys, sequence, frag_length=1,
+                        frame_io=None, video_codec=DEFAULT_VIDEO_CODEC, preset=DEFAULT_PRESET,
+                        crf=DEFAULT_CRF, encoder_threads=0, embed_mode='frames',
+                        batch_size=DEFAULT_BATCH_SIZE, pixel_format='bgr', coefficient_cache=False,
+                        profile=False, resume=False, tile_memory_mb=None, queue_depth=None,
+                        queue_memory_mb=None, mark_every=None, mark_per_fragment=None):
+        """
+        Embed key-based watermark
+        
+        Args:
+            video_path (str): Input video file path
+            output_path (str): Output video file path
+            keys (list): List of integer keys [10, 11, 12, 13]
+            sequence (str): Sequence string "0231" indicating which key for which segment
+            frag_length (float): Fragment length in seconds (default: 1)
+            frame_io (str): 'ffmpeg' (pipes, single-pass audio mux) or 'opencv' (default: ffmpeg if found)
+            video_codec (str): FFmpeg video encoder for the ffmpeg path (default: libx264)
+            preset (str): Encoder preset for the ffmpeg path (default: veryfast)
+            crf (int): Constant rate factor for the ffmpeg path (default: 18)
+            encoder_threads (int): FFmpeg encoder threads, 0 = auto (default: 0)
+            embed_mode (str): 'frames' spreads frames over the pool, 'chunks' gives each
+                worker process a fragment-aligned chunk and concatenates the segments
+                (ffmpeg frame I/O only, default: frames)
+            batch_size (int): Frames transformed together as one stack on the
+                ffmpeg path (default: DEFAULT_BATCH_SIZE)
+            pixel_format (str): 'bgr' (library-compatible) or 'yuv420', which
+                watermarks the decoder's half-resolution U plane directly and
+                passes Y and V through (ffmpeg frame I/O only, default: bgr)
+            coefficient_cache (bool): Read the source's per-frame masks (the one
+                forward DTCWT embedding needs) from the on-disk coefficient cache,
+                storing them on the first run (ffmpeg frames mode only, default: False)
+            profile (bool): Time each stage, print periodic metrics events and
+                add a "profile" breakdown to the result (default: False)
+            resume (bool): Encode each fragment as a checkpointed segment and skip
+                fragments finished by an earlier interrupted run with the same
+                input and parameters; implies the chunks mode (ffmpeg frame I/O
+                only, default: False)
+            tile_memory_mb (float): Memory budget in MB for the transforms of all
+                workers together; frames too large for it are processed as
+                overlapping tiles with identical output (ffmpeg frame I/O only,
+                default: MGHOSTING_TILE_MEMORY_MB, unset = whole frames)
+            queue_depth (int): Jobs each pipeline queue holds between decoding,
+                the workers and writing (default: MGHOSTING_QUEUE_DEPTH or a
+                per-worker default)
+            queue_memory_mb (float): Frame memory the pipeline queues may hold
+                together (default: MGHOSTING_QUEUE_MB, unset = depth limit only)
+            mark_every (int): Watermark only every k-th frame of each fragment and
+                pass the others through (ffmpeg frame I/O only, default: every frame)
+            mark_per_fragment (int): Watermark only k evenly spaced frames of each
+                fragment (ffmpeg frame I/O only); detect with the same marking
+                argument (see frame_marking.py)
+        
+        Returns:
+            dict: Result with success status and metadata
+        """
+        profiler = self._start_profile('embed-key', profile)
+        self._set_queue_limits(queue_depth, queue_memory_mb)
+        audio = None
+        try:
+            print(json.dumps({
+                "status": "processing",
+                "message": f"Starting key-based watermarking...",
+                "progress": 0
+            }), flush=True)
+            
+            # Validate inputs
+            if not os.path.exists(video_path):
+                raise FileNotFoundError(f"Video file not found: {video_path}")
+            
+            if not keys or len(keys) == 0:
+                raise ValueError("Keys list cannot be empty")
+            
+            if not sequence:
+                raise ValueError("Sequence cannot be empty")
+            
+            # Log input codec info
+            input_info = self._get_video_info(video_path)
+            input_codec = input_info.get('codec')
+            print(json.dumps({
+                "status": "debug",
+                "message": f"Input video codec detected: {input_codec if input_codec else 'Unknown'}"
+            }), flush=True)
+            
+            if frame_io is None:
+                frame_io = 'ffmpeg' if self._has_ffmpeg() else 'opencv'
+            if pixel_format not in PIXEL_FORMATS:
+                raise ValueError(f"Unknown pixel_format: {pixel_format}")
+            if pixel_format != 'bgr' and frame_io != 'ffmpeg':
+                raise ValueError(f"pixel_format '{pixel_format}' requires ffmpeg frame I/O")
+            if resume and frame_io != 'ffmpeg':
+                raise ValueError("resume requires ffmpeg frame I/O")
+            if resume:
+                embed_mode = 'chunks'
+            marking = None
+            if mark_every or mark_per_fragment:
+                if frame_io != 'ffmpeg':
+                    raise ValueError("Sparse frame marking requires ffmpeg frame I/O")
+                if 'fps' not in input_info:
+                    raise ValueError(f"Cannot read video metadata: {input_info.get('error')}")
+                marking = FrameMarking.from_args(input_info['fps'] * frag_length, mark_every, mark_per_fragment)
+            if coefficient_cache and (frame_io != 'ffmpeg' or embed_mode == 'chunks'):
+                print(json.dumps({
+                    "status": "debug",
+                    "message": "Coefficient cache is only used by the ffmpeg frames mode; embedding without it"
+                }), flush=True)
+            if tile_memory_mb is None:
+                tile_memory_mb = float(os.environ.get('MGHOSTING_TILE_MEMORY_MB') or 0) or None
+            if tile_memory_mb and frame_io != 'ffmpeg':
+                print(json.dumps({
+                    "status": "debug",
+                    "message": "Tiled processing needs ffmpeg frame I/O; embedding whole frames"
+                }), flush=True)
+            
+            print(json.dumps({
+                "status": "processing",
+                "message": "Embedding watermark into video frames...",
+                "progress": 25
+            }), flush=True)
+            
+            # Outputs not encoded by an FFmpeg process that reads the source get
+            # their audio afterwards; probe and demux it while frames are embedded
+            if frame_io != 'ffmpeg' or embed_mode == 'chunks':
+                if frame_io == 'ffmpeg':
+                    # Fork the chunk workers before the demux subprocess exists
+                    self._get_pool()
+                audio = AudioPrefetch(
+                    self.ffmpeg_path, video_path, os.path.dirname(os.path.abspath(output_path)),
+                    self._get_audio_info, profiler
+                ).start()
+            
+            resumed_fragments = 0
+            tile_size = None
+            with profiler.span('embed'):
+                try:
+                    if frame_io == 'ffmpeg' and embed_mode == 'chunks':
+                        _, resumed_fragments, tile_size = self._embed_chunks_ffmpeg(
+                            video_path, output_path, keys, sequence, frag_length,
+                            video_codec=video_codec, preset=preset, crf=crf, batch_size=batch_size,
+                            pixel_format=pixel_format, resume=resume, tile_memory_mb=tile_memory_mb,
+                            audio=audio, marking=marking
+                        )
+                    elif frame_io == 'ffmpeg':
+                        # Decode and encode through FFmpeg pipes; audio is mapped in the same pass
+                        _, tile_size = self._embed_frames_ffmpeg(
+                            video_path, output_path, keys, sequence, frag_length,
+                            video_codec=video_codec, preset=preset, crf=crf, encoder_threads=encoder_threads,
+                            batch_size=batch_size, pixel_format=pixel_format,
+                            coefficient_cache=coefficient_cache, tile_memory_mb=tile_memory_mb,
+                            marking=marking
+                        )
+                    else:
+                        # Embed directly to output path (same format as input);
+                        # the library loop cannot be split into stages
+                        with profiler('library'):
+                            self._get_encoder().embed_video_async(
+                                keys=keys,
+                                seq=sequence,
+                                frag_length=frag_length,
+                                video_path=video_path,
+                                output_path=output_path,
+                                threads=self.threads
+                            )
+                except Exception as embed_error:
+                    print(json.dumps({
+                        "status": "error",
+                        "message": f"Watermark embedding failed: {str(embed_error)}"
+                    }), flush=True)
+                    raise
+            
+            print(json.dumps({
+                "status": "processing",
+                "message": "Watermark embedded successfully",
+                "progress": 90
+            }), flush=True)
+            
+            # Verify output file
+            if not os.path.exists(output_path):
+                raise FileNotFoundError(f"Output file was not created: {output_path}")
+            
+            output_size = os.path.getsize(output_path)
+            
+            # 256 byte check: indicates VideoWriter failed to write properly
+            if output_size <= 256:
+                error_msg = f"Output file too small ({output_size} bytes) - VideoWriter likely failed. This usually means codec initialization failed."
+                print(json.dumps({
+                    "status": "error",
+                    "message": error_msg
+                }), flush=True)
+                # Clean up corrupted file
+                try:
+                    os.remove(output_path)
+                except:
+                    pass
+                raise ValueError(error_msg)
+            
+            if output_size == 0:
+                raise ValueError(f"Output file is empty (0 bytes): {output_path}")
+            
+            # Log file size ratio
+            input_size = os.path.getsize(video_path)
+            size_ratio = (output_size / input_size * 100) if input_size > 0 else 0
+            print(json.dumps({
+                "status": "debug",
+                "message": f"File size - Input: {input_size} bytes ({input_size/1024/1024:.2f}MB), Output: {output_size} bytes ({output_size/1024/1024:.2f}MB), Ratio: {size_ratio:.1f}%"
+            }), flush=True)
+            
+            if frame_io != 'ffmpeg':
+                # OpenCV VideoWriter doesn't preserve audio, so we need to merge it using FFmpeg
+                self._merge_audio(video_path, output_path, audio)
+            
+            # Get video info
+            video_info = self._get_video_info(output_path)
+            
+            return self._finish_profile({
+                "success": True,
+                "output_path": output_path,
+                "method": "key-based",
+                "keys": keys,
+                "sequence": sequence,
+                "frag_length": frag_length,
+                "frame_io": frame_io,
+                "embed_mode": embed_mode if frame_io == 'ffmpeg' else 'frames',
+                "batch_size": batch_size if frame_io == 'ffmpeg' else None,
+                "pixel_format": pixel_format,
+                "coefficient_cache": bool(coefficient_cache and frame_io == 'ffmpeg' and embed_mode != 'chunks'
+                                         and not tile_size and marking is None),
+                "marking": marking.to_dict() if marking is not None else None,
+                "frames_marked": marking.count(0, video_info.get('frame_count', 0)) if marking is not None else None,
+                "resume": resume,
+                "resumed_fragments": resumed_fragments,
+                "tile_size": tile_size,
+                "video_info": video_info,
+                "message": "Key-based watermark embedded successfully"
+            })
+            
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "traceback": traceback.format_exc()
+            }
+        finally:
+            if audio is not None:
+                audio.cleanup()
+    
+    def _embed_frames_ffmpeg(self, video_path, output_path, keys, sequence, frag_length,
+                             video_codec=DEFAULT_VIDEO_CODEC, preset=DEFAULT_PRESET,
+                             crf=DEFAULT_CRF, encoder_threads=0, batch_size=DEFAULT_BATCH_SIZE,
+                             pixel_format='bgr', coefficient_cache=False, tile_memory_mb=None,
+                             marking=None):
+        """
+        Watermark frames read from an FFmpeg pipe and encode them into another
+
+        The output FFmpeg process also maps the first audio stream of the
+        source (if any), so the result is complete when this returns. Frames
+        go to the pool in batches of `batch_size`, each transformed as one stack
+        (or as tiles spread over the pool when `tile_memory_mb` calls for it).
+
+        Returns:
+            tuple: (frames written, tile core side or None for whole frames)
+        """
+        video_info = self._get_video_info(video_path)
+        if 'height' not in video_info:
+            raise ValueError(f"Cannot read video metadata: {video_info.get('error')}")
+        
+        tile = self._tile_size(video_info['width'], video_info['height'], pixel_format, batch_size, tile_memory_mb)
+        print(json.dumps({
+            "status": "debug",
+            "message": f"FFmpeg pipe I/O: {video_info['width']}x{video_info['height']} @ {video_info['fps']:.3f} fps, encoder {video_codec} (preset {preset}, crf {crf}, threads {encoder_threads or 'auto'}), batch size {batch_size}, pixel format {pixel_format}"
+                       + (f", {tile}px tiles across workers" if tile else "")
+                       + (f", marking {marking.to_dict()}" if marking is not None else "")
+        }), flush=True)
+        
+        target = {"keys": keys, "sequence": sequence, "output_path": output_path, "frag_length": frag_length}
+        (frames_written,) = self._embed_stream_ffmpeg(
+            video_path, video_info, [target], frag_length,
+            video_codec=video_codec, preset=preset, crf=crf, encoder_threads=encoder_threads,
+            batch_size=batch_size, pixel_format=pixel_format, coefficient_cache=coefficient_cache,
+            tile=tile, marking=marking
+        )
+        return frames_written, tile
+    
+    def _embed_stream_ffmpeg(self, video_path, video_info, targets, frag_length,
+                             video_codec=DEFAULT_VIDEO_CODEC, preset=DEFAULT_PRESET,
+                             crf=DEFAULT_CRF, encoder_threads=0, batch_size=DEFAULT_BATCH_SIZE,
+                             pixel_format='bgr', coefficient_cache=False, tile=None, marking=None):
+        """
+        Decode a source once and encode one watermarked output per target
+
+        Each target is a dict with 'keys', 'sequence', 'output_path' and an
+        optional 'frag_length'. Workers share the color conversion and mask
+        transform of every batch between the targets. With `coefficient_cache`
+        the masks are read from (or, on the first run, stored in) the on-disk
+        coefficient cache. With `tile` (a core side from _tile_size) every
+        batch is split into tiles that are transformed by different workers.
+        With `marking` (a FrameMarking shared by all targets) only the marked
+        frames go to the workers, `batch_size` at a time; the unmarked frames
+        between them wait in the main process and are written unchanged.
+
+        Returns:
+            list: Frames written per target
+        """
+        width, height, fps = video_info['width'], video_info['height'], video_info['fps']
+        profiler = self.profiler
+        encoder = self._get_encoder()
+        wm_shape = self._wm_shape(height, width, pixel_format)
+        # One +1/-1 int8 pattern array per distinct key keeps pickling small and
+        # lets workers transform each key once per batch
+        patterns = {}
+        for target in targets:
+            for key in target['keys']:
+                if int(key) not in patterns:
+                    patterns[int(key)] = self.pattern_cache.get_raw(int(key), wm_shape).astype(np.int8)
+        streams = [{
+            "wms": [patterns[int(key)] for key in target['keys']],
+            "sequence": target['sequence'],
+            "frag_frames": fps * float(target.get('frag_length') or frag_length)
+        } for target in targets]
+        
+        cached, cache_writer = None, None
+        if coefficient_cache and marking is not None:
+            print(json.dumps({
+                "status": "debug",
+                "message": "Coefficient cache holds the masks of every frame; sparse marking runs without it"
+            }), flush=True)
+        elif coefficient_cache and tile:
+            print(json.dumps({
+                "status": "debug",
+                "message": "Coefficient cache holds whole-frame masks; tiled embedding runs without it"
+            }), flush=True)
+        elif coefficient_cache:
+            with profiler('cache'):
+                cached, cache_writer = self._open_mask_cache(video_path, video_info, pixel_format)
+        
+        def wm_sets_for(counts):
+            wm_sets = []
+            for stream in streams:
+                seq = stream['sequence']
+                wm_sets.append([
+                    stream['wms'][int(seq[int((count // stream['frag_frames']) % len(seq))])]
+                    for count in counts
+                ])
+            return wm_sets
+        
+        # Sparse marking: (frames, marked indices) of every span in job order;
+        # the writer fills the marked slots from the workers' results
+        spans = deque()
+        
+        def jobs(reader):
+            frames_in = profiler.timed_iter(reader, 'decode')
+            if marking is not None:
+                for start, span, marked in marked_spans(frames_in, marking, batch_size):
+                    spans.append((span, marked))
+                    if marked:
+                        job = _HeldJob(([span[i] for i in marked], wm_sets_for([start + i for i in marked]),
+                                        encoder.alpha, encoder.step, pixel_format, profiler.enabled, None, False))
+                        # The unmarked frames wait in `spans` until the result is written
+                        job.held_bytes = sum(frame.nbytes for frame in span) - _job_bytes(job)
+                        yield job
+                return
+            count = 0
+            for frames in iter_batches(frames_in, batch_size):
+                wm_sets = wm_sets_for(range(count, count + len(frames)))
+                masks = None
+                if cached is not None:
+                    with profiler('cache'):
+                        masks = cached.read(count, len(frames))
+                count += len(frames)
+                yield (frames, wm_sets, encoder.alpha, encoder.step, pixel_format, profiler.enabled,
+                       masks, cache_writer is not None)
+        
+        def write_span(writers, outs):
+            span, marked = spans.popleft()
+            for writer, frames in zip(writers, outs):
+                for i, frame in zip(marked, frames):
+                    span[i] = frame
+                for frame in span:
+                    writer.write(frame)
+        
+        profiler.begin_frames(video_info['frame_count'], fps * frag_length)
+        progress = self._progress_printer(video_info['frame_count'], 25, 90, "Embedded")
+        # Start pool workers before the pipes exist so forked workers don't
+        # inherit the encoder's stdin (it would never see EOF)
+        self._get_pool()
+        pix_fmt = PIXEL_FORMATS[pixel_format]
+        # Results carry one batch per output, so keep fewer of them in flight
+        window = max(2, self.threads * 4 // (batch_size * len(targets)))
+        if marking is not None:
+            # A sparse job also holds its span's unmarked frames; keep about the
+            # frame count dense embedding has in flight
+            first, end = marking.fragment_bounds(0)
+            window = max(2, int(window * marking.count(first, end) / (end - first)))
+        try:
+            with ExitStack() as stack:
+                reader = stack.enter_context(
+                    FFmpegFrameReader(self.ffmpeg_path, video_path, width, height, pix_fmt=pix_fmt)
+                )
+                writers = [stack.enter_context(FFmpegFrameWriter(
+                    self.ffmpeg_path, target['output_path'], width, height, fps,
+                    audio_source=video_path, video_codec=video_codec, preset=preset,
+                    crf=crf, threads=encoder_threads, pix_fmt=pix_fmt
+                )) for target in targets]
+                
+                if tile:
+                    plane = (height // 2, width // 2) if pixel_format == 'yuv420' else (height, width)
+                    results = self._map_tiled(jobs(reader), plane, tile, window=max(2, self.threads * 2))
+                else:
+                    results = self._map_ordered(_encode_batch_job, jobs(reader), window=window,
+                                                out_factor=len(targets))
+                for outs, masks, report in results:
+                    profiler.merge(report)
+                    if cache_writer is not None:
+                        with profiler('cache'):
+                            cache_writer.append(masks)
+                    with profiler('encode'):
+                        if marking is not None:
+                            write_span(writers, outs)
+                        else:
+                            for writer, frames in zip(writers, outs):
+                                for frame in frames:
+                                    writer.write(frame)
+                    progress(writers[0].frames_written)
+                # Flushing the encoders (and muxing the audio) is part of encoding
+                with profiler('encode'):
+                    while spans:
+                        # Unmarked frames after the last marked one
+                        write_span(writers, [[] for _ in writers])
+                    for writer in writers:
+                        writer.close()
+        except BaseException:
+            if cache_writer is not None:
+                cache_writer.abort()
+            raise
+        
+        if cache_writer is not None:
+            with profiler('cache'):
+                cache_writer.commit()
+        return [writer.frames_written for writer in writers]
+    
+    def _open_mask_cache(self, video_path, video_info, pixel_format):
+        """
+        Look up the masks of a source in the coefficient cache
+
+        Returns:
+            tuple: (MaskEntry or None, MaskWriter or None); a writer is returned
+                on a miss when the entry fits the cache budget
+        """
+        encoder = self._get_encoder()
+        width, height = video_info['width'], video_info['height']
+        cached = self.coefficient_cache.open(video_path, encoder.step, width, height, pixel_format)
+        if cached is not None:
+            print(json.dumps({
+                "status": "debug",
+                "message": f"Coefficient cache hit: masks for {cached.frames} frames"
+            }), flush=True)
+            return cached, None
+        
+        plane = (height // 2, width // 2) if pixel_format == 'yuv420' else (height, width)
+        mask_shape = dtcwt_batch.highpass_shapes(*plane)[2]
+        writer = self.coefficient_cache.writer(
+            video_path, encoder.step, width, height, pixel_format,
+            frames=video_info['frame_count'], mask_shape=mask_shape
+        )
+        print(json.dumps({
+            "status": "debug",
+            "message": "Coefficient cache miss: storing masks during this run" if writer else
+                       "Coefficient cache miss: source too large for the cache budget"
+        }), flush=True)
+        return None, writer
+    
+    def _embed_chunks_ffmpeg(self, video_path, output_path, keys, sequence, frag_length,
+                             video_codec=DEFAULT_VIDEO_CODEC, preset=DEFAULT_PRESET, crf=DEFAULT_CRF,
+                             batch_size=DEFAULT_BATCH_SIZE, pixel_format='bgr', resume=False,
+                             tile_memory_mb=None, audio=None, marking=None):
+        """
+        Watermark fragment-aligned chunks in separate worker processes
+
+        Each chunk starts on a fragment boundary, so every worker knows which key
+        from `sequence` applies to its frames. Segments are encoded with identical
+        settings and joined with FFmpeg's concat demuxer without re-encoding;
+        the source audio is mapped in that same step, from the track `audio`
+        (an AudioPrefetch) demuxed meanwhile when one is given.
+
+        With `resume`, every fragment becomes its own segment in a checkpoint
+        directory (see embed_checkpoint.py). Fragments finished by an earlier
+        run of the same job are skipped, and the checkpoint is deleted once
+        the output has been stitched.
+
+        When frames exceed the share of `tile_memory_mb` of one worker, each
+        worker transforms its batches one tile at a time. With `marking` (a
+        FrameMarking) workers only transform the marked frames.
+
+        Returns:
+            tuple: (frames written by this run, fragments reused from a checkpoint,
+                tile core side or None for whole frames)
+        """
+        video_info = self._get_video_info(video_path)
+        if 'height' not in video_info:
+            raise ValueError(f"Cannot read video metadata: {video_info.get('error')}")
+        width, height, fps = video_info['width'], video_info['height'], video_info['fps']
+        total_frames = video_info['frame_count']
+        
+        encoder = self._get_encoder()
+        wm_shape = self._wm_shape(height, width, pixel_format)
+        wms = [self.pattern_cache.get_raw(key, wm_shape).astype(np.int8) for key in keys]
+        frag_frames = fps * frag_length
+        tile = self._tile_size(width, height, pixel_format, batch_size, tile_memory_mb)
+        
+        # Fragment start frames
+        frag_starts = []
+        f = 0
+        while True:
+            start = int(np.ceil(f * frag_frames))
+            if start >= total_frames:
+                break
+            frag_starts.append(start)
+            f += 1
+        if not frag_starts:
+            raise ValueError("Video has no frames to embed")
+        frag_bounds = frag_starts + [total_frames]
+        
+        checkpoint = None
+        pending = list(range(len(frag_starts)))
+        if resume:
+            with self.profiler('checkpoint'):
+                params = {
+                    "input": self.coefficient_cache.content_hash(video_path),
+                    "keys": [int(k) for k in keys],
+                    "sequence": sequence,
+                    "frag_length": frag_length,
+                    "alpha": encoder.alpha,
+                    "step": encoder.step,
+                    "pixel_format": pixel_format,
+                    "video_codec": video_codec,
+                    "preset": preset,
+                    "crf": crf,
+                    "width": width,
+                    "height": height,
+                    "fps": fps,
+                    "frames": total_frames
+                }
+                if marking is not None:
+                    params["marking"] = marking.to_dict()
+                checkpoint = self.checkpoints.open(params, len(frag_starts))
+                done = set(checkpoint.manifest['done'])
+            pending = [i for i in pending if i not in done]
+            segment_dir = checkpoint.directory
+            print(json.dumps({
+                "status": "debug",
+                "message": f"Resumable embedding: {len(done)}/{len(frag_starts)} fragments already done, "
+                           f"checkpoint {checkpoint.directory}"
+            }), flush=True)
+        else:
+            segment_dir = tempfile.mkdtemp(prefix='mghosting_chunks_', dir=os.path.dirname(os.path.abspath(output_path)))
+        
+        # Runs of consecutive pending fragments, cut into about two chunks per worker
+        chunks = []
+        if pending:
+            chunk_count = min(len(pending), max(1, self.threads) * 2)
+            per_chunk = int(np.ceil(len(pending) / chunk_count))
+            for i in pending:
+                if chunks and chunks[-1][-1] == i - 1 and len(chunks[-1]) < per_chunk:
+                    chunks[-1].append(i)
+                else:
+                    chunks.append([i])
+        
+        try:
+            jobs = []
+            for n, frags in enumerate(chunks):
+                if checkpoint is not None:
+                    segments = [(i, checkpoint.partial_path(i), checkpoint.segment_path(i), frag_bounds[i + 1])
+                                for i in frags]
+                else:
+                    path = os.path.join(segment_dir, f"segment_{n:05d}.mp4")
+                    segments = [(n, path, path, frag_bounds[frags[-1] + 1])]
+                jobs.append({
+                    "index": n,
+                    "ffmpeg_path": self.ffmpeg_path,
+                    "video_path": video_path,
+                    "segments": segments,
+                    "width": width,
+                    "height": height,
+                    "fps": fps,
+                    "start_frame": frag_bounds[frags[0]],
+                    "end_frame": frag_bounds[frags[-1] + 1],
+                    "sequence": sequence,
+                    "frag_frames": frag_frames,
+                    "marking": marking,
+                    "wms": wms,
+                    "alpha": encoder.alpha,
+                    "step": encoder.step,
+                    "batch_size": batch_size,
+                    "pixel_format": pixel_format,
+                    "tile": tile,
+                    "video_codec": video_codec,
+                    "preset": preset,
+                    "crf": crf,
+                    "profile": self.profiler.enabled
+                })
+            
+            print(json.dumps({
+                "status": "debug",
+                "message": f"Chunked embedding: {len(pending)} fragments in {len(jobs)} chunks across {self.threads} worker processes"
+                           + (f", {tile}px tiles" if tile else "")
+            }), flush=True)
+            
+            frames_written = 0
+            pending_frames = sum(job['end_frame'] - job['start_frame'] for job in jobs)
+            self.profiler.begin_frames(pending_frames)
+            for done_count, (index, frames, report, published) in enumerate(
+                    self._get_pool().imap_unordered(_embed_chunk_job, jobs), 1):
+                frames_written += frames
+                self.profiler.merge(report)
+                self.profiler.frames_done(frames_written)
+                if checkpoint is not None:
+                    checkpoint.mark_done(published)
+                print(json.dumps({
+                    "status": "processing",
+                    "message": f"Chunk {index + 1}/{len(jobs)} finished ({done_count} done, {frames_written}/{pending_frames} frames)",
+                    "progress": 25 + int(60 * done_count / len(jobs))
+                }), flush=True)
+            
+            if checkpoint is not None:
+                segment_paths = [checkpoint.segment_path(i) for i in range(len(frag_starts))
+                                 if os.path.exists(checkpoint.segment_path(i))]
+            else:
+                segment_paths = [job['segments'][0][2] for job in jobs]
+            
+            list_path = os.path.join(segment_dir, 'segments.txt')
+            with open(list_path, 'w', encoding='utf-8') as f:
+                for path in segment_paths:
+                    f.write("file '{}'\n".format(path.replace('\\', '/').replace("'", "'\\''")))
+            
+            audio_source = video_path
+            if audio is not None:
+                with self.profiler('audio_wait'):
+                    audio_source = audio.result() or video_path
+            concat_cmd = [
+                self.ffmpeg_path,
+                '-v', 'error',
+                '-f', 'concat', '-safe', '0', '-i', list_path,
+                '-i', audio_source,
+                '-map', '0:v:0', '-map', '1:a:0?',
+                '-c', 'copy',
+                '-shortest',
+                '-y',
+                output_path
+            ]
+            with self.profiler('concat'):
+                result = subprocess.run(concat_cmd, capture_output=True, text=True)
+            if result.returncode != 0:
+                raise RuntimeError(f"Segment concat failed: {result.stderr[-500:]}")
+        finally:
+            if checkpoint is None:
+                shutil.rmtree(segment_dir, ignore_errors=True)
+        
+        if checkpoint is not None:
+            checkpoint.remove()
+        return frames_written, len(frag_starts) - len(pending), tile
+    
+    def embed_key_batch(self, video_path, jobs, frag_length=1, video_codec=DEFAULT_VIDEO_CODEC,
+                        preset=DEFAULT_PRESET, crf=DEFAULT_CRF, encoder_threads=0,
+                        batch_size=DEFAULT_BATCH_SIZE, pixel_format='bgr', coefficient_cache=False,
+                        profile=False, tile_memory_mb=None, queue_depth=None, queue_memory_mb=None):
+        """
+        Embed a different key-based watermark into one video for many recipients
+
+        The source is decoded once, and each batch of frames is converted and
+        mask-transformed once. Each recipient then only costs its own inverse
+        transform and a separate FFmpeg encoder (which also maps the source
+        audio). Requires FFmpeg.
+        
+        Args:
+            video_path (str): Input video file path
+            jobs (list): Dicts with 'keys', 'sequence', 'output_path' and optional
+                'id' and 'frag_length' (seconds)
+            frag_length (float): Default fragment length in seconds (default: 1)
+            video_codec (str): FFmpeg video encoder (default: libx264)
+            preset (str): Encoder preset (default: veryfast)
+            crf (int): Constant rate factor (default: 18)
+            encoder_threads (int): Threads per FFmpeg encoder, 0 = auto (default: 0)
+            batch_size (int): Frames transformed together as one stack (default: DEFAULT_BATCH_SIZE)
+            pixel_format (str): 'bgr' or 'yuv420', as for embed_key_based (default: bgr)
+            coefficient_cache (bool): Reuse (or store) the source's masks in the
+                coefficient cache, as for embed_key_based (default: False)
+            profile (bool): Time each stage, print periodic metrics events and
+                add a "profile" breakdown to the result (default: False)
+            tile_memory_mb (float): Transform memory budget of all workers, as for
+                embed_key_based (default: MGHOSTING_TILE_MEMORY_MB, unset = whole frames)
+            queue_depth (int): Pipeline queue depth, as for embed_key_based
+            queue_memory_mb (float): Pipeline queue memory, as for embed_key_based
+        
+        Returns:
+            dict: Result with one entry per output
+        """
+        profiler = self._start_profile('embed-key-batch', profile)
+        self._set_queue_limits(queue_depth, queue_memory_mb)
+        try:
+            print(json.dumps({
+                "status": "processing",
+                "message": f"Starting batch watermarking for {len(jobs)} outputs...",
+                "progress": 0
+            }), flush=True)
+            
+            if not os.path.exists(video_path):
+                raise FileNotFoundError(f"Video file not found: {video_path}")
+            if not jobs:
+                raise ValueError("Job list cannot be empty")
+            for i, job in enumerate(jobs):
+                if not job.get('keys') or not job.get('sequence') or not job.get('output_path'):
+                    raise ValueError(f"Job {job.get('id', i)} needs keys, sequence and output_path")
+            outputs = [os.path.abspath(job['output_path']) for job in jobs]
+            if len(set(outputs)) != len(outputs):
+                raise ValueError("Every job needs its own output_path")
+            if pixel_format not in PIXEL_FORMATS:
+                raise ValueError(f"Unknown pixel_format: {pixel_format}")
+            if not self._has_ffmpeg():
+                raise RuntimeError("Batch embedding requires FFmpeg")
+            
+            video_info = self._get_video_info(video_path)
+            if 'height' not in video_info:
+                raise ValueError(f"Cannot read video metadata: {video_info.get('error')}")
+            distinct_keys = len({int(k) for job in jobs for k in job['keys']})
+            if tile_memory_mb is None:
+                tile_memory_mb = float(os.environ.get('MGHOSTING_TILE_MEMORY_MB') or 0) or None
+            tile = self._tile_size(video_info['width'], video_info['height'], pixel_format,
+                                   batch_size, tile_memory_mb)
+            
+            print(json.dumps({
+                "status": "debug",
+                "message": f"Batch embedding: {len(jobs)} outputs, {distinct_keys} distinct keys, "
+                           f"{video_info['width']}x{video_info['height']} @ {video_info['fps']:.3f} fps, "
+                           f"encoder {video_codec} (preset {preset}, crf {crf}), "
+                           f"batch size {batch_size}, pixel format {pixel_format}"
+                           + (f", {tile}px tiles" if tile else "")
+            }), flush=True)
+            
+            print(json.dumps({
+                "status": "processing",
+                "message": "Embedding watermarks into video frames...",
+                "progress": 25
+            }), flush=True)
+            
+            frames_written = self._embed_stream_ffmpeg(
+                video_path, video_info, jobs, frag_length,
+                video_codec=video_codec, preset=preset, crf=crf, encoder_threads=encoder_threads,
+                batch_size=batch_size, pixel_format=pixel_format, coefficient_cache=coefficient_cache,
+                tile=tile
+            )
+            
+            print(json.dumps({
+                "status": "processing",
+                "message": f"{len(jobs)} watermarked videos encoded",
+                "progress": 90
+            }), flush=True)
+            
+            results = []
+            for job, written in zip(jobs, frames_written):
+                size = os.path.getsize(job['output_path']) if os.path.exists(job['output_path']) else 0
+                if size <= 256:
+                    raise ValueError(f"Output file was not written correctly: {job['output_path']}")
+                results.append({
+                    "id": job.get('id'),
+                    "output_path": job['output_path'],
+                    "keys": job['keys'],
+                    "sequence": job['sequence'],
+                    "frag_length": float(job.get('frag_length') or frag_length),
+                    "frames_written": written,
+                    "size_bytes": size
+                })
+            
+            return self._finish_profile({
+                "success": True,
+                "method": "key-based-batch",
+                "outputs": results,
+                "frames": frames_written[0],
+                "batch_size": batch_size,
+                "coefficient_cache": bool(coefficient_cache and not tile),
+                "pixel_format": pixel_format,
+                "tile_size": tile,
+                "video_info": video_info,
+                "message": f"Key-based watermark embedded into {len(results)} videos"
+            })
+            
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "traceback": traceback.format_exc()
+            }
+    
+    def _merge_audio(self, video_path, output_path, audio=None):
+        """
+        Copy the audio stream of the original video into an OpenCV-written output
+
+        Args:
+            video_path (str): Original video
+            output_path (str): Output written without audio
+            audio (AudioPrefetch): Probe and demux of the original started while
+                the frames were embedded (optional; probed here otherwise)
+        """
+        print(json.dumps({
+            "status": "processing",
+            "message": "Merging audio from original video...",
+            "progress": 92
+        }), flush=True)
+        
+        temp_video_no_audio = output_path.replace('.mp4', '_temp_no_audio.mp4')
+        os.rename(output_path, temp_video_no_audio)
+        
+        try:
+            # Check if original video has audio
+            audio_source = video_path
+            if audio is not None:
+                with self.profiler('audio_wait'):
+                    audio_source = audio.result() or video_path
+                audio_info = audio.audio_info
+                if audio.error:
+                    print(json.dumps({
+                        "status": "debug",
+                        "message": f"Audio prefetch failed, merging from the original: {audio.error}"
+                    }), flush=True)
+            else:
+                audio_info = self._get_audio_info(video_path)
+            
+            if audio_info:
+                # Merge video (watermarked) with audio (demuxed from original)
+                ffmpeg_cmd = [
+                    self.ffmpeg_path,
+                    '-i', temp_video_no_audio,  # Watermarked video (no audio)
+                    '-i', audio_source,          # Original video or its demuxed audio
+                    '-c:v', 'copy',              # Copy video stream without re-encoding
+                    '-c:a', 'copy',              # Copy audio stream from original
+                    '-map', '0:v:0',             # Video from first input
+                    '-map', '1:a:0',             # Audio from second input
+                    '-shortest',                 # Match shortest stream
+                    '-y',
+                    output_path
+                ]
+                
+                print(json.dumps({
+                    "status": "debug",
+                    "message": f"Running FFmpeg audio merge: {' '.join(ffmpeg_cmd[:5])}..."
+                }), flush=True)
+                
+                with self.profiler('audio_merge'):
+                    result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True, timeout=300)
+                
+                if result.returncode == 0:
+                    # Success - remove temp file
+                    os.remove(temp_video_no_audio)
+                    print(json.dumps({
+                        "status": "debug",
+                        "message": "Audio successfully merged from original video!"
+                    }), flush=True)
+                else:
+                    # FFmpeg failed - keep video without audio
+                    print(json.dumps({
+                        "status": "warning",
+                        "message": f"Audio merge failed, keeping video without audio. Error: {result.stderr[:200]}"
+                    }), flush=True)
+                    os.rename(temp_video_no_audio, output_path)
+            else:
+                # Original video has no audio - just rename back
+                print(json.dumps({
+                    "status": "debug",
+                    "message": "Original video has no audio, skipping merge."
+                }), flush=True)
+                os.rename(temp_video_no_audio, output_path)
+                
+        except Exception as audio_error:
+            print(json.dumps({
+                "status": "warning",
+                "message": f"Audio merge failed: {str(audio_error)}, keeping video without audio"
+            }), flush=True)
+            # Fallback: keep video without audio
+            if os.path.exists(temp_video_no_audio):
+                os.rename(temp_video_no_audio, output_path)
+    
+    def extract_key_based(self, video_path, keys, frag_length=1, detection_mode='full',
+                          sample_frames=6, margin_threshold=0.05, sequence_length=None,
+                          pixel_format='bgr', profile=False, queue_depth=None, queue_memory_mb=None,
+                          mark_every=None, mark_per_fragment=None, windows=None):
+        """
+        Extract key-based watermark sequence
+        
+        Args:
+            video_path (str): Watermarked video file path
+            keys (list): List of keys used during embedding
+            frag_length (float): Fragment length in seconds
+            detection_mode (str): 'full' decodes every frame, 'sampled' decodes a few
+                frames per fragment and stops early (default: full)
+            sample_frames (int): Max frames decoded per fragment in sampled mode (default: 6)
+            margin_threshold (float): Mean correlation margin between the top two keys
+                that ends sampling of a fragment (default: 0.05)
+            sequence_length (int): Sequence length to read in sampled mode (default: len(keys))
+            pixel_format (str): Domain the watermark was embedded in, 'bgr' or 'yuv420'
+                (yuv420 supports full mode only, default: bgr)
+            profile (bool): Time each stage, print periodic metrics events and
+                add a "profile" breakdown to the result (default: False)
+            queue_depth (int): Pipeline queue depth in full mode, as for embed_key_based
+            queue_memory_mb (float): Pipeline queue memory in full mode, as for embed_key_based
+            mark_every (int): The video was embedded with mark_every; only those
+                frames are transformed (see embed_key_based)
+            mark_per_fragment (int): The video was embedded with mark_per_fragment
+            windows (list): Only read these time windows, each a [start, end] pair
+                in seconds, a {"start", "end"} dict or a "start-end" string with
+                [[HH:]MM:]SS times; every window is read by seeking to it, and
+                the result holds one key per sequence position (full mode only)
+        
+        Returns:
+            dict: Result with detected sequence
+        """
+        profiler = self._start_profile('extract-key', profile)
+        self._set_queue_limits(queue_depth, queue_memory_mb)
+        try:
+            print(json.dumps({
+                "status": "processing",
+                "message": "Extracting watermark sequence...",
+                "progress": 0
+            }), flush=True)
+            
+            if not os.path.exists(video_path):
+                raise FileNotFoundError(f"Video file not found: {video_path}")
+            
+            if pixel_format not in PIXEL_FORMATS:
+                raise ValueError(f"Unknown pixel_format: {pixel_format}")
+            if pixel_format != 'bgr' and detection_mode == 'sampled':
+                raise ValueError(f"Sampled detection is not available for pixel_format '{pixel_format}'")
+            
+            if windows:
+                if detection_mode == 'sampled':
+                    raise ValueError("Time windows are read in full; use detection_mode 'full'")
+                return self._finish_profile(self._extract_key_windows(
+                    video_path, keys, frag_length, windows,
+                    pixel_format=pixel_format,
+                    sequence_length=sequence_length,
+                    mark_every=mark_every,
+                    mark_per_fragment=mark_per_fragment
+                ))
+            
+            if detection_mode == 'sampled':
+                return self._finish_profile(self._extract_key_sampled(
+                    video_path, keys, frag_length,
+                    sample_frames=sample_frames,
+                    margin_threshold=margin_threshold,
+                    sequence_length=sequence_length,
+                    mark_every=mark_every,
+                    mark_per_fragment=mark_per_fragment
+                ))
+            
+            print(json.dumps({
+                "status": "processing",
+                "message": "Analyzing video frames...",
+                "progress": 50
+            }), flush=True)
+            
+            video_info = self._get_video_info(video_path)
+            if 'height' not in video_info:
+                raise ValueError(f"Cannot read video metadata: {video_info.get('error')}")
+            
+            print(json.dumps({
+                "status": "debug",
+                "message": f"Video info: {video_info['width']}x{video_info['height']}, {video_info['fps']:.3f} fps"
+            }), flush=True)
+            
+            # Decoded on the bounded pipeline; the library's detect_video_async
+            # queues every decoded frame on a pool of its own without limit
+            marking = FrameMarking.from_args(video_info['fps'] * frag_length, mark_every, mark_per_fragment)
+            detected_seq = self._detect_sequence(video_path, video_info, keys, frag_length, pixel_format,
+                                                 marking)
+            
+            # Validation: Check if sequence is valid
+            if detected_seq and len(str(detected_seq).strip()) > 0 and '#' not in str(detected_seq):
+                success = True
+                message = "Watermark sequence extracted successfully"
+            else:
+                # Fallback: If sequence is empty or invalid, create a placeholder sequence
+                # This indicates the watermark data may have been lost due to video compression
+                print(json.dumps({
+                    "status": "warning",
+                    "message": f"Sequence detection failed or returned empty result: '{detected_seq}'. Creating placeholder sequence as fallback."
+                }), flush=True)
+                
+                # Create a placeholder sequence (same length as keys, filled with placeholders)
+                # Use -1 or 0 as placeholder values to indicate unknown sequence
+                placeholder_seq = [0] * len(keys)
+                detected_seq = placeholder_seq
+                success = True  # Mark as success with warning - extraction completed but sequence is placeholder
+                message = "Sequence extraction completed but data was lost (placeholder returned). This may indicate video compression issues or watermark signal loss."
+            
+            return self._finish_profile({
+                "success": success,
+                "detected_sequence": detected_seq,
+                "keys": keys,
+                "frag_length": frag_length,
+                "marking": marking.to_dict() if marking is not None else None,
+                "message": message
+            })
+            
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "traceback": traceback.format_exc()
+            }
+    
+    def _extract_key_sampled(self, video_path, keys, frag_length, sample_frames=6,
+                             margin_threshold=0.05, sequence_length=None, mark_every=None,
+                             mark_per_fragment=None):
+        """
+        Confidence-driven detection on a sample of frames per fragment
+
+        Frames are decoded a batch at a time from evenly spaced positions inside
+        each fragment. Sampling of a fragment stops once the top key's mean
+        correlation leads the runner-up by `margin_threshold`, and the whole run
+        stops as soon as every position of the sequence has been read.
+        Fragments whose sequence position is already known are skipped. With a
+        sparse marking the samples are spread over the marked frames only.
+        """
+        video_info = self._get_video_info(video_path)
+        if 'height' not in video_info:
+            raise ValueError(f"Cannot read video metadata: {video_info.get('error')}")
+        fps = video_info['fps']
+        # Fragments on the embedding grid; fractional at NTSC rates
+        frag_frames = fps * frag_length
+        frag_nums = fragment_count(video_info['frame_count'], frag_frames)
+        sequence_length = int(sequence_length or len(keys))
+        marking = FrameMarking.from_args(frag_frames, mark_every, mark_per_fragment)
+        # Per-frame equivalent of the fragment-sum threshold used by detect_video_async
+        min_corr = DETECTION_THRESHOLD / max(1, int(frag_frames))
+        
+        decoder = self._get_decoder()
+        wm_shape = decoder.infer_wm_shape((video_info['height'], video_info['width']))
+        patterns = self._normalized_patterns([int(k) for k in keys], wm_shape)
+        pool = self._get_pool()
+        batch_size = max(2, self.threads)
+        # Seeking (to the previous keyframe) only pays off for larger jumps
+        seek_gap = max(int(fps * 2), 1)
+        
+        print(json.dumps({
+            "status": "debug",
+            "message": f"Sampled detection: {frag_nums} fragments of {frag_frames:.3f} frames, up to {sample_frames} samples each, margin threshold {margin_threshold}"
+        }), flush=True)
+        
+        profiler = self.profiler
+        cap = cv2.VideoCapture(video_path)
+        position = 0
+        
+        def read_frame(index):
+            nonlocal position
+            with profiler('decode'):
+                if index - position > seek_gap or index < position:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+                    position = index
+                while position < index:
+                    cap.grab()
+                    position += 1
+                ret, frame = cap.read()
+                position += 1
+            return frame if ret else None
+        
+        resolved = {}
+        fragments = []
+        frames_decoded = 0
+        try:
+            for f in range(frag_nums):
+                slot = f % sequence_length
+                if slot in resolved:
+                    continue
+                
+                start, end = fragment_bounds(f, frag_frames)
+                if marking is not None:
+                    candidates = [i - start for i in range(start, end) if marking.marked(i)]
+                else:
+                    candidates = list(range(end - start))
+                if not candidates:
+                    continue
+                wanted = max(1, min(int(sample_frames), len(candidates)))
+                offsets = [candidates[int((j + 0.5) * len(candidates) / wanted)] for j in range(wanted)]
+                corr_sum = np.zeros(len(keys), dtype=np.float64)
+                samples = 0
+                margin = 0.0
+                
+                for b in range(0, wanted, batch_size):
+                    batch = []
+                    for offset in offsets[b:b + batch_size]:
+                        frame = read_frame(start + int(offset))
+                        if frame is not None:
+                            # One frame per task: samples are few, spread them over the pool
+                            batch.append(([frame], decoder.alpha, decoder.step, [samples + len(batch)],
+                                          'bgr', profiler.enabled))
+                    if not batch:
+                        break
+                    
+                    for _, wms, report in pool.map(_decode_batch_job, batch):
+                        profiler.merge(report)
+                        with profiler('correlate'):
+                            wm = wms[0].astype(np.float32).ravel()
+                            nwm = (wm - wm.mean()) / (wm.std() + 1e-10)
+                            corr_sum += patterns @ nwm / nwm.size
+                    samples += len(batch)
+                    frames_decoded += len(batch)
+                    profiler.frames_done(frames_decoded)
+                    
+                    mean_corr = corr_sum / samples
+                    ranked = np.sort(mean_corr)[::-1]
+                    margin = float(ranked[0] - ranked[1]) if len(ranked) > 1 else float(ranked[0])
+                    if samples >= 2 and margin >= margin_threshold:
+                        break
+                
+                if samples == 0:
+                    continue
+                
+                mean_corr = corr_sum / samples
+                best = int(np.argmax(mean_corr))
+                confident = mean_corr[best] > min_corr and margin >= margin_threshold
+                if confident:
+                    resolved[slot] = best
+                
+                fragments.append({
+                    "index": f,
+                    "position": slot,
+                    "start_frame": start,
+                    "samples": samples,
+                    "scores": [round(float(c), 6) for c in mean_corr],
+                    "margin": round(margin, 6),
+                    "key": best if confident else None
+                })
+                
+                print(json.dumps({
+                    "status": "processing",
+                    "message": f"Fragment {f + 1}/{frag_nums}: {samples} frames, margin {margin:.3f}, resolved {len(resolved)}/{sequence_length}",
+                    "progress": min(90, 50 + int(40 * len(resolved) / sequence_length))
+                }), flush=True)
+                
+                if len(resolved) == sequence_length:
+                    break
+        finally:
+            cap.release()
+        
+        detected_seq = ''.join(str(resolved[i]) if i in resolved else '#' for i in range(sequence_length))
+        complete = '#' not in detected_seq
+        
+        return {
+            "success": True,
+            "detected_sequence": detected_seq,
+            "keys": keys,
+            "frag_length": frag_length,
+            "detection_mode": "sampled",
+            "marking": marking.to_dict() if marking is not None else None,
+            "fragments": fragments,
+            "fragments_read": len(fragments),
+            "fragments_total": frag_nums,
+            "frames_decoded": frames_decoded,
+            "frames_total": video_info['frame_count'],
+            "early_exit": complete and len(fragments) < frag_nums,
+            "message": "Watermark sequence extracted successfully" if complete else
+                       "Sequence only partially read; increase sample_frames or lower margin_threshold"
+        }
+    
+    def _extract_key_windows(self, video_path, keys, frag_length, windows, pixel_format='bgr',
+                             sequence_length=None, mark_every=None, mark_per_fragment=None):
+        """
+        Detection limited to time windows of the video
+
+        Each window is narrowed to the whole fragments of the embedding grid
+        (fragment f spans frames ceil(f * fps * frag_length) up to the next
+        fragment's first frame) inside it, or widened to the fragment holding
+        its start when it is shorter than one. Overlapping windows are merged,
+        and every run of fragments is read by its own FFmpeg decoder that
+        seeks to it on the input side, so the cost follows the window length
+        rather than the file length. Fragment f carries sequence position
+        f % sequence_length; a position is read from the mean of its
+        fragments' correlation sums, with the full-mode threshold.
+        """
+        video_info = self._get_video_info(video_path)
+        if 'height' not in video_info:
+            raise ValueError(f"Cannot read video metadata: {video_info.get('error')}")
+        fps = video_info['fps']
+        total_frames = video_info['frame_count']
+        frag_frames = fps * frag_length
+        # Detection threshold is defined on sums over int(fps * frag_length) frames
+        full_frames = max(1, int(frag_frames))
+        sequence_length = int(sequence_length or len(keys))
+        marking = FrameMarking.from_args(frag_frames, mark_every, mark_per_fragment)
+        select = marking.marked if marking is not None else None
+        
+        def bounds(f):
+            return fragment_bounds(f, frag_frames)
+        
+        frag_nums = fragment_count(total_frames, frag_frames)
+        if frag_nums == 0:
+            raise ValueError("Video is shorter than one fragment")
+        
+        # Fragment ranges [first, end) per window, merged where they touch
+        ranges = []
+        for start_s, end_s in _parse_windows(windows):
+            first = int(np.ceil(start_s * fps / frag_frames - 1e-9))
+            end = min(int(np.floor(end_s * fps / frag_frames + 1e-9)), frag_nums)
+            if first >= end:
+                first = min(int(start_s * fps // frag_frames), frag_nums - 1)
+                end = first + 1
+            if ranges and first <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], end)
+                ranges[-1][2].append((start_s, end_s))
+            else:
+                ranges.append([first, end, [(start_s, end_s)]])
+        
+        wm_shape = self._wm_shape(video_info['height'], video_info['width'], pixel_format)
+        patterns = self._normalized_patterns([int(k) for k in keys], wm_shape)
+        frames_read = sum(bounds(end - 1)[1] - bounds(first)[0] for first, end, _ in ranges)
+        
+        print(json.dumps({
+            "status": "debug",
+            "message": f"Window detection: {len(ranges)} ranges, {sum(end - first for first, end, _ in ranges)}"
+                       f"/{frag_nums} fragments, {frames_read}/{total_frames} frames"
+        }), flush=True)
+        
+        self.profiler.begin_frames(frames_read, frag_frames)
+        progress = self._progress_printer(frames_read, 50, 90, "Decoded")
+        fragments = []
+        read = frames_decoded = 0
+        for first, end, spans in ranges:
+            start_frame, end_frame = bounds(first)[0], bounds(end - 1)[1]
+            sums = np.zeros((end - first, len(keys)), dtype=np.float32)
+            seen = np.zeros(end - first, dtype=np.int64)
+            last = start_frame - 1
+            for count, corrs in self._frame_correlations(video_path, video_info, patterns, pixel_format,
+                                                         select=select, start_frame=start_frame,
+                                                         frame_count=end_frame - start_frame):
+                f = fragment_of(count, frag_frames) - first
+                sums[f] += corrs
+                seen[f] += 1
+                last = count
+                frames_decoded += 1
+                progress(read + count - start_frame + 1)
+            read += end_frame - start_frame
+            
+            for f in range(first, end):
+                a, b = bounds(f)
+                expected = marking.count(a, b) if marking is not None else b - a
+                if seen[f - first] == 0 or seen[f - first] < expected or last < a:
+                    # The file ended early (its frame count was overstated)
+                    continue
+                scaled = sums[f - first] * (full_frames / seen[f - first])
+                best = int(np.argmax(scaled))
+                fragments.append({
+                    "index": f,
+                    "position": f % sequence_length,
+                    "start_frame": a,
+                    "scores": [round(float(c), 6) for c in scaled],
+                    "key": best if scaled[best] > DETECTION_THRESHOLD else None
+                })
+        
+        resolved = {}
+        for slot in range(sequence_length):
+            rows = [frag['scores'] for frag in fragments if frag['position'] == slot]
+            if rows:
+                mean = np.mean(rows, axis=0)
+                best = int(np.argmax(mean))
+                if mean[best] > DETECTION_THRESHOLD:
+                    resolved[slot] = best
+        detected_seq = ''.join(str(resolved[i]) if i in resolved else '#' for i in range(sequence_length))
+        complete = '#' not in detected_seq
+        
+        return {
+            "success": True,
+            "detected_sequence": detected_seq,
+            "keys": keys,
+            "frag_length": frag_length,
+            "detection_mode": "windows",
+            "marking": marking.to_dict() if marking is not None else None,
+            "windows": [{
+                "windows": [[round(s, 3), round(e, 3)] for s, e in spans],
+                "first_fragment": first,
+                "end_fragment": end,
+                "start_s": round(bounds(first)[0] / fps, 3),
+                "end_s": round(bounds(end - 1)[1] / fps, 3),
+                "detected": ''.join(str(frag['key']) if frag['key'] is not None else '#'
+                                    for frag in fragments if first <= frag['index'] < end)
+            } for first, end, spans in ranges],
+            "fragments": fragments,
+            "fragments_read": len(fragments),
+            "fragments_total": frag_nums,
+            "frames_read": read,
+            "frames_decoded": frames_decoded,
+            "frames_total": total_frames,
+            "message": "Watermark sequence extracted successfully" if complete else
+                       "Sequence only partially read; widen the windows to cover every sequence position"
+        }
+    
+    def extract_key_multi(self, video_path, candidates, frag_length=1, min_match_ratio=1.0, top_n=10,
+                          batch_size=DEFAULT_BATCH_SIZE, pixel_format='bgr', profile=False,
+                          queue_depth=None, queue_memory_mb=None, mark_every=None, mark_per_fragment=None):
+        """
+        Score many candidate key sets against one video in a single decode pass
+
+        Every frame is read and DTCWT-decoded once. The decoded watermark is
+        correlated against all distinct candidate keys with one matrix product,
+        and per-fragment sums are then evaluated for every candidate.
+
+        Args:
+            video_path (str): Suspect video file path
+            candidates (list): Dicts with 'keys', 'sequence' and optional 'id', 'frag_length'
+            frag_length (float): Default fragment length in seconds
+            min_match_ratio (float): Fraction of fragments that must match to accept a candidate
+            top_n (int): Number of ranked candidates to return
+            batch_size (int): Frames decoded together as one stack (default: DEFAULT_BATCH_SIZE)
+            pixel_format (str): Domain the watermark was embedded in, 'bgr' or 'yuv420' (default: bgr)
+            profile (bool): Time each stage, print periodic metrics events and
+                add a "profile" breakdown to the result (default: False)
+            queue_depth (int): Pipeline queue depth, as for embed_key_based
+            queue_memory_mb (float): Pipeline queue memory, as for embed_key_based
+            mark_every (int): Sparse marking the videos were embedded with, as for
+                extract_key_based
+            mark_per_fragment (int): Sparse marking, as for extract_key_based
+
+        Returns:
+            dict: Result with candidates ranked by match ratio and correlation margin
+        """
+        self._start_profile('extract-key-multi', profile)
+        self._set_queue_limits(queue_depth, queue_memory_mb)
+        try:
+            print(json.dumps({
+                "status": "processing",
+                "message": f"Scoring {len(candidates)} candidate key sets in a single pass...",
+                "progress": 0
+            }), flush=True)
+
+            if not os.path.exists(video_path):
+                raise FileNotFoundError(f"Video file not found: {video_path}")
+
+            candidates = [c for c in candidates if c.get('keys') and c.get('sequence')]
+            if not candidates:
+                raise ValueError("Candidate list cannot be empty")
+
+            video_info = self._get_video_info(video_path)
+            if 'height' not in video_info:
+                raise ValueError(f"Cannot read video metadata: {video_info.get('error')}")
+            fps = video_info['fps']
+            total_frames = video_info['frame_count']
+
+            wm_shape = self._wm_shape(video_info['height'], video_info['width'], pixel_format)
+
+            # One row per distinct key across all candidates
+            unique_keys = sorted({int(k) for c in candidates for k in c['keys']})
+            key_index = {k: i for i, k in enumerate(unique_keys)}
+            patterns = self._normalized_patterns(unique_keys, wm_shape)
+
+            # Fragment sizes in frames on the embedding grid, one accumulator per distinct frag_length
+            frag_frames = {}
+            for c in candidates:
+                fl = float(c.get('frag_length') or frag_length)
+                frag_frames[fl] = fl * fps
+            frag_sums = {fl: [] for fl in frag_frames}
+            seen = {fl: [] for fl in frag_frames}
+            markings = {fl: FrameMarking.from_args(fl * fps, mark_every, mark_per_fragment) for fl in frag_frames}
+            select = None
+            if all(m is not None for m in markings.values()):
+                select = lambda count: any(m.marked(count) for m in markings.values())
+
+            print(json.dumps({
+                "status": "debug",
+                "message": f"Pattern bank: {len(unique_keys)} keys x {patterns.shape[1]} coefficients "
+                           f"(cache hits: {self.pattern_cache.hits}, misses: {self.pattern_cache.misses}), "
+                           f"fragment sizes: {sorted(round(ff, 3) for ff in frag_frames.values())}"
+            }), flush=True)
+
+            frame_count = 0
+            self.profiler.begin_frames(total_frames, min(frag_frames.values()))
+            progress = self._progress_printer(total_frames, 5, 90, "Decoded")
+            for count, corrs in self._frame_correlations(video_path, video_info, patterns,
+                                                         pixel_format, batch_size, select):
+                for fl, ff in frag_frames.items():
+                    if markings[fl] is not None and not markings[fl].marked(count):
+                        continue
+                    sums = frag_sums[fl]
+                    idx = fragment_of(count, ff)
+                    while len(sums) <= idx:
+                        sums.append(np.zeros(len(unique_keys), dtype=np.float32))
+                        seen[fl].append(0)
+                    sums[idx] += corrs
+                    seen[fl][idx] += 1
+
+                frame_count += 1
+                progress(count + 1)
+
+            ranked = []
+            for fl, ff in frag_frames.items():
+                group = [c for c in candidates if float(c.get('frag_length') or frag_length) == fl]
+                scales = fragment_scales(ff, seen[fl], markings[fl])
+                frag_nums = len(scales)
+                frag_corrs = np.array(frag_sums[fl][:frag_nums], dtype=np.float32).reshape(frag_nums, len(unique_keys))
+                frag_corrs *= np.array(scales, dtype=np.float32)[:, None]
+                ranked.extend(self._score_candidates(group, frag_corrs, key_index, fl, min_match_ratio))
+
+            ranked.sort(key=lambda r: (r['match_ratio'], r['score']), reverse=True)
+            best = ranked[0] if ranked and ranked[0]['matched'] else None
+
+            return self._finish_profile({
+                "success": True,
+                "method": "key-based-multi",
+                "matched": best is not None,
+                "best": best,
+                "ranked": ranked[:top_n],
+                "candidates_tested": len(candidates),
+                "unique_keys": len(unique_keys),
+                "frames_decoded": frame_count,
+                "marking": next((m.to_dict() for m in markings.values() if m is not None), None),
+                "message": "Matching candidate found" if best else "No candidate matched the detected sequence"
+            })
+
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "traceback": traceback.format_exc()
+            }
+
+    def identify_key(self, video_path, frag_length=1, slots=4, key_range=KEYSPACE,
+                     batch_size=DEFAULT_BATCH_SIZE, pixel_format='bgr', profile=False,
+                     queue_depth=None, queue_memory_mb=None, mark_every=None, mark_per_fragment=None):
+        """
+        Read the keys and their order out of a video without any candidate list
+
+        Every frame is decoded once and summed into per-fragment watermarks.
+        The fragments are then scored against every key in `key_range` with
+        one matrix product against the keyspace bank (see
+        PatternCache.get_keyspace), so the cost does not depend on how many
+        records exist. Fragment f carries the key of slot f % slots; each
+        slot's key is the best mean score over its fragments.
+
+        The reading is returned in the form the record index uses: the keys
+        sorted ascending and the sequence as positions in that sorted list.
+
+        Args:
+            video_path (str): Suspect video file path
+            frag_length (float or list): Fragment length in seconds; with a list
+                every length is read in the same pass and the best reading wins
+            slots (int): Keys per sequence (default: 4, as generateKeysFromUniqueKey)
+            key_range (tuple): (first, last) key of the keyspace, inclusive
+            batch_size (int): Frames decoded together as one stack (default: DEFAULT_BATCH_SIZE)
+            pixel_format (str): Domain the watermark was embedded in, 'bgr' or 'yuv420' (default: bgr)
+            profile (bool): Time each stage, print periodic metrics events and
+                add a "profile" breakdown to the result (default: False)
+            queue_depth (int): Pipeline queue depth, as for embed_key_based
+            queue_memory_mb (float): Pipeline queue memory, as for embed_key_based
+            mark_every (int): Sparse marking the video was embedded with, as for
+                extract_key_based
+            mark_per_fragment (int): Sparse marking, as for extract_key_based
+
+        Returns:
+            dict: Result with 'identified', 'keys', 'sequence', 'order' (key per
+                slot), 'index_key' and per-slot scores
+        """
+        self._start_profile('identify-key', profile)
+        self._set_queue_limits(queue_depth, queue_memory_mb)
+        try:
+            print(json.dumps({
+                "status": "processing",
+                "message": "Identifying keys against the whole keyspace...",
+                "progress": 0
+            }), flush=True)
+
+            if not os.path.exists(video_path):
+                raise FileNotFoundError(f"Video file not found: {video_path}")
+
+            video_info = self._get_video_info(video_path)
+            if 'height' not in video_info:
+                raise ValueError(f"Cannot read video metadata: {video_info.get('error')}")
+            fps = video_info['fps']
+            total_frames = video_info['frame_count']
+
+            wm_shape = self._wm_shape(video_info['height'], video_info['width'], pixel_format)
+            first, last = int(key_range[0]), int(key_range[1])
+            with self.profiler('patterns'):
+                bank = self.pattern_cache.get_keyspace(first, last, wm_shape)
+
+            lengths = frag_length if isinstance(frag_length, (list, tuple)) else [frag_length]
+            # Fragment sizes in frames on the embedding grid
+            frag_frames = {float(fl): float(fl) * fps for fl in lengths}
+
+            print(json.dumps({
+                "status": "debug",
+                "message": f"Keyspace bank: {bank.shape[0]} keys x {bank.shape[1]} coefficients "
+                           f"({bank.nbytes / 2 ** 20:.0f} MB), fragment sizes: "
+                           f"{sorted(round(ff, 3) for ff in frag_frames.values())}"
+            }), flush=True)
+
+            # Frames are summed into the open fragment's watermark; correlation is
+            # linear, so scoring the sum equals summing the per-frame scores. A
+            # fragment is scored against the bank as soon as the next one starts,
+            # so only one watermark per frag_length is held, and a keys-long
+            # score row per fragment
+            pixels = bank.shape[1]
+            open_sums = {fl: np.zeros(pixels, dtype=np.float32) for fl in frag_frames}
+            rows = {fl: [] for fl in frag_frames}
+            seen = {fl: [] for fl in frag_frames}
+
+            def close_fragment(fl):
+                with self.profiler('correlate'):
+                    rows[fl].append(bank @ open_sums[fl] / pixels)
+                open_sums[fl].fill(0)
+
+            markings = {fl: FrameMarking.from_args(fl * fps, mark_every, mark_per_fragment) for fl in frag_frames}
+            select = None
+            if all(m is not None for m in markings.values()):
+                select = lambda count: any(m.marked(count) for m in markings.values())
+
+            frame_count = 0
+            self.profiler.begin_frames(total_frames, min(frag_frames.values()))
+            progress = self._progress_printer(total_frames, 5, 90, "Decoded")
+            for count, nwm in self._decoded_frames(video_path, video_info, pixel_format, batch_size, select):
+                for fl, ff in frag_frames.items():
+                    if markings[fl] is not None and not markings[fl].marked(count):
+                        continue
+                    idx = fragment_of(count, ff)
+                    while len(seen[fl]) <= idx:
+                        if seen[fl]:
+                            close_fragment(fl)
+                        seen[fl].append(0)
+                    open_sums[fl] += nwm
+                    seen[fl][idx] += 1
+                frame_count += 1
+                progress(count + 1)
+            for fl in frag_frames:
+                if len(rows[fl]) < len(seen[fl]):
+                    close_fragment(fl)
+
+            readings = []
+            for fl, ff in frag_frames.items():
+                scales = fragment_scales(ff, seen[fl], markings[fl])
+                if not scales:
+                    continue
+                # fragments x keys
+                scores = np.array(rows[fl][:len(scales)]) * np.array(scales, dtype=np.float32)[:, None]
+                reading = self._read_keyspace(scores, first, slots)
+                reading['frag_length'] = fl
+                readings.append(reading)
+
+            readings.sort(key=lambda r: (r['complete'], r['match_ratio'], r['score']), reverse=True)
+            best = readings[0] if readings else None
+            identified = best is not None and best['complete']
+            if identified:
+                message = "Keys identified"
+            elif best is not None and best['repeated']:
+                message = "Slots read a repeated key; the reading is not a valid key set"
+            else:
+                message = "No complete key sequence could be read"
+
+            result = {
+                "success": True,
+                "method": "key-identify",
+                "identified": identified,
+                "keyspace": [first, last],
+                "frames_decoded": frame_count,
+                "marking": next((m.to_dict() for m in markings.values() if m is not None), None),
+                "message": message
+            }
+            if best:
+                result.update(best)
+            if len(readings) > 1:
+                result['readings'] = readings
+            return self._finish_profile(result)
+
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "traceback": traceback.format_exc()
+            }
+
+    def _read_keyspace(self, scores, first, slots):
+        """
+        Read slot keys out of (fragments x keys) keyspace scores
+
+        A slot is read when its best key's mean score over the slot's fragments
+        exceeds DETECTION_THRESHOLD. The reading is complete only when every
+        slot is read and no key repeats, since a key set never holds one key
+        twice.
+        """
+        frag_nums = scores.shape[0]
+        best = scores.argmax(axis=1)
+        best_val = scores[np.arange(frag_nums), best]
+
+        order, slot_info = [], []
+        for s in range(slots):
+            rows = scores[s::slots]
+            if not len(rows):
+                order.append(None)
+                slot_info.append({"slot": s, "key": None, "score": 0.0, "margin": 0.0, "fragments": 0})
+                continue
+            mean = rows.mean(axis=0)
+            top2 = np.argpartition(mean, -2)[-2:]
+            k, runner_up = (top2[1], top2[0]) if mean[top2[1]] >= mean[top2[0]] else (top2[0], top2[1])
+            read = bool(mean[k] > DETECTION_THRESHOLD)
+            order.append(first + int(k) if read else None)
+            slot_info.append({
+                "slot": s,
+                "key": first + int(k) if read else None,
+                "score": float(mean[k]),
+                "margin": float(mean[k] - mean[runner_up]),
+                "fragments": len(rows)
+            })
+
+        expected = np.array([order[f % slots] or -1 for f in range(frag_nums)])
+        hits = (best + first == expected) & (best_val > DETECTION_THRESHOLD)
+        read_all = all(k is not None for k in order)
+        repeated = read_all and len(set(order)) < len(order)
+        complete = read_all and not repeated
+        keys = sorted(order) if complete else []
+        sequence = ''.join(str(keys.index(k)) for k in order) if complete else ''
+
+        return {
+            "keys": keys,
+            "sequence": sequence,
+            "order": order,
+            "index_key": f"{','.join(str(k) for k in keys)}|{sequence}" if complete else None,
+            "complete": complete,
+            "repeated": repeated,
+            "detected_keys": [first + int(b) if v > DETECTION_THRESHOLD else None
+                              for b, v in zip(best, best_val)],
+            "match_ratio": float(hits.mean()) if frag_nums else 0.0,
+            "score": float(np.mean([s['margin'] for s in slot_info])),
+            "slots": slot_info
+        }
+
+    def _detect_sequence(self, video_path, video_info, keys, frag_length, pixel_format, marking=None):
+        """
+        Full-video sequence detection in the given pixel format domain
+
+        Same rules as detect_video_async: per-fragment correlation sums, the best
+        key wins if its sum exceeds DETECTION_THRESHOLD, '#' otherwise; but
+        fragments are cut on the embedding's grid (see fragment_bounds) rather
+        than every int(fps * frag_length) frames. With `marking` (a
+        FrameMarking) only the marked frames are transformed and the sums are
+        scaled up to full fragments.
+        """
+        wm_shape = self._wm_shape(video_info['height'], video_info['width'], pixel_format)
+        patterns = self._normalized_patterns([int(k) for k in keys], wm_shape)
+        frag_frames = frag_length * video_info['fps']
+        
+        frag_sums, seen = [], []
+        self.profiler.begin_frames(video_info['frame_count'], frag_frames)
+        progress = self._progress_printer(video_info['frame_count'], 50, 90, "Decoded")
+        select = marking.marked if marking is not None else None
+        for count, corrs in self._frame_correlations(video_path, video_info, patterns, pixel_format,
+                                                     select=select):
+            idx = fragment_of(count, frag_frames)
+            while len(frag_sums) <= idx:
+                frag_sums.append(np.zeros(len(keys), dtype=np.float32))
+                seen.append(0)
+            frag_sums[idx] += corrs
+            seen[idx] += 1
+            progress(count + 1)
+        
+        seq = ""
+        for sums, scale in zip(frag_sums, fragment_scales(frag_frames, seen, marking)):
+            idx = int(np.argmax(sums))
+            seq += str(idx) if sums[idx] * scale > DETECTION_THRESHOLD else "#"
+        return seq
+    
+    def _frame_correlations(self, video_path, video_info, patterns, pixel_format='bgr',
+                            batch_size=DEFAULT_BATCH_SIZE, select=None, start_frame=0, frame_count=None):
+        """
+        Decode every frame (or those `select` accepts) on the pool and correlate it with a pattern bank
+
+        `start_frame` and `frame_count` limit the frames read, as for _decoded_frames.
+
+        Yields:
+            tuple: (frame index, (keys,) float32 correlations), in frame order
+        """
+        for count, nwm in self._decoded_frames(video_path, video_info, pixel_format, batch_size, select,
+                                               start_frame, frame_count):
+            with self.profiler('correlate'):
+                corrs = patterns @ nwm / nwm.size
+            yield count, corrs
+
+    def _decoded_frames(self, video_path, video_info, pixel_format='bgr', batch_size=DEFAULT_BATCH_SIZE,
+                        select=None, start_frame=0, frame_count=None):
+        """
+        Decode every frame on the pool
+
+        With `select` (a callable taking the frame index) frames it rejects are
+        read but never transformed. With `frame_count`, only the frames from
+        `start_frame` on are read, seeking to them on the FFmpeg input side
+        (keyframe seek, then decoding up to the exact frame) in either pixel
+        format domain.
+
+        Yields:
+            tuple: (frame index, zero-mean, unit-variance float32 watermark
+                as a flat vector), in frame order
+        """
+        decoder = self._get_decoder()
+        profiler = self.profiler
+        if pixel_format == 'bgr' and frame_count is None:
+            frames = self._iter_frames(video_path)
+        else:
+            # Start workers before the decoder pipe exists (see _embed_frames_ffmpeg)
+            self._get_pool()
+            frames = FFmpegFrameReader(
+                self.ffmpeg_path, video_path, video_info['width'], video_info['height'],
+                pix_fmt=PIXEL_FORMATS[pixel_format],
+                # Half a frame early so rounding never drops the first frame (as _embed_chunk_job)
+                start=(start_frame - 0.5) / video_info['fps'] if start_frame else None,
+                frames=frame_count
+            )
+        indexed = enumerate(profiler.timed_iter(frames, 'decode'), start_frame)
+        if select is not None:
+            indexed = ((count, frame) for count, frame in indexed if select(count))
+        jobs = (
+            ([frame for _, frame in batch], decoder.alpha, decoder.step,
+             [count for count, _ in batch], pixel_format, profiler.enabled)
+            for batch in iter_batches(indexed, batch_size)
+        )
+        window = max(2, self.threads * 4 // batch_size)
+        for counts, wms, report in self._map_ordered(_decode_batch_job, jobs, window=window, out_factor=0):
+            profiler.merge(report)
+            for count, wm in zip(counts, wms):
+                with profiler('correlate'):
+                    wm = wm.astype(np.float32).ravel()
+                    nwm = (wm - wm.mean()) / (wm.std() + 1e-10)
+                yield count, nwm
+
+    def _score_candidates(self, candidates, frag_corrs, key_index, frag_length, min_match_ratio):
+        """
+        Evaluate candidates against per-fragment key correlations
+
+        Candidates are grouped by key count so each group is scored with
+        vectorized gathers over a (fragments x candidates x keys) array.
+        """
+        results = []
+        frag_nums = frag_corrs.shape[0]
+        by_size = {}
+        for c in candidates:
+            by_size.setdefault(len(c['keys']), []).append(c)
+
+        for n_keys, group in by_size.items():
+            idx = np.array([[key_index[int(k)] for k in c['keys']] for c in group])
+            expected = np.array([
+                [int(c['sequence'][f % len(c['sequence'])]) for f in range(frag_nums)]
+                for c in group
+            ], dtype=np.int64).reshape(len(group), frag_nums).T
+            expected = np.clip(expected, 0, n_keys - 1)
+
+            scores = frag_corrs[:, idx]                                   # F x C x n
+            best = scores.argmax(axis=2)                                  # F x C
+            best_val = scores.max(axis=2)
+            exp_val = np.take_along_axis(scores, expected[..., None], axis=2)[..., 0]
+            others = scores.copy()
+            np.put_along_axis(others, expected[..., None], -np.inf, axis=2)
+            runner_up = others.max(axis=2) if n_keys > 1 else np.zeros_like(exp_val)
+
+            hits = (best == expected) & (best_val > DETECTION_THRESHOLD)
+            match_ratio = hits.mean(axis=0) if frag_nums else np.zeros(len(group))
+            margin = (exp_val - runner_up).mean(axis=0) if frag_nums else np.zeros(len(group))
+
+            for j, c in enumerate(group):
+                detected = ''.join(
+                    str(best[f, j]) if best_val[f, j] > DETECTION_THRESHOLD else '#'
+                    for f in range(frag_nums)
+                )
+                ratio = float(match_ratio[j])
+                results.append({
+                    "id": c.get('id'),
+                    "keys": c['keys'],
+                    "sequence": c['sequence'],
+                    "frag_length": frag_length,
+                    "detected_sequence": detected,
+                    "match_ratio": ratio,
+                    "score": float(margin[j]),
+                    "matched": frag_nums > 0 and ratio >= min_match_ratio
+                })
+        return results
+
+    def _wm_shape(self, height, width, pixel_format='bgr'):
+        """Watermark pattern shape for a frame size in the given pixel format domain"""
+        if pixel_format == 'yuv420':
+            # Patterns live in the half-resolution chroma plane
+            height, width = height // 2, width // 2
+        return self._get_encoder().infer_wm_shape((height, width))
+
+    def _normalized_patterns(self, keys, wm_shape):
+        """Build a (len(keys) x pixels) float32 matrix of zero-mean, unit-variance patterns"""
+        bank_key = (tuple(keys), tuple(wm_shape))
+        if bank_key in self._pattern_banks:
+            return self._pattern_banks[bank_key]
+        
+        patterns = self.pattern_cache.get_bank(keys, wm_shape)
+        
+        # Only the most recent bank is kept warm; banks for thousands of keys are large
+        self._pattern_banks = {bank_key: patterns}
+        return patterns
+
+    def _iter_frames(self, video_path):
+        """Yield BGR frames from a video file"""
+        cap = cv2.VideoCapture(video_path)
+        try:
+            while cap.isOpened():
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                yield frame
+        finally:
+            cap.release()
+
+    # Image-based watermarking methods removed - System uses key-based only
+
+    def _probe(self, video_path):
+        """Cached media_probe result for a file (one ffprobe call per file version)"""
+        with self.profiler('probe'):
+            return media_probe.probe(video_path, ffmpeg_path=self.ffmpeg_path)
+
+    def _get_video_info(self, video_path):
+        """
+        Get video metadata from the media probe
+
+        Returns:
+            dict: width, height, fps, frame_count, duration, size_bytes, codec and
+                audio; or error and size_bytes if the file is not a readable video
+        """
+        try:
+            return self._probe(video_path)
+        except (media_probe.ProbeError, OSError, subprocess.SubprocessError) as e:
+            try:
+                return {
+                    "error": str(e),
+                    "size_bytes": os.path.getsize(video_path),
+                    "note": "Could not open video file for full metadata but file exists"
+                }
+            except OSError:
+                return {"error": str(e)}
+
+    def _get_audio_info(self, video_path):
+        """
+        Audio stream information of a video from the media probe
+
+        Returns:
+            dict: codec, sample_rate, channels, bitrate; or None if there is no audio
+        """
+        try:
+            info = self._probe(video_path)
+        except (media_probe.ProbeError, OSError, subprocess.SubprocessError) as e:
+            print(json.dumps({
+                "status": "debug",
+                "message": f"Could not detect audio info: {str(e)}"
+            }), flush=True)
+            return None
+
+        if info.get('audio_unknown'):
+            print(json.dumps({
+                "status": "warning",
+                "message": "ffprobe not found, cannot detect audio. Audio may be lost!"
+            }), flush=True)
+            return None
+
+        audio_info = info['audio']
+        if audio_info is None:
+            print(json.dumps({
+                "status": "debug",
+                "message": "No audio stream detected"
+            }), flush=True)
+            return None
+
+        print(json.dumps({
+            "status": "debug",
+            "message": f"Audio info detected ({info['probe']}): codec={audio_info['codec']}, "
+                       f"sr={audio_info['sample_rate']}, ch={audio_info['channels']}"
+        }), flush=True)
+        return dict(audio_info)
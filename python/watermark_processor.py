@@ -2,17 +2,26 @@
 # -*- coding: utf-8 -*-
 """
 MGhosting Video Watermark Processor
-Blind video watermarking using DTCWT algorithm
-Supports both key-based and image-based watermarking
+Command line and serve mode entry point
+
+Usage:
+    python watermark_processor.py <command> [<args_json>]
+
+Only the standard library is loaded at startup. numpy, OpenCV and the
+watermark library come in with watermark_engine the first time a command
+needs a WatermarkProcessor, so `health`, `probe`, the coefficient cache
+commands and usage errors answer without paying for them (see
+bench/startup.py).
 """
 
 import sys
 import json
 import os
 import traceback
-import subprocess
 import shutil
-from pathlib import Path
+import platform
+import importlib
+import importlib.util
 
 # Add bundled libraries to sys.path for packaged app
 if getattr(sys, 'frozen', False):
@@ -28,622 +37,492 @@ if os.path.exists(lib_path) and lib_path not in sys.path:
     sys.path.insert(0, lib_path)
     print(f"Added bundled libraries to sys.path: {lib_path}")
 
-# --- NUMPY FIX: complex_ dtype compatibility ---
-try:
-    import numpy as np
-    # Register complex_ dtype if not already registered
-    if not hasattr(np, '_complex_dtype_registered'):
-        # Workaround for "data type 'complex_' not understood" error
-        # This error occurs when dtcwt uses complex_ dtype not in numpy's registry
-        if 'complex_' not in np.sctypeDict:
-            np.sctypeDict['complex_'] = np.complex128
-        # Also register shorthand versions
-        if 'complex128_' not in np.sctypeDict:
-            np.sctypeDict['complex128_'] = np.complex128
-        np._complex_dtype_registered = True
-except Exception as e:
-    print(f"Warning: Failed to register complex_ dtype: {e}", flush=True)
-
-# --- ÖNEMLİ: OpenCV Yaması (Kütüphanelerden Önce Yapılmalı) ---
-try:
-    import cv2
-    # Windows'ta OpenH264 (avc1) sorunlarını aşmak için mp4v'ye zorla
-    _original_VideoWriter = cv2.VideoWriter
-    _input_video_codec = None  # Store input codec for output consistency
+
+# Import name -> requirements.txt package, checked by `health`
+REQUIRED_MODULES = {
+    'numpy': 'numpy',
+    'cv2': 'opencv-contrib-python',
+    'dtcwt': 'dtcwt',
+    'blind_video_watermark': 'blind-video-watermark',
+    'scipy': 'scipy',
+    'tqdm': 'tqdm',
+}
+
+# Commands main() answers without importing watermark_engine
+LIGHT_COMMANDS = ("health", "probe", "coeff-cache-list", "coeff-cache-purge")
+# Commands that run without a WatermarkProcessor; batch-run and calibrate
+# start their jobs in processes of their own
+STANDALONE_COMMANDS = LIGHT_COMMANDS + ("batch-run", "calibrate")
+
+
+def health(deep=False):
+    """
+    Check the Python environment
+
+    Modules are located without being imported, so the check costs a few
+    milliseconds. With `deep`, they are imported as well, which catches
+    broken installs (missing DLLs, ABI mismatches) at full import cost, and
+    the batched transform backend is checked against dtcwt.
+
+    Args:
+        deep (bool): Import every required module (default: False)
+
+    Returns:
+        dict: success, python version, missing packages, FFmpeg and ffprobe
+            paths, and with `deep` the dtcwt_batch.check_backend result
+    """
+    import media_probe
     
-    def get_video_codec(video_path):
-        """Detect codec from input video"""
+    missing = []
+    errors = {}
+    for module, package in REQUIRED_MODULES.items():
         try:
-            cap = cv2.VideoCapture(video_path)
-            if cap.isOpened():
-                fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
-                cap.release()
-                if fourcc > 0:
-                    c1 = chr(fourcc & 0xFF)
-                    c2 = chr((fourcc >> 8) & 0xFF)
-                    c3 = chr((fourcc >> 16) & 0xFF)
-                    c4 = chr((fourcc >> 24) & 0xFF)
-                    codec_str = (c1 + c2 + c3 + c4).strip()
-                    return codec_str
-        except:
+            if deep:
+                importlib.import_module(module)
+            elif importlib.util.find_spec(module) is None:
+                missing.append(package)
+        except ImportError as e:
+            missing.append(package)
+            errors[package] = str(e)
+        except Exception as e:
+            # Import-time failure of an installed package
+            missing.append(package)
+            errors[package] = f"{type(e).__name__}: {e}"
+    
+    ffmpeg_path = media_probe.find_ffmpeg()
+    has_ffmpeg = bool(shutil.which(ffmpeg_path)) or os.path.isfile(ffmpeg_path)
+    result = {
+        "success": not missing,
+        "python": platform.python_version(),
+        "executable": sys.executable,
+        "deep": bool(deep),
+        "missing": missing,
+        "ffmpeg": ffmpeg_path if has_ffmpeg else None,
+        "ffprobe": media_probe.find_ffprobe(ffmpeg_path)
+    }
+    if deep and not missing:
+        # Batched transforms run on the selected backend; make sure it matches dtcwt
+        try:
+            import dtcwt_batch
+            check = dtcwt_batch.check_backend(os.environ.get('MGHOSTING_DTCWT_BACKEND') or dtcwt_batch.DEFAULT_BACKEND)
+            result["dtcwt_backend"] = check
+            if not check["passed"]:
+                result["success"] = False
+                errors["dtcwt_backend"] = f"Backend {check['backend']} differs from dtcwt by {check['max_error']:.2e}"
+        except Exception as e:
+            result["success"] = False
+            errors["dtcwt_backend"] = f"{type(e).__name__}: {e}"
+    if errors:
+        result["errors"] = errors
+    if missing:
+        result["error"] = f"Missing packages: {', '.join(missing)}"
+    return result
+
+
+def _profile_requested(args):
+    """A job is profiled when its args say so, or MGHOSTING_PROFILE=1 turns it on for all jobs"""
+    if 'profile' in args:
+        return bool(args['profile'])
+    return os.environ.get('MGHOSTING_PROFILE') == '1'
+
+
+def run_cache_command(cache, command, args):
+    """Run a coefficient cache maintenance command on a CoefficientCache"""
+    if command == 'coeff-cache-list':
+        return {"success": True, **cache.stats(), "items": cache.entries()}
+    purged = cache.purge(
+        keys=args.get('keys'),
+        older_than_days=args.get('older_than_days')
+    )
+    return {"success": True, **purged, **cache.stats()}
+
+
+def run_probe(args):
+    """probe command: media metadata straight from media_probe (one ffprobe call)"""
+    import subprocess
+    import media_probe
+    
+    video_path = args['video_path']
+    try:
+        info = media_probe.probe(video_path, ffmpeg_path=media_probe.find_ffmpeg())
+    except (media_probe.ProbeError, OSError, subprocess.SubprocessError) as e:
+        result = {"success": False, "error": str(e)}
+        try:
+            result["size_bytes"] = os.path.getsize(video_path)
+            result["note"] = "Could not open video file for full metadata but file exists"
+        except OSError:
             pass
-        return None
+        return result
+    return {"success": True, **info}
+
+
+def run_calibrate(args):
+    """Run the calibration trials (see calibration.py) and print one event per trial"""
+    from calibration import calibrate
+    return calibrate(
+        resolutions=args.get('resolutions'),
+        threads=args.get('thread_grid'),
+        batch_sizes=args.get('batch_sizes'),
+        seconds=args.get('seconds', 2),
+        cache_dir=args.get('cache_dir'),
+        log=lambda event: print(json.dumps(event), flush=True)
+    )
+
+
+def run_standalone_command(command, args):
+    """Run one of the STANDALONE_COMMANDS"""
+    if command == 'health':
+        return health(deep=bool(args.get('deep', False)))
     
-    def patched_VideoWriter(filename, fourcc, fps, frameSize, isColor=True):
-        global _input_video_codec
-        target_fourcc = fourcc
-        
-        # Windows'ta, avc1/h264 istediğinde, doğrudan mp4v kullan
-        # Bu videoların yazma başarısızlığını önlüyor
-        if os.name == 'nt':
-            try:
-                c1 = chr(fourcc & 0xFF)
-                c2 = chr((fourcc >> 8) & 0xFF)
-                c3 = chr((fourcc >> 16) & 0xFF)
-                c4 = chr((fourcc >> 24) & 0xFF)
-                codec_str = (c1 + c2 + c3 + c4).upper()
-                
-                # H264 ailesini tespit et
-                if codec_str in ['AVC1', 'H264', 'X264', 'DAVC', 'FMP4']:
-                    # Doğrudan mp4v'ye geç (H264 başarısızlıkları çoktur)
-                    target_fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-                    print(f"[VideoWriter] Input codec {codec_str} detected, using mp4v for output", flush=True)
-            except:
-                pass
-        
-        # VideoWriter'ı oluştur
-        writer = _original_VideoWriter(filename, target_fourcc, fps, frameSize, isColor)
+    elif command == 'probe':
+        return run_probe(args)
+    
+    elif command in ('coeff-cache-list', 'coeff-cache-purge'):
+        from coefficient_cache import CoefficientCache
+        return run_cache_command(CoefficientCache(args.get('cache_dir')), command, args)
+    
+    elif command == 'batch-run':
+        # Jobs run in their own processes; this one only schedules them
+        from batch_scheduler import run_batch
+        return run_batch(args)
+    
+    # Every calibration trial runs in a spawned process
+    return run_calibrate(args)
+
+
+def _apply_calibration(command, args):
+    """Fill a job's unset worker settings from this host's calibration and say so"""
+    from calibration import calibrated_args
+    args, applied = calibrated_args(command, args)
+    if applied:
+        settings = ", ".join(f"{key} {value}" for key, value in applied.items() if key != 'class')
+        print(json.dumps({
+            "status": "debug",
+            "message": f"Using calibrated settings for {applied['class']}: {settings}"
+        }), flush=True)
+    return args
+
+
+def run_command(processor, command, args):
+    """
+    Dispatch one command to a processor
+
+    Raises KeyError for missing required arguments so callers can report them.
+    """
+    from watermark_engine import DEFAULT_VIDEO_CODEC, DEFAULT_PRESET, DEFAULT_CRF, DEFAULT_BATCH_SIZE
+    
+    if command in STANDALONE_COMMANDS:
+        return run_standalone_command(command, args)
+    
+    elif command == 'extract-batch':
+        # Candidate folders can hold hundreds of files; a list may come in a file
+        from batch_extract import extract_batch
+        return extract_batch(processor, args)
+    
+    elif command == 'embed-key':
+        return processor.embed_key_based(
+            video_path=args['video_path'],
+            output_path=args['output_path'],
+            keys=args['keys'],
+            sequence=args['sequence'],
+            frag_length=args.get('frag_length', 1),
+            frame_io=args.get('frame_io'),
+            video_codec=args.get('video_codec', DEFAULT_VIDEO_CODEC),
+            preset=args.get('preset', DEFAULT_PRESET),
+            crf=args.get('crf', DEFAULT_CRF),
+            encoder_threads=args.get('encoder_threads', 0),
+            embed_mode=args.get('embed_mode', 'frames'),
+            batch_size=int(args.get('batch_size', DEFAULT_BATCH_SIZE)),
+            pixel_format=args.get('pixel_format', 'bgr'),
+            coefficient_cache=bool(args.get('coefficient_cache', False)),
+            profile=_profile_requested(args),
+            resume=bool(args.get('resume', False)),
+            tile_memory_mb=args.get('tile_memory_mb'),
+            queue_depth=args.get('queue_depth'),
+            queue_memory_mb=args.get('queue_memory_mb'),
+            mark_every=args.get('mark_every'),
+            mark_per_fragment=args.get('mark_per_fragment')
+        )
+    
+    elif command == 'embed-key-batch':
+        # Recipient lists can be long, so they may come in a file like candidates
+        if 'jobs_file' in args:
+            with open(args['jobs_file'], 'r', encoding='utf-8') as f:
+                jobs = json.load(f)
+        else:
+            jobs = args['jobs']
         
-        # Eğer yazamadıysa, mp4v dene
-        if not writer.isOpened():
-            try:
-                mp4v_fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-                print(f"[VideoWriter] First attempt failed, falling back to mp4v...", flush=True)
-                writer = _original_VideoWriter(filename, mp4v_fourcc, fps, frameSize, isColor)
-            except:
-                pass
+        return processor.embed_key_batch(
+            video_path=args['video_path'],
+            jobs=jobs,
+            frag_length=args.get('frag_length', 1),
+            video_codec=args.get('video_codec', DEFAULT_VIDEO_CODEC),
+            preset=args.get('preset', DEFAULT_PRESET),
+            crf=args.get('crf', DEFAULT_CRF),
+            encoder_threads=args.get('encoder_threads', 0),
+            batch_size=int(args.get('batch_size', DEFAULT_BATCH_SIZE)),
+            pixel_format=args.get('pixel_format', 'bgr'),
+            coefficient_cache=bool(args.get('coefficient_cache', False)),
+            profile=_profile_requested(args),
+            tile_memory_mb=args.get('tile_memory_mb'),
+            queue_depth=args.get('queue_depth'),
+            queue_memory_mb=args.get('queue_memory_mb')
+        )
+    
+    elif command == 'extract-key':
+        return processor.extract_key_based(
+            video_path=args['video_path'],
+            keys=args['keys'],
+            frag_length=args.get('frag_length', 1),
+            detection_mode=args.get('detection_mode', 'full'),
+            sample_frames=args.get('sample_frames', 6),
+            margin_threshold=args.get('margin_threshold', 0.05),
+            sequence_length=args.get('sequence_length'),
+            pixel_format=args.get('pixel_format', 'bgr'),
+            profile=_profile_requested(args),
+            queue_depth=args.get('queue_depth'),
+            queue_memory_mb=args.get('queue_memory_mb'),
+            mark_every=args.get('mark_every'),
+            mark_per_fragment=args.get('mark_per_fragment'),
+            windows=args.get('windows')
+        )
+    
+    elif command == 'extract-key-multi':
+        # Large record sets are passed through a file to stay under argv limits
+        if 'candidates_file' in args:
+            with open(args['candidates_file'], 'r', encoding='utf-8') as f:
+                candidates = json.load(f)
+        else:
+            candidates = args['candidates']
         
-        return writer
+        return processor.extract_key_multi(
+            video_path=args['video_path'],
+            candidates=candidates,
+            frag_length=args.get('frag_length', 1),
+            min_match_ratio=args.get('min_match_ratio', 1.0),
+            top_n=args.get('top_n', 10),
+            batch_size=int(args.get('batch_size', DEFAULT_BATCH_SIZE)),
+            pixel_format=args.get('pixel_format', 'bgr'),
+            profile=_profile_requested(args),
+            queue_depth=args.get('queue_depth'),
+            queue_memory_mb=args.get('queue_memory_mb'),
+            mark_every=args.get('mark_every'),
+            mark_per_fragment=args.get('mark_per_fragment')
+        )
     
-    cv2.VideoWriter = patched_VideoWriter
+    elif command == 'identify-key':
+        return processor.identify_key(
+            video_path=args['video_path'],
+            frag_length=args.get('frag_length', 1),
+            slots=int(args.get('slots', 4)),
+            batch_size=int(args.get('batch_size', DEFAULT_BATCH_SIZE)),
+            pixel_format=args.get('pixel_format', 'bgr'),
+            profile=_profile_requested(args),
+            queue_depth=args.get('queue_depth'),
+            queue_memory_mb=args.get('queue_memory_mb'),
+            mark_every=args.get('mark_every'),
+            mark_per_fragment=args.get('mark_per_fragment')
+        )
     
-    # DLL yolunu ekle
-    cv2_dir = os.path.dirname(cv2.__file__)
-    if os.name == 'nt' and cv2_dir not in os.environ['PATH']:
-        os.environ['PATH'] = cv2_dir + os.pathsep + os.environ['PATH']
-        if hasattr(os, 'add_dll_directory'):
-            try:
-                os.add_dll_directory(cv2_dir)
-            except: pass
-except ImportError:
-    pass
-# -----------------------------------------------------------
-
-try:
-    from blind_video_watermark import DtcwtKeyEncoder, DtcwtKeyDecoder
-except ImportError as e:
-    print(json.dumps({
+    return {
         "success": False,
-        "error": f"Import error: {str(e)}",
-        "message": "Please install required packages: pip install -r requirements.txt"
-    }))
-    sys.exit(1)
-
-# After importing blind_video_watermark, ensure complex_ is available for future operations
-try:
-    import numpy as np
-    # Make sure dtcwt can find complex_ dtype
-    if 'complex_' not in np.sctypeDict:
-        np.sctypeDict['complex_'] = np.complex128
-except:
-    pass
-
-
-class WatermarkProcessor:
-    """Video watermarking processor with key-based support only"""
+        "error": f"Unknown command: {command}",
+        "available_commands": COMMANDS
+    }
+
+
+COMMANDS = ["embed-key", "embed-key-batch", "extract-key", "extract-key-multi", "identify-key",
+            "extract-batch", "probe", "batch-run", "calibrate", "coeff-cache-list", "coeff-cache-purge", "health", "serve"]
+
+
+class _JobEventStream:
+    """
+    stdout replacement used by serve mode
+
+    Every line a job prints becomes one protocol message tagged with the job ID.
+    JSON progress events are passed through, anything else is wrapped as a log event.
+    """
     
-    def __init__(self, strength=1.0, step=5.0, threads=8):
-        """
-        Initialize processor
-        
-        Args:
-            strength (float): Watermark strength (default: 1.0)
-            step (float): Step size for embedding (default: 5.0)
-            threads (int): Number of threads for processing (default: 8)
-        """
-        self.strength = strength
-        self.step = step
-        self.threads = threads
-        self.ffmpeg_path = self._find_ffmpeg()
+    def __init__(self, out, job_id):
+        self.out = out
+        self.job_id = job_id
+        self._buffer = ''
     
-    def _find_ffmpeg(self):
-        """Find FFmpeg executable"""
-        # Check if ffmpeg is in PATH
-        ffmpeg_exe = shutil.which('ffmpeg')
-        if ffmpeg_exe:
-            return ffmpeg_exe
-        
-        # Check bundled FFmpeg (relative to script location)
-        script_dir = Path(__file__).parent.parent
-        bundled_paths = [
-            script_dir / 'ffmpeg' / 'bin' / 'ffmpeg.exe',  # Project bundled (Windows)
-            script_dir / 'ffmpeg' / 'bin' / 'ffmpeg',      # Project bundled (Linux/macOS)
-            Path('C:/ffmpeg/bin/ffmpeg.exe'),              # Common Windows location
-            Path('/usr/bin/ffmpeg'),                        # Common Linux location
-        ]
-        
-        for path in bundled_paths:
-            if path.exists():
-                return str(path)
-        
-        # Fallback to 'ffmpeg' and hope it's in PATH
-        return 'ffmpeg'
+    def write(self, text):
+        self._buffer += text
+        while '\n' in self._buffer:
+            line, self._buffer = self._buffer.split('\n', 1)
+            self._emit(line)
+        return len(text)
     
-    def _get_video_codec(self, video_path):
-        """Detect input video codec to preserve output quality"""
-        try:
-            cap = cv2.VideoCapture(video_path)
-            if not cap.isOpened():
-                return None
-            
-            # Try to get codec (note: OpenCV may not always report this correctly)
-            # But we can use ffprobe if available
-            fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
-            cap.release()
-            
-            # Convert fourcc to codec string
-            codec_str = ""
-            for i in range(4):
-                codec_str += chr(fourcc >> (8 * i) & 0xFF)
-            
-            return codec_str if codec_str.strip() else None
-        except:
-            return None
+    def flush(self):
+        self.out.flush()
     
-    def embed_key_based(self, video_path, output_path, keys, sequence, frag_length=1):
-        """
-        Embed key-based watermark
-        
-        Args:
-            video_path (str): Input video file path
-            output_path (str): Output video file path
-            keys (list): List of integer keys [10, 11, 12, 13]
-            sequence (str): Sequence string "0231" indicating which key for which segment
-            frag_length (float): Fragment length in seconds (default: 1)
+    def close(self):
+        if self._buffer.strip():
+            self._emit(self._buffer)
+        self._buffer = ''
+    
+    def _emit(self, line):
+        if not line.strip():
+            return
+        try:
+            event = json.loads(line)
+        except ValueError:
+            event = None
+        if not isinstance(event, dict):
+            event = {"status": "log", "message": line.strip()}
+        _write_message(self.out, {"type": "event", "job_id": self.job_id, **event})
+
+
+def _write_message(out, message):
+    """Write one JSON-lines protocol message"""
+    out.write(json.dumps(message) + '\n')
+    out.flush()
+
+
+def _run_job(writer, job_id, func, *args):
+    """Run one serve-mode job with its output sent as events tagged with `job_id`, and send its result"""
+    stream = _JobEventStream(writer, job_id)
+    real_stdout = sys.stdout
+    sys.stdout = stream
+    try:
+        result = func(*args)
+    except KeyError as e:
+        result = {"success": False, "error": f"Missing required argument: {str(e)}"}
+    except Exception as e:
+        result = {"success": False, "error": str(e), "traceback": traceback.format_exc()}
+    finally:
+        stream.close()
+        sys.stdout = real_stdout
+    _write_message(writer, {"type": "result", "job_id": job_id, "result": result})
+
+
+def _serve_stream(reader, writer, processors):
+    """
+    Process framed JSON requests from a line reader until EOF or shutdown
+
+    Request:  {"id": "job-1", "command": "embed-key", "args": {...}}
+    Messages: {"type": "event", "job_id": ..., "status": ..., ...}
+              {"type": "result", "job_id": ..., "result": {...}}
+
+    Returns True if a shutdown was requested.
+    """
+    for line in reader:
+        if not line.strip():
+            continue
         
-        Returns:
-            dict: Result with success status and metadata
-        """
         try:
-            print(json.dumps({
-                "status": "processing",
-                "message": f"Starting key-based watermarking...",
-                "progress": 0
-            }), flush=True)
-            
-            # Validate inputs
-            if not os.path.exists(video_path):
-                raise FileNotFoundError(f"Video file not found: {video_path}")
-            
-            if not keys or len(keys) == 0:
-                raise ValueError("Keys list cannot be empty")
-            
-            if not sequence:
-                raise ValueError("Sequence cannot be empty")
-            
-            # Log input codec info
-            input_codec = get_video_codec(video_path)
-            print(json.dumps({
-                "status": "debug",
-                "message": f"Input video codec detected: {input_codec if input_codec else 'Unknown'}"
-            }), flush=True)
-            
-            # Create encoder
-            encoder = DtcwtKeyEncoder(str=self.strength, step=self.step)
-            
-            print(json.dumps({
-                "status": "processing",
-                "message": "Embedding watermark into video frames...",
-                "progress": 25
-            }), flush=True)
-            
-            # Embed directly to output path (same format as input)
-            try:
-                encoder.embed_video_async(
-                    keys=keys,
-                    seq=sequence,
-                    frag_length=frag_length,
-                    video_path=video_path,
-                    output_path=output_path,
-                    threads=self.threads
-                )
-            except Exception as embed_error:
-                print(json.dumps({
-                    "status": "error",
-                    "message": f"Watermark embedding failed: {str(embed_error)}"
-                }), flush=True)
-                raise
-            
-            print(json.dumps({
-                "status": "processing",
-                "message": "Watermark embedded successfully",
-                "progress": 90
-            }), flush=True)
-            
-            # Verify output file
-            if not os.path.exists(output_path):
-                raise FileNotFoundError(f"Output file was not created: {output_path}")
-            
-            output_size = os.path.getsize(output_path)
-            
-            # 256 byte check: indicates VideoWriter failed to write properly
-            if output_size <= 256:
-                error_msg = f"Output file too small ({output_size} bytes) - VideoWriter likely failed. This usually means codec initialization failed."
-                print(json.dumps({
-                    "status": "error",
-                    "message": error_msg
-                }), flush=True)
-                # Clean up corrupted file
-                try:
-                    os.remove(output_path)
-                except:
-                    pass
-                raise ValueError(error_msg)
-            
-            if output_size == 0:
-                raise ValueError(f"Output file is empty (0 bytes): {output_path}")
-            
-            # Log file size ratio
-            input_size = os.path.getsize(video_path)
-            size_ratio = (output_size / input_size * 100) if input_size > 0 else 0
-            print(json.dumps({
-                "status": "debug",
-                "message": f"File size - Input: {input_size} bytes ({input_size/1024/1024:.2f}MB), Output: {output_size} bytes ({output_size/1024/1024:.2f}MB), Ratio: {size_ratio:.1f}%"
-            }), flush=True)
-            
-            # CRITICAL: Add audio back from original video
-            # OpenCV VideoWriter doesn't preserve audio, so we need to merge it using FFmpeg
-            print(json.dumps({
-                "status": "processing",
-                "message": "Merging audio from original video...",
-                "progress": 92
-            }), flush=True)
-            
-            temp_video_no_audio = output_path.replace('.mp4', '_temp_no_audio.mp4')
-            os.rename(output_path, temp_video_no_audio)
-            
-            try:
-                # Check if original video has audio
-                audio_info = self._get_audio_info(video_path)
-                
-                if audio_info:
-                    # Merge video (watermarked) with audio (from original)
-                    ffmpeg_cmd = [
-                        self.ffmpeg_path,
-                        '-i', temp_video_no_audio,  # Watermarked video (no audio)
-                        '-i', video_path,            # Original video (with audio)
-                        '-c:v', 'copy',              # Copy video stream without re-encoding
-                        '-c:a', 'copy',              # Copy audio stream from original
-                        '-map', '0:v:0',             # Video from first input
-                        '-map', '1:a:0',             # Audio from second input
-                        '-shortest',                 # Match shortest stream
-                        '-y',
-                        output_path
-                    ]
-                    
-                    print(json.dumps({
-                        "status": "debug",
-                        "message": f"Running FFmpeg audio merge: {' '.join(ffmpeg_cmd[:5])}..."
-                    }), flush=True)
-                    
-                    result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True, timeout=300)
-                    
-                    if result.returncode == 0:
-                        # Success - remove temp file
-                        os.remove(temp_video_no_audio)
-                        print(json.dumps({
-                            "status": "debug",
-                            "message": "Audio successfully merged from original video!"
-                        }), flush=True)
-                    else:
-                        # FFmpeg failed - keep video without audio
-                        print(json.dumps({
-                            "status": "warning",
-                            "message": f"Audio merge failed, keeping video without audio. Error: {result.stderr[:200]}"
-                        }), flush=True)
-                        os.rename(temp_video_no_audio, output_path)
-                else:
-                    # Original video has no audio - just rename back
-                    print(json.dumps({
-                        "status": "debug",
-                        "message": "Original video has no audio, skipping merge."
-                    }), flush=True)
-                    os.rename(temp_video_no_audio, output_path)
-                    
-            except Exception as audio_error:
-                print(json.dumps({
-                    "status": "warning",
-                    "message": f"Audio merge failed: {str(audio_error)}, keeping video without audio"
-                }), flush=True)
-                # Fallback: keep video without audio
-                if os.path.exists(temp_video_no_audio):
-                    os.rename(temp_video_no_audio, output_path)
-            
-            # Small delay to ensure file is fully written
-            import time
-            time.sleep(0.5)
-            
-            # Get video info
-            video_info = self._get_video_info(output_path)
-            
-            return {
-                "success": True,
-                "output_path": output_path,
-                "method": "key-based",
-                "keys": keys,
-                "sequence": sequence,
-                "frag_length": frag_length,
-                "video_info": video_info,
-                "message": "Key-based watermark embedded successfully"
-            }
-            
-        except Exception as e:
-            return {
-                "success": False,
-                "error": str(e),
-                "traceback": traceback.format_exc()
-            }
-    
-    def extract_key_based(self, video_path, keys, frag_length=1):
-        """
-        Extract key-based watermark sequence
+            request = json.loads(line)
+            job_id = request.get('id')
+            command = request['command']
+            args = request.get('args') or {}
+        except (ValueError, KeyError, AttributeError) as e:
+            _write_message(writer, {
+                "type": "result",
+                "job_id": None,
+                "result": {"success": False, "error": f"Invalid request: {str(e)}"}
+            })
+            continue
+        
+        if command == 'shutdown':
+            _write_message(writer, {"type": "result", "job_id": job_id, "result": {"success": True}})
+            return True
+        
+        if command == 'ping':
+            _write_message(writer, {
+                "type": "result",
+                "job_id": job_id,
+                "result": {"success": True, "pid": os.getpid(), "warm_processors": len(processors)}
+            })
+            continue
         
-        Args:
-            video_path (str): Watermarked video file path
-            keys (list): List of keys used during embedding
-            frag_length (float): Fragment length in seconds
+        if command in STANDALONE_COMMANDS:
+            # No processor: the warm one stays as it is
+            _run_job(writer, job_id, run_standalone_command, command, args)
+            continue
         
-        Returns:
-            dict: Result with detected sequence
-        """
+        stream = _JobEventStream(writer, job_id)
+        real_stdout = sys.stdout
+        sys.stdout = stream
         try:
-            print(json.dumps({
-                "status": "processing",
-                "message": "Extracting watermark sequence...",
-                "progress": 0
-            }), flush=True)
-            
-            if not os.path.exists(video_path):
-                raise FileNotFoundError(f"Video file not found: {video_path}")
-            
-            # Create decoder
-            decoder = DtcwtKeyDecoder(str=self.strength, step=self.step)
-            
-            print(json.dumps({
-                "status": "processing",
-                "message": "Analyzing video frames...",
-                "progress": 50
-            }), flush=True)
-            
-            # Get video info if ori_frame_size not provided
-            video_info = self._get_video_info(video_path)
-            ori_frame_size = (video_info['height'], video_info['width'])
-            
-            print(json.dumps({
-                "status": "debug",
-                "message": f"Video info: {video_info['width']}x{video_info['height']}, ori_frame_size: {ori_frame_size}"
-            }), flush=True)
-            
-            # Detect sequence with error handling
-            detected_seq = None
+            args = _apply_calibration(command, args)
+        finally:
+            stream.close()
+            sys.stdout = real_stdout
+        
+        # One processor (worker pool, pattern banks) stays warm; strength and step
+        # are per job, and a job needing another pool or cache replaces it. Jobs
+        # that set none of them (calibration fills threads for embeds and
+        # detections only) run on the warm processor
+        settings = (args.get('threads'), args.get('dtcwt_backend'), args.get('cache_dir'))
+        if settings == (None, None, None):
+            from calibration import default_threads
+            settings = next(iter(processors)) if processors else (default_threads(), None, None)
+        if settings not in processors:
+            from watermark_engine import WatermarkProcessor
+            for processor in processors.values():
+                processor.close()
+            processors.clear()
             try:
-                detected_seq = decoder.detect_video_async(
-                    keys=keys,
-                    frag_length=frag_length,
-                    wmed_video_path=video_path,
-                    ori_frame_size=ori_frame_size,
-                    threads=self.threads,
-                    mode='fast'  # Try fast mode first
-                )
-                
-                print(json.dumps({
-                    "status": "debug",
-                    "message": f"detect_video_async returned: {detected_seq}"
-                }), flush=True)
-                
-            except TypeError:
-                # If mode parameter not supported, try without it
-                print(json.dumps({
-                    "status": "debug",
-                    "message": f"Retrying detect_video_async without 'mode' parameter..."
-                }), flush=True)
-                
-                detected_seq = decoder.detect_video_async(
-                    keys=keys,
-                    frag_length=frag_length,
-                    wmed_video_path=video_path,
-                    ori_frame_size=ori_frame_size,
-                    threads=self.threads
+                processors[settings] = WatermarkProcessor(
+                    threads=settings[0],
+                    cache_dir=settings[2],
+                    dtcwt_backend=settings[1]
                 )
-            
-            # Validation: Check if sequence is valid
-            if detected_seq and len(str(detected_seq).strip()) > 0 and '#' not in str(detected_seq):
-                success = True
-                message = "Watermark sequence extracted successfully"
-            else:
-                # Fallback: If sequence is empty or invalid, create a placeholder sequence
-                # This indicates the watermark data may have been lost due to video compression
-                print(json.dumps({
-                    "status": "warning",
-                    "message": f"Sequence detection failed or returned empty result: '{detected_seq}'. Creating placeholder sequence as fallback."
-                }), flush=True)
-                
-                # Create a placeholder sequence (same length as keys, filled with placeholders)
-                # Use -1 or 0 as placeholder values to indicate unknown sequence
-                placeholder_seq = [0] * len(keys)
-                detected_seq = placeholder_seq
-                success = True  # Mark as success with warning - extraction completed but sequence is placeholder
-                message = "Sequence extraction completed but data was lost (placeholder returned). This may indicate video compression issues or watermark signal loss."
-            
-            return {
-                "success": success,
-                "detected_sequence": detected_seq,
-                "keys": keys,
-                "frag_length": frag_length,
-                "message": message
-            }
-            
-        except Exception as e:
-            return {
-                "success": False,
-                "error": str(e),
-                "traceback": traceback.format_exc()
-            }
+            except ValueError as e:
+                # Unknown dtcwt_backend
+                _write_message(writer, {"type": "result", "job_id": job_id,
+                                        "result": {"success": False, "error": str(e)}})
+                continue
+        processors[settings].set_strength(args.get('strength', 1.0), args.get('step', 5.0))
+        
+        _run_job(writer, job_id, run_command, processors[settings], command, args)
     
-    # Image-based watermarking methods removed - System uses key-based only
+    return False
+
+
+def serve(port=None):
+    """
+    Run as a persistent worker
+
+    Heavy imports, the VideoWriter patch and processor state are paid for once.
+    Requests are read from stdin, or from a local TCP socket when a port is given.
+    """
+    # Load the engine before announcing readiness, so the first job does not pay for it
+    import watermark_engine  # noqa: F401
     
-    def _get_video_info(self, video_path):
-        """Get video metadata using OpenCV with retry logic"""
-        import time
+    processors = {}
+    try:
+        if port is None:
+            _write_message(sys.stdout, {"type": "ready", "pid": os.getpid(), "commands": COMMANDS})
+            _serve_stream(sys.stdin, sys.stdout, processors)
+            return
         
-        max_retries = 3
-        retry_delay = 0.5  # seconds
+        import socket
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(('127.0.0.1', port))
+        server.listen(1)
+        _write_message(sys.stdout, {
+            "type": "ready",
+            "pid": os.getpid(),
+            "port": server.getsockname()[1],
+            "commands": COMMANDS
+        })
         
-        for attempt in range(max_retries):
-            try:
-                cap = cv2.VideoCapture(video_path)
-                
-                if not cap.isOpened():
-                    if attempt < max_retries - 1:
-                        time.sleep(retry_delay)
-                        continue
-                    raise ValueError("Cannot open video file")
-                
-                width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                fps = cap.get(cv2.CAP_PROP_FPS)
-                frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-                duration = frame_count / fps if fps > 0 else 0
-                
-                cap.release()
-                
-                return {
-                    "width": width,
-                    "height": height,
-                    "fps": fps,
-                    "frame_count": frame_count,
-                    "duration": duration,
-                    "size_bytes": os.path.getsize(video_path)
-                }
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
-                else:
-                    # Return partial info on final failure
-                    try:
-                        size = os.path.getsize(video_path)
-                        return {
-                            "error": str(e),
-                            "size_bytes": size,
-                            "note": "Could not open video file for full metadata but file exists"
-                        }
-                    except:
-                        return {"error": str(e)}
-    
-    def _get_audio_info(self, video_path):
-        """
-        Extract audio stream information from video using ffprobe.
-        Returns dict with audio codec, sample rate, channels, bitrate, or None if no audio.
-        """
         try:
-            # Try to find ffprobe
-            ffprobe_path = shutil.which('ffprobe')
-            
-            if not ffprobe_path:
-                # Check bundled ffmpeg folder
-                script_dir = Path(__file__).parent.parent
-                bundled_paths = [
-                    script_dir / 'ffmpeg' / 'bin' / 'ffprobe.exe',
-                    Path('C:/ffmpeg/bin/ffprobe.exe'),  # Common Windows location
-                ]
-                
-                for path in bundled_paths:
-                    if path.exists():
-                        ffprobe_path = str(path)
+            while True:
+                conn, _ = server.accept()
+                with conn, conn.makefile('r', encoding='utf-8') as reader, \
+                        conn.makefile('w', encoding='utf-8') as writer:
+                    if _serve_stream(reader, writer, processors):
                         break
-            
-            if not ffprobe_path:
-                print(json.dumps({
-                    "status": "warning",
-                    "message": "ffprobe not found, cannot detect audio. Audio may be lost!"
-                }), flush=True)
-                return None
-            
-            print(json.dumps({
-                "status": "debug",
-                "message": f"Using ffprobe: {ffprobe_path}"
-            }), flush=True)
-            
-            # Get detailed audio info using ffprobe
-            cmd = [
-                ffprobe_path,
-                '-v', 'error',
-                '-select_streams', 'a:0',
-                '-show_entries', 'stream=codec_name,sample_rate,channels,bit_rate',
-                '-of', 'default=noprint_wrappers=1:nokey=1',
-                video_path
-            ]
-            
-            print(json.dumps({
-                "status": "debug",
-                "message": f"Running command: {' '.join(cmd[:7])}..."
-            }), flush=True)
-            
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-            
-            print(json.dumps({
-                "status": "debug",
-                "message": f"ffprobe returncode: {result.returncode}, stdout: '{result.stdout.strip()}', stderr: '{result.stderr[:100]}'"
-            }), flush=True)
-            
-            if result.returncode != 0 or not result.stdout.strip():
-                # No audio stream found
-                print(json.dumps({
-                    "status": "debug",
-                    "message": "No audio stream detected or ffprobe failed"
-                }), flush=True)
-                return None
-            
-            # Parse output: codec_name\nsample_rate\nchannels\nbit_rate (one per line)
-            lines = result.stdout.strip().split('\n')
-            if len(lines) >= 1 and lines[0]:
-                audio_info = {
-                    'codec': lines[0] if lines[0] else 'unknown',
-                    'sample_rate': lines[1] if len(lines) > 1 and lines[1] else '44100',
-                    'channels': lines[2] if len(lines) > 2 and lines[2] else '2',
-                    'bitrate': lines[3] if len(lines) > 3 and lines[3] else 'N/A'
-                }
-                
-                print(json.dumps({
-                    "status": "debug",
-                    "message": f"Audio info detected: codec={audio_info['codec']}, sr={audio_info['sample_rate']}, ch={audio_info['channels']}"
-                }), flush=True)
-                
-                return audio_info
-            
-            return None
-            
-        except Exception as e:
-            print(json.dumps({
-                "status": "debug",
-                "message": f"Could not detect audio info: {str(e)}"
-            }), flush=True)
-            import traceback
-            print(json.dumps({
-                "status": "debug",
-                "message": f"Traceback: {traceback.format_exc()}"
-            }), flush=True)
-            return None
+        finally:
+            server.close()
+    finally:
+        for processor in processors.values():
+            processor.close()
 
 
 def main():
@@ -665,37 +544,38 @@ def main():
         else:
             args = {}
         
-        # Get processor settings
-        strength = args.get('strength', 1.0)
-        step = args.get('step', 5.0)
-        threads = args.get('threads', 8)
+        if command == 'serve':
+            serve(port=args.get('port'))
+            return
         
-        processor = WatermarkProcessor(strength=strength, step=step, threads=threads)
+        if command in STANDALONE_COMMANDS:
+            result = run_standalone_command(command, args)
         
-        # Execute command
-        if command == 'embed-key':
-            result = processor.embed_key_based(
-                video_path=args['video_path'],
-                output_path=args['output_path'],
-                keys=args['keys'],
-                sequence=args['sequence'],
-                frag_length=args.get('frag_length', 1)
-            )
-        
-        elif command == 'extract-key':
-            result = processor.extract_key_based(
-                video_path=args['video_path'],
-                keys=args['keys'],
-                frag_length=args.get('frag_length', 1)
-            )
-        
-        else:
+        elif command not in COMMANDS:
             result = {
                 "success": False,
                 "error": f"Unknown command: {command}",
-                "available_commands": ["embed-key", "extract-key"]
+                "available_commands": COMMANDS
             }
         
+        else:
+            from watermark_engine import WatermarkProcessor
+            
+            # Get processor settings; unset worker settings come from the calibration
+            args = _apply_calibration(command, args)
+            strength = args.get('strength', 1.0)
+            step = args.get('step', 5.0)
+            threads = args.get('threads')
+            
+            processor = WatermarkProcessor(strength=strength, step=step, threads=threads, cache_dir=args.get('cache_dir'),
+                                           dtcwt_backend=args.get('dtcwt_backend'))
+            
+            # Execute command
+            try:
+                result = run_command(processor, command, args)
+            finally:
+                processor.close()
+        
         # Output result
         print(json.dumps(result, indent=2))
         
@@ -141,7 +141,8 @@ async function startEmbedProcess() {
     const userName = document.getElementById('userName').value;
     const strength = parseFloat(document.getElementById('strengthInput').value);
     const step = parseFloat(document.getElementById('stepInput').value);
-    const threads = parseInt(document.getElementById('threadsInput').value);
+    // Boş bırakılırsa bu makinenin kalibrasyonu (veya varsayılan) kullanılır
+    const threads = parseInt(document.getElementById('threadsInput').value) || null;
     const fragLength = parseFloat(document.getElementById('fragLengthInput').value);
 
     // Validate user info